@@ -98,14 +98,14 @@ if load_casscf_guess:
     N2Hb.load_amo_guess_from_casscf_npy (npyfile, norbs_cmo, norbs_amo)
 elif dr_guess is not None:
     chkname = ('c2h6n4_lasscf_dr' + ['{:02.0F}','{:03.0F}'][dr_guess < 0]).format (dr_guess*10)
-    c2h6n4_dmet.load_checkpoint (chkname + '.chk.npy')
+    c2h6n4_dmet.load_checkpoint (chkname + '.chk.h5')
 else:
     c2h6n4_dmet.generate_frag_cas_guess (mf.mo_coeff, caslst=CASlist)
 
 # Calculation
 # --------------------------------------------------------------------------------------------------------------------
 energy_result = c2h6n4_dmet.doselfconsistent ()
-c2h6n4_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.npy')
+c2h6n4_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.h5')
 print ("----Energy: {:.1f} {:.8f}".format (dr_nn, energy_result))
 
 # Save natural-orbital moldens
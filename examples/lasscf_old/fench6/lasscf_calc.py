@@ -215,9 +215,9 @@ if load_casscf_guess:
     norbs_amo = 5
     Fe.load_amo_guess_from_casscf_npy (npyfile, norbs_cmo, norbs_amo)
 elif load_lasscf_chk:
-    fench_dmet.load_checkpoint (my_kwargs['calcname'] + '.chk.npy')
+    fench_dmet.load_checkpoint (my_kwargs['calcname'] + '.chk.h5')
 elif load_lasscf_sto3g_chk:
-    fench_dmet.load_checkpoint (my_kwargs['calcname'][:-5] + 'sto3g.chk.npy', prev_mol=mol_sto3g)
+    fench_dmet.load_checkpoint (my_kwargs['calcname'][:-5] + 'sto3g.chk.h5', prev_mol=mol_sto3g)
 else:
     fn = (grab_3d_ls, grab_3d_hs)[spinS//2]
     fench_dmet.generate_frag_cas_guess (fn (mf), force_imp=True, confine_guess=False)
@@ -226,7 +226,7 @@ else:
 # --------------------------------------------------------------------------------------------------------------------
 print ("Going into calculation")
 energy_result = fench_dmet.doselfconsistent ()
-fench_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.npy')
+fench_dmet.save_checkpoint (my_kwargs['calcname'] + '.chk.h5')
 print ("----S = {} energy: {:.8f}".format (spinS, energy_result))
 
 # Save natural-orbital moldens
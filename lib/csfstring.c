@@ -10,10 +10,11 @@
 #include "fblas.h"
 //#include "fci.h"
 
-void FCICSFddstrs2csdstrs (uint64_t * csdstrs, uint64_t * ddstrs, int nstr, int norb, int neleca, int nelecb)
+void FCICSFddstrs2csdstrs (uint64_t * csdstrs, uint64_t * ddstrs, int64_t nstr, int norb, int neleca, int nelecb)
 {
 
-    int i, iorb, isorb, ispin;
+    int64_t i;
+    int iorb, isorb, ispin;
     uint64_t * astrs = ddstrs;
     uint64_t * bstrs = & ddstrs[nstr];
     uint64_t * npairs = csdstrs;
@@ -44,10 +45,11 @@ void FCICSFddstrs2csdstrs (uint64_t * csdstrs, uint64_t * ddstrs, int nstr, int
     }
 }
 
-void FCICSFcsdstrs2ddstrs (uint64_t * ddstrs, uint64_t * csdstrs, int nstr, int norb, int neleca, int nelecb)
+void FCICSFcsdstrs2ddstrs (uint64_t * ddstrs, uint64_t * csdstrs, int64_t nstr, int norb, int neleca, int nelecb)
 {
 
-    int i, iorb, isorb, ispin;
+    int64_t i;
+    int iorb, isorb, ispin;
     uint64_t * astrs = ddstrs;
     uint64_t * bstrs = & ddstrs[nstr];
     uint64_t * npairs = csdstrs;
@@ -82,6 +84,187 @@ void FCICSFcsdstrs2ddstrs (uint64_t * ddstrs, uint64_t * csdstrs, int nstr, int
 }
 
 
+static uint64_t FCICSF_str2addr (uint64_t str, uint64_t binom[65][65])
+{
+    // cistring address of a string: the sum over occupied orbitals p of binom(p, k), where k is
+    // the number of occupied orbitals <= p
+    uint64_t addr = 0;
+    int nocc = 0;
+    while (str){
+        nocc++;
+        addr += binom[__builtin_ctzll (str)][nocc];
+        str &= str - 1;
+    }
+    return addr;
+}
+
+void FCICSFcsd2ddaddrs (int64_t * ddaddrs, uint64_t * dconf_strs, uint64_t * sconf_strs,
+                        uint64_t * spins_strs, int norb, int64_t ndconf, int64_t nsconf,
+                        int64_t nspins, int64_t ndetb)
+{
+    // Determinant-pair addresses (ideta*ndetb + idetb) of the full product of the doubly-occupied
+    // configurations dconf_strs, singly-occupied configurations sconf_strs and spin states
+    // spins_strs of one number of electron pairs, in csd order:
+    // ddaddrs[(idconf*nsconf + isconf)*nspins + ispins]
+    // Same as csdstrs2ddstrs followed by cistring.strs2addr.
+
+    uint64_t binom[65][65];
+    int i, j;
+    for (i = 0; i < 65; i++){
+        binom[i][0] = 1;
+        for (j = 1; j < 65; j++){
+            binom[i][j] = (i == 0) ? 0 : binom[i-1][j-1] + binom[i-1][j];
+        }
+    }
+
+#pragma omp parallel default(shared)
+{
+
+    int64_t idconf, isconf, ispins;
+    int iorb, isorb, nspin;
+    int sorbs[64];
+    uint64_t dconf, sconf, spins, astr, bstr, open;
+    int64_t * out;
+
+#pragma omp for schedule(static)
+
+    for (idconf = 0; idconf < ndconf; idconf++){
+        dconf = dconf_strs[idconf];
+        for (isconf = 0; isconf < nsconf; isconf++){
+            out = ddaddrs + (idconf * nsconf + isconf) * nspins;
+            sconf = sconf_strs[isconf];
+            // Orbital indices of the singly-occupied orbitals
+            nspin = 0;
+            isorb = 0;
+            open = 0;
+            for (iorb = 0; iorb < norb; iorb++){
+                if ((1ULL << iorb) & dconf){ continue; }
+                if ((1ULL << isorb) & sconf){
+                    sorbs[nspin] = iorb;
+                    open |= 1ULL << iorb;
+                    nspin++;
+                }
+                isorb++;
+            }
+            for (ispins = 0; ispins < nspins; ispins++){
+                spins = spins_strs[ispins];
+                astr = dconf;
+                while (spins){
+                    astr |= 1ULL << sorbs[__builtin_ctzll (spins)];
+                    spins &= spins - 1;
+                }
+                bstr = dconf | (open & ~astr);
+                out[ispins] = ((int64_t) FCICSF_str2addr (astr, binom)) * ndetb
+                            + ((int64_t) FCICSF_str2addr (bstr, binom));
+            }
+        }
+    }
+
+}
+}
+
+#define CSF_TRANSFORM_BLKSIZE 16384
+
+static inline uint64_t FCICSF_get_addr (void * addrs, int addr_is64, uint64_t i)
+{
+    if (addr_is64){ return ((uint64_t *) addrs)[i]; }
+    return (uint64_t) ((uint32_t *) addrs)[i];
+}
+
+void FCICSFdet2csf_blk (double * csfvec, double * detvec, void * det_addrs, int addr_is64,
+                        double * umat, int nvec, int64_t ncsf_all, int64_t ndet_all,
+                        uint64_t nconf, int ndet, int ncsf)
+{
+    // Transform the determinants of nconf configurations of the same number of unpaired electrons
+    // into CSFs:
+    // csfvec[ivec,iconf*ncsf+icsf] = sum_idet detvec[ivec,det_addrs[iconf*ndet+idet]] * umat[idet,icsf]
+    // where csfvec points to the first CSF of the first configuration of vector 0, the rows
+    // of csfvec and detvec are ncsf_all and ndet_all long, and det_addrs are 32-bit unless
+    // addr_is64. Each thread gathers a chunk of configurations into a buffer and multiplies it by
+    // umat.
+
+    const char trans = 'N';
+    const double d_one = 1.0;
+    const double d_zero = 0.0;
+    const int nblk = (CSF_TRANSFORM_BLKSIZE / ndet > 0) ? CSF_TRANSFORM_BLKSIZE / ndet : 1;
+    const uint64_t nchunk = (nconf + nblk - 1) / nblk;
+
+#pragma omp parallel default(shared)
+{
+
+    int ivec, idet, nc, ic;
+    uint64_t ichunk, iconf, ijob;
+    double * buf = malloc (((size_t) nblk) * ndet * sizeof (double));
+    double * vec;
+
+#pragma omp for schedule(static)
+
+    for (ijob = 0; ijob < nchunk * nvec; ijob++){
+        ivec = ijob / nchunk;
+        ichunk = ijob % nchunk;
+        iconf = ichunk * nblk;
+        nc = (nconf - iconf < nblk) ? (int) (nconf - iconf) : nblk;
+        vec = detvec + ivec * ndet_all;
+        for (ic = 0; ic < nc; ic++){
+        for (idet = 0; idet < ndet; idet++){
+            buf[ic*ndet + idet] = vec[FCICSF_get_addr (det_addrs, addr_is64,
+                                                       (iconf + ic) * ndet + idet)];
+        }}
+        dgemm_(&trans, &trans, &ncsf, &nc, &ndet,
+               &d_one, umat, &ncsf, buf, &ndet,
+               &d_zero, csfvec + ivec * ncsf_all + iconf * ncsf, &ncsf);
+    }
+
+    free (buf);
+
+}
+}
+
+void FCICSFcsf2det_blk (double * detvec, double * csfvec, void * det_addrs, int addr_is64,
+                        double * umat, int nvec, int64_t ncsf_all, int64_t ndet_all,
+                        uint64_t nconf, int ndet, int ncsf)
+{
+    // Inverse of FCICSFdet2csf_blk:
+    // detvec[ivec,det_addrs[iconf*ndet+idet]] = sum_icsf csfvec[ivec,iconf*ncsf+icsf] * umat[idet,icsf]
+    // Determinants of other configurations are not touched.
+
+    const char trans = 'T';
+    const char notrans = 'N';
+    const double d_one = 1.0;
+    const double d_zero = 0.0;
+    const int nblk = (CSF_TRANSFORM_BLKSIZE / ndet > 0) ? CSF_TRANSFORM_BLKSIZE / ndet : 1;
+    const uint64_t nchunk = (nconf + nblk - 1) / nblk;
+
+#pragma omp parallel default(shared)
+{
+
+    int ivec, idet, nc, ic;
+    uint64_t ichunk, iconf, ijob;
+    double * buf = malloc (((size_t) nblk) * ndet * sizeof (double));
+    double * vec;
+
+#pragma omp for schedule(static)
+
+    for (ijob = 0; ijob < nchunk * nvec; ijob++){
+        ivec = ijob / nchunk;
+        ichunk = ijob % nchunk;
+        iconf = ichunk * nblk;
+        nc = (nconf - iconf < nblk) ? (int) (nconf - iconf) : nblk;
+        dgemm_(&trans, &notrans, &ndet, &nc, &ncsf,
+               &d_one, umat, &ncsf, csfvec + ivec * ncsf_all + iconf * ncsf, &ncsf,
+               &d_zero, buf, &ndet);
+        vec = detvec + ivec * ndet_all;
+        for (ic = 0; ic < nc; ic++){
+        for (idet = 0; idet < ndet; idet++){
+            vec[FCICSF_get_addr (det_addrs, addr_is64, (iconf + ic) * ndet + idet)] = buf[ic*ndet + idet];
+        }}
+    }
+
+    free (buf);
+
+}
+}
+
 void FCICSFmakecsf (double * umat, uint64_t * detstr, uint64_t * coupstr, int nspin, int ndet, int ncoup, int twoS, int twoMS)
 {
 
@@ -291,71 +474,364 @@ void FCICSFaddrs2str (uint64_t * strings, int * addrs, int nstr, int * gentable_
     free (gentable);
 }
 
-void FCICSFhdiag (double * hdiag, double * hdiag_det, double * eri, uint64_t * astrs, uint64_t * bstrs, unsigned int norb, unsigned int nconf, unsigned int ndet)
+void FCICSFhdiag (double * hdiag, double * hdiag_det, double * eri, uint64_t * astrs, uint64_t * bstrs, unsigned int norb, uint64_t nconf, unsigned int ndet)
 {
+    // Each thread handles all the elements (idetx, idety <= idetx) of one row of the
+    // determinant-basis block of one configuration at a time; elements between determinants that
+    // differ by more than one spin flip are left untouched, so hdiag must be zeroed by the caller
 
-    unsigned int ndet_lt = ndet * (ndet+1) / 2;
+    uint64_t nrow = nconf * ((uint64_t) ndet);
 
 #pragma omp parallel default(shared)
 {
 
-    unsigned int idetconf, iconf, idet_lt, idetx, idety, iorb, nexc;
-    uint64_t exc_str, somo_str, big_idx1, big_idx2, hdiag_idx_lt, hdiag_idx_ut;
+    uint64_t iconf;
+    unsigned int idetx, idety, iorb, nexc;
+    uint64_t irow, exc_str, somo_str, big_idx1, big_idx2, hdiag_idx_lt, hdiag_idx_ut;
     unsigned int exc[2];
     int sgn, esgn;
 
-#pragma omp for schedule(static) 
+#pragma omp for schedule(dynamic, 16)
 
-    for (idetconf = 0; idetconf < nconf * ndet_lt; idetconf++){
-        iconf = idetconf / ndet_lt;
-        idety = idetconf % ndet_lt;
-        for (idetx = 0; idetx < ndet; idetx++){
-            if (idetx < idety){ idety -= idetx + 1; }
-            else { break; }
-        }
+    for (irow = 0; irow < nrow; irow++){
+        iconf = irow / ndet;
+        idetx = irow % ndet;
         // Careful with possible integer overflow
         hdiag_idx_lt = ndet;
         hdiag_idx_lt *= ndet;
         hdiag_idx_lt *= iconf;
-        hdiag_idx_ut = hdiag_idx_lt;
-        big_idx1 = ndet;
-        big_idx1 *= idety;
-        big_idx2 = ndet;
-        big_idx2 *= idetx;
-        hdiag_idx_lt += big_idx1;
-        hdiag_idx_ut += big_idx2;
-        hdiag_idx_lt += idetx;
-        hdiag_idx_ut += idety;
-        if (idetx == idety){ 
-            hdiag[hdiag_idx_lt] = hdiag_det[(iconf*ndet)+idetx];
+        big_idx1 = (((uint64_t) ndet)*iconf) + idetx;
+        hdiag[hdiag_idx_lt + (((uint64_t) ndet)*idetx) + idetx] = hdiag_det[big_idx1];
+        somo_str = astrs[big_idx1] ^ bstrs[big_idx1];
+        for (idety = 0; idety < idetx; idety++){
+            big_idx2 = (((uint64_t) ndet)*iconf) + idety;
+            exc_str  = astrs[big_idx1] ^ astrs[big_idx2];
+            nexc = 0; esgn = 1; sgn = -1;
+            for (iorb = 0; iorb < norb; iorb++){
+                if (somo_str & 1ULL << iorb){ esgn *= -1; }
+                if (exc_str & 1ULL << iorb){
+                    if (nexc < 2){ exc[nexc] = iorb; }
+                    nexc++;
+                    if (nexc > 2){ break; }
+                    sgn *= esgn;
+                }
+            } 
+            if (nexc > 2){ continue; }
+            assert (nexc == 2);
+            hdiag_idx_ut = hdiag_idx_lt + (((uint64_t) ndet)*idetx) + idety;
+            big_idx2 = exc[0]*norb*norb*norb + exc[1]*norb*norb + exc[1]*norb + exc[0];
+            hdiag[hdiag_idx_ut] = sgn * eri[big_idx2];
+            hdiag[hdiag_idx_lt + (((uint64_t) ndet)*idety) + idetx] = hdiag[hdiag_idx_ut];
+        }
+    }
+
+}
+}
+
+
+static int FCICSF_cre_des_sign (uint64_t str, unsigned int p, unsigned int q)
+{
+    // Sign of p' q |str>: (-1)**(number of occupied orbitals strictly between p and q)
+    uint64_t mask;
+    if (p == q){ return 1; }
+    if (p > q){ mask = (1ULL << p) - (1ULL << (q+1)); }
+    else { mask = (1ULL << q) - (1ULL << (p+1)); }
+    return (__builtin_popcountll (str & mask) % 2) ? -1 : 1;
+}
+
+static void FCICSF_lowest_two (uint64_t str, unsigned int * idx)
+{
+    idx[0] = __builtin_ctzll (str);
+    str &= str - 1;
+    idx[1] = str ? __builtin_ctzll (str) : 0;
+}
+
+static double FCICSF_hij (double * h1e_a, double * h1e_b, double * eri, uint64_t bra_astr,
+                          uint64_t bra_bstr, uint64_t ket_astr, uint64_t ket_bstr,
+                          unsigned int norb)
+{
+    // <bra|H|ket> for two different determinants by the Slater-Condon rules
+    // eri is (pq|rs) in chemist's notation, unpacked
+    uint64_t n1 = norb;
+    uint64_t n2 = n1 * n1;
+    uint64_t n3 = n2 * n1;
+    uint64_t xa = bra_astr ^ ket_astr;
+    uint64_t xb = bra_bstr ^ ket_bstr;
+    int nxa = __builtin_popcountll (xa);
+    int nxb = __builtin_popcountll (xb);
+    unsigned int cre[2], des[2], k;
+    uint64_t str;
+    int sgn;
+    double val = 0;
+    if (nxa + nxb > 4 || (nxa + nxb) == 0){ return 0; }
+    if (nxa == 2 && nxb == 0){
+        // alpha single: des[0] -> cre[0]
+        FCICSF_lowest_two (xa & bra_astr, cre);
+        FCICSF_lowest_two (xa & ket_astr, des);
+        sgn = FCICSF_cre_des_sign (ket_astr, cre[0], des[0]);
+        val = h1e_a[cre[0]*n1 + des[0]];
+        for (k = 0; k < norb; k++){
+            if (ket_astr & (1ULL << k)){
+                val += eri[cre[0]*n3 + des[0]*n2 + k*n1 + k];
+                val -= eri[cre[0]*n3 + k*n2 + k*n1 + des[0]];
+            }
+            if (ket_bstr & (1ULL << k)){
+                val += eri[cre[0]*n3 + des[0]*n2 + k*n1 + k];
+            }
+        }
+        return sgn * val;
+    }
+    if (nxa == 0 && nxb == 2){
+        // beta single: des[0] -> cre[0]
+        FCICSF_lowest_two (xb & bra_bstr, cre);
+        FCICSF_lowest_two (xb & ket_bstr, des);
+        sgn = FCICSF_cre_des_sign (ket_bstr, cre[0], des[0]);
+        val = h1e_b[cre[0]*n1 + des[0]];
+        for (k = 0; k < norb; k++){
+            if (ket_bstr & (1ULL << k)){
+                val += eri[cre[0]*n3 + des[0]*n2 + k*n1 + k];
+                val -= eri[cre[0]*n3 + k*n2 + k*n1 + des[0]];
+            }
+            if (ket_astr & (1ULL << k)){
+                val += eri[cre[0]*n3 + des[0]*n2 + k*n1 + k];
+            }
+        }
+        return sgn * val;
+    }
+    if (nxa == 2 && nxb == 2){
+        // alpha des[0] -> cre[0], beta des[1] -> cre[1]
+        unsigned int ca[2], da[2], cb[2], db[2];
+        FCICSF_lowest_two (xa & bra_astr, ca);
+        FCICSF_lowest_two (xa & ket_astr, da);
+        FCICSF_lowest_two (xb & bra_bstr, cb);
+        FCICSF_lowest_two (xb & ket_bstr, db);
+        sgn = FCICSF_cre_des_sign (ket_astr, ca[0], da[0]);
+        sgn *= FCICSF_cre_des_sign (ket_bstr, cb[0], db[0]);
+        return sgn * eri[ca[0]*n3 + da[0]*n2 + cb[0]*n1 + db[0]];
+    }
+    // same-spin double: des[0],des[1] -> cre[0],cre[1]
+    if (nxa == 4){
+        FCICSF_lowest_two (xa & bra_astr, cre);
+        FCICSF_lowest_two (xa & ket_astr, des);
+        str = ket_astr;
+    } else {
+        FCICSF_lowest_two (xb & bra_bstr, cre);
+        FCICSF_lowest_two (xb & ket_bstr, des);
+        str = ket_bstr;
+    }
+    sgn = FCICSF_cre_des_sign (str, cre[0], des[0]);
+    str ^= (1ULL << cre[0]) | (1ULL << des[0]);
+    sgn *= FCICSF_cre_des_sign (str, cre[1], des[1]);
+    val = eri[cre[0]*n3 + des[0]*n2 + cre[1]*n1 + des[1]];
+    val -= eri[cre[0]*n3 + des[1]*n2 + cre[1]*n1 + des[0]];
+    return sgn * val;
+}
+
+static int FCICSF_cmp_keys (const void * a, const void * b)
+{
+    uint64_t x = ((uint64_t *) a)[0];
+    uint64_t y = ((uint64_t *) b)[0];
+    return (x > y) - (x < y);
+}
+
+static void FCICSF_hrow_matches (double * hrow, uint64_t * keys, uint64_t key, double * h1e_a,
+                                 double * h1e_b, double * eri, uint64_t bra_astr,
+                                 uint64_t bra_bstr, uint64_t * ket_astrs, uint64_t * ket_bstrs,
+                                 unsigned int norb, unsigned int ndet_ket)
+{
+    // Evaluate the elements of hrow for all ket determinants whose key (keys[2*i]; sorted, with
+    // the ket index in keys[2*i+1]) equals key
+    unsigned int lo = 0, hi = ndet_ket, mid;
+    uint64_t iket;
+    while (lo < hi){
+        mid = (lo + hi) / 2;
+        if (keys[2*mid] < key){ lo = mid + 1; }
+        else { hi = mid; }
+    }
+    for (; lo < ndet_ket && keys[2*lo] == key; lo++){
+        iket = keys[2*lo+1];
+        hrow[iket] = FCICSF_hij (h1e_a, h1e_b, eri, bra_astr, bra_bstr, ket_astrs[iket],
+                                 ket_bstrs[iket], norb);
+    }
+}
+
+void FCICSFhoffdiag_blocks (double * hblk, double * h1e_a, double * h1e_b, double * eri,
+                            uint64_t * bra_astrs, uint64_t * bra_bstrs, uint64_t * ket_astrs,
+                            uint64_t * ket_bstrs, unsigned int norb, uint64_t npair,
+                            unsigned int ndet_bra, unsigned int ndet_ket)
+{
+    // Determinant-basis Hamiltonian blocks between pairs of electron configurations:
+    // hblk[ipair,i,j] = <bra_ipair,i|H|ket_ipair,j>, with the strings of the determinants of the
+    // bra and ket configurations of the ipair'th pair in bra_*strs[ipair,:] and ket_*strs[ipair,:].
+    // Elements between identical determinants are set to zero.
+    //
+    // If the configurations differ by nexc (= 1 or 2) electron moves, two determinants can only
+    // interact if the spins of the spectator electrons (singly-occupied orbitals of both
+    // configurations) differ in at most 2 - nexc places. The ket determinants are therefore sorted
+    // by the spin-up string of their spectators, and only the matching ones are visited for each
+    // bra determinant, instead of all of them.
+
+    uint64_t nblk = ((uint64_t) ndet_bra) * ((uint64_t) ndet_ket);
+
+#pragma omp parallel default(shared)
+{
+
+    uint64_t ipair, ibra, iket, key, spec, socc_bra, docc_bra, socc_ket, docc_ket;
+    uint64_t * ba, * bb, * ka, * kb;
+    uint64_t * keys = malloc (2 * ((uint64_t) ndet_ket) * sizeof (uint64_t));
+    double * hpair, * hrow;
+    unsigned int iorb;
+    int nexc2;
+
+#pragma omp for schedule(dynamic)
+
+    for (ipair = 0; ipair < npair; ipair++){
+        hpair = hblk + (ipair * nblk);
+        memset (hpair, 0, nblk * sizeof (double));
+        ba = bra_astrs + (ipair * ndet_bra);
+        bb = bra_bstrs + (ipair * ndet_bra);
+        ka = ket_astrs + (ipair * ndet_ket);
+        kb = ket_bstrs + (ipair * ndet_ket);
+        socc_bra = ba[0] | bb[0];
+        docc_bra = ba[0] & bb[0];
+        socc_ket = ka[0] | kb[0];
+        docc_ket = ka[0] & kb[0];
+        nexc2 = __builtin_popcountll (socc_bra ^ socc_ket);
+        nexc2 += __builtin_popcountll (docc_bra ^ docc_ket);
+        if (nexc2 > 4){ continue; }
+        if (nexc2 == 0){ // Same configuration: visit everything
+            for (ibra = 0; ibra < ndet_bra; ibra++){
+                hrow = hpair + (ibra * ndet_ket);
+                for (iket = 0; iket < ndet_ket; iket++){
+                    hrow[iket] = FCICSF_hij (h1e_a, h1e_b, eri, ba[ibra], bb[ibra], ka[iket],
+                                             kb[iket], norb);
+                }
+            }
             continue;
         }
-        // Fear of integer overflow is only reasonable for off-diagonal elements of a Hamiltonian matrix
-        // It's not reasonable for anything else
-        big_idx1 = (ndet*iconf) + idetx;
-        big_idx2 = (ndet*iconf) + idety;
-        exc_str  = astrs[big_idx1] ^ astrs[big_idx2];
-        somo_str = astrs[big_idx1] ^ bstrs[big_idx1];
-        nexc = 0; esgn = 1; sgn = -1;
-        for (iorb = 0; iorb < norb; iorb++){
-            if (somo_str & 1ULL << iorb){ esgn *= -1; }
-            if (exc_str & 1ULL << iorb){
-                if (nexc < 2){ exc[nexc] = iorb; }
-                nexc++;
-                if (nexc > 2){ break; }
-                sgn *= esgn;
+        spec = (socc_bra & ~docc_bra) & (socc_ket & ~docc_ket);
+        for (iket = 0; iket < ndet_ket; iket++){
+            keys[2*iket] = ka[iket] & spec;
+            keys[2*iket+1] = iket;
+        }
+        qsort (keys, ndet_ket, 2 * sizeof (uint64_t), FCICSF_cmp_keys);
+        for (ibra = 0; ibra < ndet_bra; ibra++){
+            hrow = hpair + (ibra * ndet_ket);
+            key = ba[ibra] & spec;
+            FCICSF_hrow_matches (hrow, keys, key, h1e_a, h1e_b, eri, ba[ibra], bb[ibra], ka, kb,
+                                 norb, ndet_ket);
+            if (nexc2 == 4){ continue; }
+            for (iorb = 0; iorb < norb; iorb++){
+                if (spec & (1ULL << iorb)){
+                    FCICSF_hrow_matches (hrow, keys, key ^ (1ULL << iorb), h1e_a, h1e_b, eri,
+                                         ba[ibra], bb[ibra], ka, kb, norb, ndet_ket);
+                }
             }
-        } 
-        if (nexc > 2){ continue; }
-        assert (nexc == 2);
-
-        // Fear of integer overflow is only reasonable for off-diagonal elements of a Hamiltonian matrix
-        // It's not reasonable for anything else
-        big_idx1 = exc[0]*norb*norb*norb + exc[1]*norb*norb + exc[1]*norb + exc[0];
-        hdiag[hdiag_idx_lt] = sgn * eri[big_idx1];
-        hdiag[hdiag_idx_ut] = hdiag[hdiag_idx_lt];
+        }
     }
+    free (keys);
 
 }
 }
 
+void FCICSFhdiag_dets (double * hdiag, double * h1e_a, double * h1e_b, double * eri,
+                       uint64_t * astrs, uint64_t * bstrs, unsigned int norb, uint64_t ndet)
+{
+    // Diagonal elements <det|H|det> by the Slater-Condon rules
+    // eri is (pq|rs) in chemist's notation, unpacked
+
+    uint64_t n1 = norb;
+    uint64_t n2 = n1 * n1;
+    uint64_t n3 = n2 * n1;
+
+#pragma omp parallel default(shared)
+{
+
+    uint64_t idet, astr, bstr;
+    unsigned int i, j;
+    double val, jij;
+
+#pragma omp for schedule(static)
+
+    for (idet = 0; idet < ndet; idet++){
+        astr = astrs[idet];
+        bstr = bstrs[idet];
+        val = 0;
+        for (i = 0; i < norb; i++){
+            if (astr & (1ULL << i)){ val += h1e_a[i*n1 + i]; }
+            if (bstr & (1ULL << i)){ val += h1e_b[i*n1 + i]; }
+            for (j = 0; j < norb; j++){
+                jij = eri[i*n3 + i*n2 + j*n1 + j];
+                if (astr & (1ULL << i)){
+                    if (astr & (1ULL << j)){ val += 0.5 * (jij - eri[i*n3 + j*n2 + j*n1 + i]); }
+                    if (bstr & (1ULL << j)){ val += jij; }
+                }
+                if ((bstr & (1ULL << i)) && (bstr & (1ULL << j))){
+                    val += 0.5 * (jij - eri[i*n3 + j*n2 + j*n1 + i]);
+                }
+            }
+        }
+        hdiag[idet] = val;
+    }
+
+}
+}
+
+static inline int FCICSF_conf_exc (uint64_t bra_socc, uint64_t bra_docc, uint64_t ket_socc,
+                                   uint64_t ket_docc)
+{
+    // Sum over orbitals of the absolute difference between the occupation numbers of two
+    // configurations, each represented by the strings of its occupied (socc) and doubly-occupied
+    // (docc) orbitals. It is at most 4 if the configurations differ by at most a double excitation
+    return __builtin_popcountll (bra_socc ^ ket_socc) + __builtin_popcountll (bra_docc ^ ket_docc);
+}
+
+void FCICSFconf_pair_counts (int64_t * counts, uint64_t * bra_socc, uint64_t * bra_docc,
+                             uint64_t * ket_socc, uint64_t * ket_docc, int64_t nbra, int64_t nket,
+                             int triu)
+{
+    // counts[i] = number of ket configurations which differ from the ith bra configuration by at
+    // most a double excitation. If triu, only ket configurations j >= i are counted.
+
+#pragma omp parallel default(shared)
+{
+
+    int64_t ibra, iket;
+
+#pragma omp for schedule(dynamic, 64)
+
+    for (ibra = 0; ibra < nbra; ibra++){
+        counts[ibra] = 0;
+        for (iket = (triu ? ibra : 0); iket < nket; iket++){
+            if (FCICSF_conf_exc (bra_socc[ibra], bra_docc[ibra], ket_socc[iket],
+                                 ket_docc[iket]) <= 4){ counts[ibra]++; }
+        }
+    }
+
+}
+}
+
+void FCICSFconf_pair_list (int64_t * idx_ket, int64_t * offsets, uint64_t * bra_socc,
+                           uint64_t * bra_docc, uint64_t * ket_socc, uint64_t * ket_docc,
+                           int64_t nbra, int64_t nket, int triu)
+{
+    // The ket configurations counted by FCICSFconf_pair_counts, in ascending order, in
+    // idx_ket[offsets[i]:offsets[i+1]] for the ith bra configuration
+
+#pragma omp parallel default(shared)
+{
+
+    int64_t ibra, iket, ix;
+
+#pragma omp for schedule(dynamic, 64)
+
+    for (ibra = 0; ibra < nbra; ibra++){
+        ix = offsets[ibra];
+        for (iket = (triu ? ibra : 0); iket < nket; iket++){
+            if (FCICSF_conf_exc (bra_socc[ibra], bra_docc[ibra], ket_socc[iket],
+                                 ket_docc[iket]) <= 4){ idx_ket[ix++] = iket; }
+        }
+    }
+
+}
+}
@@ -15,7 +15,6 @@ from mrh.util.basis import *
 from mrh.util.io import prettyprint_ndarray as prettyprint
 from mrh.util.io import warnings
 from mrh.util.rdm import Schmidt_decomposition_idempotent_wrapper, idempotize_1RDM, get_1RDM_from_OEI, get_2RDM_from_2CDM, get_2CDM_from_2RDM, Schmidt_decompose_1RDM
-from mrh.util.tensors import symmetrize_tensor
 from mrh.util.my_math import is_close_to_integer
 from mrh.my_pyscf.tools.jmol import cas_mo_energy_shift_4_jmol
 from mrh.my_dmet.orbital_hessian import LASSCFHessianCalculator
@@ -201,6 +200,23 @@ class fragment_object:
 
     # Common runtime warning checks
     ###########################################################################################################################
+    # Attributes which are never sent between processes when fragments are handled by a process pool
+    # (see dmet.run_fragments): they are shared with the parent dmet object, hold open files, or are closures.
+    _process_local_attrs = ('ints', 'hesscalc', 'impham_get_jk', 'mol_stdout', 'imp_solver_function')
+
+    def get_process_state (self):
+        ''' Attributes to send back to the parent process after this fragment was handled by a worker process '''
+        shared = set ([id (v) for v in self.ints.__dict__.values () if isinstance (v, (np.ndarray, list))])
+        return {key: val for key, val in self.__dict__.items ()
+                if key not in self._process_local_attrs and not callable (val) and id (val) not in shared}
+
+    def set_process_state_ (self, state):
+        ''' Absorb the attributes returned by get_process_state in a worker process '''
+        self.__dict__.update (state)
+        if self.imp_solver_name == "RHF" and self.quasidirect and self.impham_built:
+            self.impham_get_jk = self.make_impham_get_jk ()
+        return self
+
     def warn_check_Schmidt (self, cstr="NONE"):
         wstr = "Schmidt decomposition not performed at call to {0}. Undefined behavior likely!".format (cstr)
         return warnings.warn (wstr, RuntimeWarning) if (not self.Schmidt_done) else None
@@ -958,16 +974,9 @@ class fragment_object:
             self.imp_solved   = False
             return
         if self.imp_solver_name == "RHF" and self.quasidirect:
-            ao2imp = np.dot (self.ints.ao2loc, self.loc2imp)
-            def my_jk (mol, dm, hermi=1):
-                dm_ao        = represent_operator_in_basis (dm, ao2imp.T)
-                vj_ao, vk_ao = self.ints.get_jk_ao (dm_ao, hermi)
-                vj_basis     = represent_operator_in_basis (vj_ao, ao2imp)
-                vk_basis     = represent_operator_in_basis (vk_ao, ao2imp)
-                return vj_basis, vk_basis
             self.impham_TEI = None 
             #self.impham_TEI_fiii = None # np.empty ([self.norbs_frag] + [self.norbs_imp for i in range (3)], dtype=np.float64)
-            self.impham_get_jk = my_jk
+            self.impham_get_jk = self.make_impham_get_jk ()
             vj, vk_c = self.impham_get_jk (self.ints.mol, self.get_oneRDM_imp ())
             vk_s = self.impham_get_jk (self.ints.mol, self.get_oneSDM_imp ())[1]
             cdm = self.get_oneRDM_imp ()
@@ -1005,15 +1014,13 @@ class fragment_object:
             self.impham_get_jk = None
             cdm = self.get_oneRDM_imp ()
             sdm = self.get_oneSDM_imp ()
-            eri = ao2mo.restore (1, self.impham_TEI, self.norbs_imp)
-            vj = np.tensordot (eri, cdm, axes=2)
-            vk_c = np.tensordot (eri, cdm, axes=((1,2),(0,1)))
-            vk_s = np.tensordot (eri, sdm, axes=((1,2),(0,1)))
+            vj, vk = dot_eri_dm (self.impham_TEI, [cdm, sdm], hermi=1)
+            vj, vk_c, vk_s = vj[0], vk[0], vk[1]
             sie = self.E2_cum
             sie += np.tensordot (vj, cdm) / 2
             sie -= np.tensordot (vk_c, cdm) / 4
             sie -= np.tensordot (vk_s, sdm) / 4
-            eri = cdm = sdm = None
+            cdm = sdm = None
 
         #OEI_C = self.ints.dmet_fock (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc)
         #OEI_S = -self.ints.dmet_k (self.loc2emb, self.norbs_imp, self.oneSDMfroz_loc) / 2
@@ -1038,6 +1045,16 @@ class fragment_object:
         print ("Time in impurity Hamiltonian constructor: {:.8f} wall, {:.8f} clock".format (time.time () - w0, time.process_time () - t0))
         sys.stdout.flush ()
 
+    def make_impham_get_jk (self):
+        ao2imp = np.dot (self.ints.ao2loc, self.loc2imp)
+        def my_jk (mol, dm, hermi=1):
+            dm_ao        = represent_operator_in_basis (dm, ao2imp.T)
+            vj_ao, vk_ao = self.ints.get_jk_ao (dm_ao, hermi)
+            vj_basis     = represent_operator_in_basis (vj_ao, ao2imp)
+            vk_basis     = represent_operator_in_basis (vk_ao, ao2imp)
+            return vj_basis, vk_basis
+        return my_jk
+
     def test_impurity_hamiltonian_energy (self):
         h = self.impham_OEI_C.copy ()
         dm = represent_operator_in_basis (self.oneRDM_loc, self.loc2imp)
@@ -1392,8 +1409,10 @@ class fragment_object:
         elif isinstance (self.twoCDM_imp, np.ndarray):
             L_iiif = np.tensordot (self.twoCDM_imp, self.imp2frag, axes=1)
             if isinstance (self.impham_TEI, np.ndarray):
-                V_iiif = ao2mo.restore (1, self.impham_TEI, self.norbs_imp)
-                V_iiif = np.tensordot (V_iiif, self.imp2frag, axes=1) 
+                imp2imp = np.eye (self.norbs_imp)
+                mo_coeffs = [imp2imp, imp2imp, imp2imp, self.imp2frag]
+                norbs = [self.norbs_imp, self.norbs_imp, self.norbs_imp, self.norbs_frag]
+                V_iiif = ao2mo.incore.general (self.impham_TEI, mo_coeffs, compact=False).reshape (*norbs)
                 E2 = 0.5 * np.tensordot (V_iiif, L_iiif, axes=4)
             elif isinstance (self.impham_CDERI, np.ndarray):
                 raise NotImplementedError ("No opportunity to test this yet.")
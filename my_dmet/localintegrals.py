@@ -18,7 +18,7 @@
 '''
 
 #import qcdmet_paths
-from pyscf import gto, scf, ao2mo, tools, lo
+from pyscf import gto, scf, ao2mo, tools, lo, lib
 from pyscf.lo import nao, orth, boys
 from pyscf.x2c import x2c
 from pyscf.tools import molden
@@ -41,7 +41,7 @@ from mrh.util.la import matrix_eigen_control_options, matrix_svd_control_options
 from mrh.util import params
 from math import sqrt
 import itertools
-import time, sys, gc
+import time, sys, tempfile
 from functools import reduce, partial
 
 LINEAR_DEP_THR = getattr(__config__, 'df_df_DF_lindep', 1e-12)
@@ -149,6 +149,15 @@ class localintegrals:
         self.nelec_idem     = self.nelec_tot
         self._eri           = None
         self.with_df        = None
+        # DF mode: build the (aux, loc, loc) three-center tensor once in a memory-mapped scratch file and project it
+        # onto each impurity basis in dmet_cderi. Impurity bases differing from a recent one by less than imp_cderi_tol
+        # reuse its cderi array. The cache holds at most imp_cderi_maxcache arrays and imp_cderi_max_memory MB
+        self.project_loc_cderi    = False
+        self.imp_cderi_tol        = 1e-10
+        self.imp_cderi_maxcache   = 16
+        self.imp_cderi_max_memory = self.max_memory / 4
+        self._loc_cderi           = None
+        self._imp_cderi_cache     = []
         assert (abs (np.trace (self.oneRDM_loc) - self.nelec_tot) < 1e-8), '{} {}'.format (np.trace (self.oneRDM_loc), self.nelec_tot)
         sys.stdout.flush ()
         def _is_mem_enough ():
@@ -491,6 +500,71 @@ class localintegrals:
         DMguess = 2 * np.dot( eigvecs[ :, :numPairs ], eigvecs[ :, :numPairs ].T )
         return DMguess
 
+    def get_loc_cderi (self):
+        ''' Three-center integrals in the localized basis, packed lower-triangular with shape
+        (naux, norbs_tot*(norbs_tot+1)//2), in a memory-mapped scratch file. Built on the first call with a single pass
+        over with_df. '''
+        assert (self.with_df is not None), "density fitting required"
+        if self._loc_cderi is not None: return self._loc_cderi
+        t0 = time.process_time ()
+        w0 = time.time ()     
+        norbs_aux = self.with_df.get_naoaux ()
+        nloc = self.norbs_tot
+        self._loc_cderi_file = tempfile.NamedTemporaryFile (dir=lib.param.TMPDIR)
+        cderi = np.memmap (self._loc_cderi_file, dtype=self.ao2loc.dtype, mode='w+', shape=(norbs_aux, nloc*(nloc+1)//2))
+        ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (self.ao2loc, self.ao2loc, compact=True)
+        b0 = 0
+        for eri1 in self.with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            cderi[b0:b1] = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym)
+            b0 = b1
+        cderi.flush ()
+        self._loc_cderi = cderi
+        print ("({0}, {1}) seconds to build {2:.0f}-MB localized-basis cderi array".format (
+            time.process_time () - t0, time.time () - w0, cderi.size * cderi.itemsize / 1e6))
+        return cderi
+
+    def _get_cached_imp_cderi (self, loc2imp):
+        for loc2imp_cache, cderi in self._imp_cderi_cache:
+            if loc2imp_cache.shape == loc2imp.shape and np.amax (np.abs (loc2imp_cache - loc2imp)) < self.imp_cderi_tol:
+                return cderi
+        return None
+
+    def cache_imp_cderi (self, loc2imp, cderi):
+        ''' Remember the impurity cderi array for the basis loc2imp, evicting the least recent ones beyond
+        imp_cderi_maxcache entries or imp_cderi_max_memory MB. Called in the parent process with the arrays returned by
+        worker processes (see dmet.run_fragments), since additions made in a worker are lost with it. '''
+        if self._get_cached_imp_cderi (loc2imp) is not None: return
+        if cderi.size * cderi.itemsize / 1e6 > self.imp_cderi_max_memory: return
+        cache = [(loc2imp.copy (), cderi)] + self._imp_cderi_cache
+        mem = np.cumsum ([c.size * c.itemsize / 1e6 for l, c in cache])
+        ncache = min (self.imp_cderi_maxcache, np.count_nonzero (mem <= self.imp_cderi_max_memory))
+        self._imp_cderi_cache = cache[:ncache]
+
+    def _project_loc_cderi (self, loc2imp):
+        cderi = self._get_cached_imp_cderi (loc2imp)
+        if cderi is not None:
+            print ("Reusing cached impurity cderi array")
+            return cderi
+        t0 = time.process_time ()
+        w0 = time.time ()     
+        loc_cderi = self.get_loc_cderi ()
+        norbs_aux, nloc = loc_cderi.shape[0], self.norbs_tot
+        nimp = loc2imp.shape[1]
+        CDERI = np.empty ((norbs_aux, nimp*(nimp+1)//2), dtype=loc2imp.dtype)
+        max_memory = max (1, self.max_memory - current_memory ()[0])
+        blksize = int (max (1, min (norbs_aux, max_memory*1e6/8/(nloc*(2*nloc+2*nimp)))))
+        for p0 in range (0, norbs_aux, blksize):
+            p1 = min (norbs_aux, p0+blksize)
+            eri1 = lib.unpack_tril (loc_cderi[p0:p1])
+            eri1 = np.dot (eri1.reshape (-1, nloc), loc2imp).reshape (p1-p0, nloc, nimp)
+            eri1 = np.dot (eri1.transpose (0,2,1).reshape (-1, nloc), loc2imp).reshape (p1-p0, nimp, nimp)
+            CDERI[p0:p1] = lib.pack_tril (eri1)
+        print ("({0}, {1}) seconds to project localized-basis cderi array onto impurity".format (
+            time.process_time () - t0, time.time () - w0))
+        self.cache_imp_cderi (loc2imp, CDERI)
+        return CDERI
+
     def dmet_cderi (self, loc2dmet, numAct=None):
 
         t0 = time.process_time ()
@@ -499,6 +573,7 @@ class localintegrals:
         numAct = loc2dmet.shape[1] if numAct==None else numAct
         loc2imp = loc2dmet[:,:numAct]
         assert (self.with_df is not None), "density fitting required"
+        if self.project_loc_cderi: return self._project_loc_cderi (loc2imp)
         npair = numAct*(numAct+1)//2
         CDERI = np.empty ((self.with_df.get_naoaux (), npair), dtype=loc2dmet.dtype)
         full_cderi_size = (norbs_aux * self.mol.nao_nr () * (self.mol.nao_nr () + 1) * CDERI.itemsize // 2) / 1e6
@@ -523,12 +598,34 @@ class localintegrals:
         return CDERI
 
     def dmet_tei (self, loc2dmet, numAct=None, symmetry=1):
+        ''' Impurity ERIs. They are only ever held in packed form here (8-fold for density fitting, 4-fold otherwise),
+        so asking for symmetry=8 or symmetry=4 never materializes the (numAct,)*4 array. '''
 
         numAct = loc2dmet.shape[1] if numAct==None else numAct
         loc2imp = loc2dmet[:,:numAct]
-        TEI = symmetrize_tensor (self.general_tei ([loc2imp for i in range(4)], compact=True))
+        if self.with_df is not None:
+            TEI = self._df_tei_s8 (loc2imp)
+        else:
+            TEI = self.general_tei ([loc2imp for i in range(4)], compact=True)
+            # (ij|kl) = (kl|ij), in place
+            TEI = lib.transpose_sum (TEI, inplace=True)
+            TEI *= 0.5
         return ao2mo.restore (symmetry, TEI, numAct)
 
+    def _df_tei_s8 (self, loc2imp):
+        ''' 8-fold-packed impurity ERIs from the impurity cderi array, built one block of pair rows at a time '''
+        cderi = self.dmet_cderi (loc2imp)
+        naux, npair = cderi.shape
+        TEI = np.empty (npair*(npair+1)//2, dtype=cderi.dtype)
+        max_memory = max (1, self.max_memory - current_memory ()[0])
+        blksize = int (max (1, min (npair, max_memory*1e6/8/npair/2)))
+        for p0 in range (0, npair, blksize):
+            p1 = min (npair, p0+blksize)
+            eri1 = np.dot (cderi[:,p0:p1].T, cderi[:,:p1])
+            tril = np.arange (p1)[None,:] <= np.arange (p0,p1)[:,None]
+            TEI[p0*(p0+1)//2:p1*(p1+1)//2] = eri1[tril]
+        return TEI
+
     def dmet_const (self, loc2dmet, norbs_imp, oneRDMfroz_loc, oneSDMfroz_loc):
         norbs_core = self.norbs_tot - norbs_imp
         if norbs_core == 0:
@@ -557,10 +654,10 @@ class localintegrals:
             TEI = ao2mo.incore.general(self._eri, a2b_list, compact=compact)
         else:
             a2b_list = [np.dot (self.ao2loc, l2b) for l2b in loc2bas_list]
-            TEI  = ao2mo.outcore.general_iofree(self.mol, a2b_list, compact=compact)
+            max_memory = max (1, self.max_memory - current_memory ()[0])
+            TEI  = ao2mo.outcore.general_iofree(self.mol, a2b_list, compact=compact, max_memory=max_memory)
 
         if not compact: TEI = TEI.reshape (*norbs)
-        gc.collect () # I guess the ao2mo module is messy because until I put this here I was randomly losing up to 3 GB for big stretches of a calculation
 
         return TEI
 
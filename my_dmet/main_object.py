@@ -27,9 +27,11 @@ from mrh.my_pyscf.mcscf import lasci
 import warnings
 import numpy as np
 from scipy import optimize, linalg
-import time, ctypes
+import time, ctypes, sys, os
+import h5py
+import multiprocessing
 #import tracemalloc
-from pyscf import scf, mcscf
+from pyscf import scf, mcscf, lib
 from pyscf.lo import orth, nao
 from pyscf.lib import logger as pyscf_logger
 from pyscf.gto import mole, same_mol
@@ -50,6 +52,33 @@ from mrh.my_dmet.debug import debug_ofc_oneRDM, debug_Etot, examine_ifrag_olap,
 from functools import reduce
 from itertools import combinations, product
 
+# Work shared with forked worker processes by dmet.run_fragments. Nothing here is pickled on the way in.
+_fragment_pool_work = {}
+
+def _fragment_pool_init (nthreads):
+    lib.num_threads (nthreads)
+
+def _fragment_pool_task (ifrag):
+    fragments, fn, args = [_fragment_pool_work[key] for key in ('fragments', 'fn', 'args')]
+    frag = fragments[ifrag]
+    fn (frag, *args)
+    sys.stdout.flush ()
+    if frag.mol_stdout is not None: frag.mol_stdout.flush ()
+    return frag.get_process_state ()
+
+def _frag_schmidt_impham (frag, oneRDM_loc, all_frags, loc2wmcs, doLASSCF):
+    print ("Entering Schmidt decomposition for {}".format (frag.frag_name))
+    t0 = time.time ()
+    frag.do_Schmidt (oneRDM_loc, all_frags, loc2wmcs, doLASSCF)
+    t1 = time.time ()
+    print ("Entering impurity Hamiltonian construction for {}".format (frag.frag_name))
+    frag.construct_impurity_hamiltonian ()
+    t2 = time.time ()
+    print ("Schmidt decomposition: {} seconds; impurity Hamiltonian construction: {} seconds".format (t1-t0, t2-t1))
+
+def _frag_solve (frag, chempot_frag):
+    frag.solve_impurity_problem (chempot_frag)
+
 class dmet:
 
     def __init__( self, theInts, fragments, calcname='DMET', isTranslationInvariant=False, SCmethod='BFGS', incl_bath_errvec=True, use_constrained_opt=False, 
@@ -58,7 +87,8 @@ class dmet:
                     print_rdm=True, debug_energy=False, debug_reloc=False, oldLASSCF=False,
                     nelec_int_thresh=1e-6, chempot_init=0.0, num_mf_stab_checks=0,
                     corrpot_maxiter=50, orb_maxiter=50, chempot_tol=1e-6, corrpot_mf_moldens=0, do_conv_molden=False,
-                    conv_tol_grad=1e-4 ):
+                    conv_tol_grad=1e-4, max_workers=1, checkpoint_compression=None, checkpoint_keep=None,
+                    project_loc_cderi=False ):
 
 
         if isTranslationInvariant:
@@ -100,12 +130,17 @@ class dmet:
         self.corrpot_mf_moldens       = corrpot_mf_moldens
         self.corrpot_mf_molden_cnt    = 0
         self.ints.num_mf_stab_checks  = num_mf_stab_checks
+        self.ints.project_loc_cderi   = project_loc_cderi
         if not self.ints.symmetry: enforce_symmetry = False
         self.enforce_symmetry         = enforce_symmetry
         self.lasci_log                = None
         self.oldLASSCF                = oldLASSCF
         self.do_conv_molden           = do_conv_molden
         self.conv_tol_grad            = conv_tol_grad
+        self.max_workers              = max_workers
+        self.checkpoint_compression   = checkpoint_compression
+        self.checkpoint_keep          = checkpoint_keep
+        self._chk_files               = set ()
 
         self.verbose = self.ints.mol.verbose
         for frag in self.fragments:
@@ -274,13 +309,46 @@ class dmet:
         H1col   = np.array( H1col,   dtype=ctypes.c_int )
         return ( H1start, H1row, H1col )
         
+    def run_fragments (self, fn, *args):
+        ''' Call fn (frag, *args) for every fragment. If self.max_workers > 1, the fragments are distributed among
+        that many forked worker processes, each with lib.num_threads () // max_workers threads, and the fragments'
+        new attributes are copied back in the original fragment order. fn must only modify the fragment it is given. '''
+        nworkers = min (self.max_workers, len (self.fragments))
+        if nworkers < 2:
+            for frag in self.fragments: fn (frag, *args)
+            return
+        for frag in self.fragments:
+            # Open log files here: each worker would otherwise truncate them on each call
+            if frag.mol_stdout is None and frag.mol_output is not None:
+                frag.mol_stdout = open (frag.mol_output, 'w')
+            if frag.mol_stdout is not None: frag.mol_stdout.flush ()
+        # Shared intermediates that would otherwise be rebuilt by every worker
+        if self.ints.project_loc_cderi and any ([f.project_cderi for f in self.fragments]):
+            self.ints.get_loc_cderi ()
+        sys.stdout.flush ()
+        nthreads = max (1, lib.num_threads () // nworkers)
+        _fragment_pool_work.update (fragments=self.fragments, fn=fn, args=args)
+        try:
+            ctx = multiprocessing.get_context ('fork')
+            with ctx.Pool (processes=nworkers, initializer=_fragment_pool_init, initargs=(nthreads,)) as pool:
+                states = pool.map (_fragment_pool_task, range (len (self.fragments)), chunksize=1)
+        finally:
+            _fragment_pool_work.clear ()
+        for frag, state in zip (self.fragments, states):
+            frag.set_process_state_ (state)
+        # Impurity cderi arrays projected in the workers are cached here so that the next workers inherit them
+        if self.ints.project_loc_cderi:
+            for frag in self.fragments:
+                if frag.project_cderi and frag.impham_built and isinstance (frag.impham_CDERI, np.ndarray):
+                    self.ints.cache_imp_cderi (frag.loc2emb[:,:frag.norbs_imp], frag.impham_CDERI)
+
     def doexact( self, chempot_frag=0.0 ):
         oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat ) 
         self.energy = 0.0												
         self.spin = 0.0
 
+        self.run_fragments (_frag_solve, chempot_frag)
         for frag in self.fragments:
-            frag.solve_impurity_problem (chempot_frag)
             self.energy += frag.E_frag
             self.spin += frag.S2_frag
 
@@ -564,7 +632,7 @@ class dmet:
             loc2wmas = np.concatenate ([frag.loc2amo for frag in self.fragments], axis=1)
             loc2wmcs = get_complementary_states (loc2wmas, symmetry=self.ints.loc2symm, enforce_symmetry=self.enforce_symmetry)
             self.refragmentation (loc2wmas, loc2wmcs, self.ints.oneRDM_loc)
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
         while (u_diff > convergence_threshold):
             u_diff, rdm = self.doselfconsistent_corrpot (rdm, [('corrpot', iteration)])
             iteration += 1 
@@ -674,7 +742,7 @@ class dmet:
         #itersnap.dump ('iter{}end.snpsht'.format (myiter))
 
         if not self.doLASSCF:
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
 
         return u_diff, rdm_new
 
@@ -704,15 +772,7 @@ class dmet:
         old_energy = self.energy
         self.energy = 0.0
         self.spin = 0.0
-        for frag in self.fragments:
-            print ("Entering Schmidt decomposition for {}".format (frag.frag_name))
-            t0 = time.time ()
-            frag.do_Schmidt (oneRDM_loc, self.fragments, loc2wmcs_old, self.doLASSCF)
-            t1 = time.time ()
-            print ("Entering impurity Hamiltonian construction for {}".format (frag.frag_name))
-            frag.construct_impurity_hamiltonian ()
-            t2 = time.time ()
-            print ("Schmidt decomposition: {} seconds; impurity Hamiltonian construction: {} seconds".format (t1-t0, t2-t1))
+        self.run_fragments (_frag_schmidt_impham, oneRDM_loc, self.fragments, loc2wmcs_old, self.doLASSCF)
         if self.examine_ifrag_olap:
             examine_ifrag_olap (self)
         if self.examine_wmcs:
@@ -740,7 +800,7 @@ class dmet:
             oneRDM_loc = sum ([f.oneRDMas_loc for f in self.fragments if f.norbs_as])
             oneRDM_loc += 2 * get_1RDM_from_OEI (self.ints.activeFOCK, self.ints.nelec_idem//2, subspace=loc2wmcs_new)
             e_tot, grads = self.refragmentation (loc2wmas_new, loc2wmcs_new, oneRDM_loc)
-            if self.verbose: self.save_checkpoint (self.calcname + '.chk.npy')
+            if self.verbose: self.save_checkpoint (self.calcname + '.chk.h5')
         try:
             orb_diff = measure_basis_olap (loc2wmas_new, loc2wmcs_old)[0] / max (1,loc2wmas_new.shape[1])
         except:
@@ -1226,29 +1286,94 @@ class dmet:
         return
 
     def save_checkpoint (self, fname):
-        ''' Data array structure: nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1, loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo of frag 2, ... '''
+        ''' Append the current iteration to the HDF5 checkpoint file fname. Layout:
+                iter/<n>/nao
+                iter/<n>/chempot
+                iter/<n>/mat                      (1RDM if doLASSCF else umat; AO basis)
+                iter/<n>/frag/<ifrag>/norbs_as
+                iter/<n>/frag/<ifrag>/ao2amo
+                iter/<n>/frag/<ifrag>/oneRDM_amo
+                iter/<n>/frag/<ifrag>/twoCDMimp_amo
+            and the attribute "last" of the root group is the index of the last complete iteration. The first call on a
+            given fname for this dmet object starts a new file, unless fname was loaded with load_checkpoint: a
+            restarted calculation continues the file it was restarted from, numbering its iterations on from the last
+            one there. If self.checkpoint_keep is not None, only that many of the most recent iterations are kept;
+            the file is created with a persistent free-space manager, so the space of the deleted ones is reused.
+            Large arrays are chunked and compressed according to self.checkpoint_compression (e.g., 'gzip'; None for
+            no compression). '''
         nao = self.ints.mol.nao_nr ()
         if self.doLASSCF:
-            chkdata = self.helper.construct1RDM_loc (self.doSCF, self.umat)
-            chkdata = represent_operator_in_basis (chkdata, self.ints.ao2loc.conjugate ().T).flatten (order='C')
+            mat = self.helper.construct1RDM_loc (self.doSCF, self.umat)
+            mat = represent_operator_in_basis (mat, self.ints.ao2loc.conjugate ().T)
         else:
-            chkdata = represent_operator_in_basis (self.umat, self.ints.ao2loc.conjugate ().T).flatten (order='C')
-        chkdata = np.append (np.asarray ([nao, self.chempot]), chkdata)
-        for f in self.fragments:
-            chkdata = np.append (chkdata, [f.norbs_as])
-            chkdata = np.append (chkdata, np.dot (self.ints.ao2loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, represent_operator_in_basis (f.oneRDM_loc, f.loc2amo).flatten (order='C'))
-            chkdata = np.append (chkdata, f.twoCDMimp_amo.flatten (order='C'))
-        np.save (fname, chkdata)
+            mat = represent_operator_in_basis (self.umat, self.ints.ao2loc.conjugate ().T)
+        opts = {}
+        if self.checkpoint_compression is not None:
+            opts = {'chunks': True, 'compression': self.checkpoint_compression}
+        chk_key = os.path.abspath (fname)
+        if chk_key in self._chk_files and h5py.is_hdf5 (fname): fopts = {'mode': 'a'}
+        else: fopts = {'mode': 'w', 'fs_strategy': 'fsm', 'fs_persist': True}
+        self._chk_files.add (chk_key)
+        with h5py.File (fname, **fopts) as fh5:
+            iteration = int (fh5.attrs['last']) + 1 if 'last' in fh5.attrs else 0
+            igrp = fh5.require_group ('iter')
+            # Left over by an interrupted call
+            if str (iteration) in igrp: del igrp[str (iteration)]
+            grp = igrp.create_group (str (iteration))
+            # Per iteration: a restart with prev_mol may change the basis
+            grp['nao'] = nao
+            grp['chempot'] = self.chempot
+            grp.create_dataset ('mat', data=mat, **opts)
+            for ifrag, f in enumerate (self.fragments):
+                fgrp = grp.create_group ('frag/{}'.format (ifrag))
+                fgrp.attrs['frag_name'] = f.frag_name
+                fgrp['norbs_as'] = f.norbs_as
+                if not f.norbs_as: continue
+                fgrp.create_dataset ('ao2amo', data=np.dot (self.ints.ao2loc, f.loc2amo), **opts)
+                fgrp.create_dataset ('oneRDM_amo', data=represent_operator_in_basis (f.oneRDM_loc, f.loc2amo), **opts)
+                fgrp.create_dataset ('twoCDMimp_amo', data=f.twoCDMimp_amo, **opts)
+            fh5.attrs['last'] = iteration
+            if self.checkpoint_keep is not None:
+                for key in list (igrp.keys ()):
+                    if int (key) <= iteration - self.checkpoint_keep: del igrp[key]
         return
 
-    def load_checkpoint (self, fname, prev_mol=None):
-        nelec_amo = sum ((f.active_space[0] for f in self.fragments if f.active_space is not None))
-        norbs_amo = sum ((f.active_space[1] for f in self.fragments if f.active_space is not None))
-        norbs_cmo = (self.ints.mol.nelectron - nelec_amo) // 2
-        norbs_omo = norbs_cmo + norbs_amo
-        chkdata = np.load (fname)
-        nao, self.chempot, chkdata = int (round (chkdata[0])), chkdata[1], chkdata[2:] 
+    def load_checkpoint (self, fname, prev_mol=None, iteration=None, frags=None):
+        ''' Load a checkpoint written by save_checkpoint (or, if fname is not an HDF5 file, by the older flat-.npy
+            version of save_checkpoint).
+
+            Kwargs:
+                prev_mol : gto.Mole
+                    Molecule of the checkpointed calculation if it differs in geometry or basis
+                iteration : int
+                    Which iteration to load; default is the last complete one
+                frags : list of int or str
+                    Indices or names of the fragments whose active orbitals and density matrices are to be loaded.
+                    The data of other fragments isn't read at all. Default is all fragments. '''
+        if not h5py.is_hdf5 (fname):
+            assert (iteration is None and frags is None), "Legacy .npy checkpoints can only be loaded whole"
+            return self._load_checkpoint_npy (fname, prev_mol=prev_mol)
+        self._chk_files.add (os.path.abspath (fname))
+        with h5py.File (fname, 'r') as fh5:
+            if iteration is None: iteration = fh5.attrs['last']
+            grp = fh5['iter/{}'.format (iteration)]
+            nao = int ((grp['nao'] if 'nao' in grp else fh5['nao'])[()])
+            self.chempot = grp['chempot'][()]
+            aoSloc, locSao = self._get_checkpoint_ovlp (nao, prev_mol)
+            self._load_checkpoint_mat (grp['mat'][()], aoSloc, prev_mol)
+            for ifrag, f in enumerate (self.fragments):
+                if self.doLASSCF: f.oneRDM_loc = self.ints.oneRDM_loc
+                if frags is not None and ifrag not in frags and f.frag_name not in frags: continue
+                fgrp = grp['frag/{}'.format (ifrag)]
+                namo = int (fgrp['norbs_as'][()])
+                print ("{} active orbitals reported in checkpoint file for fragment {}".format (namo, f.frag_name))
+                if namo > 0:
+                    self._load_checkpoint_frag (f, fgrp['ao2amo'][()], fgrp['oneRDM_amo'][()],
+                                                fgrp['twoCDMimp_amo'][()], locSao, prev_mol)
+
+        if self.doLASSCF: self.ints.setup_wm_core_scf (self.fragments, self.calcname)
+
+    def _get_checkpoint_ovlp (self, nao, prev_mol):
         print ("{} atomic orbital basis functions reported in checkpoint file, as opposed to {} in integral object".format (nao, self.ints.mol.nao_nr ()))
         assert (prev_mol is not None or nao == self.ints.mol.nao_nr ())
         locSao = np.dot (self.ints.ao_ovlp, self.ints.ao2loc).conjugate ().T
@@ -1262,8 +1387,9 @@ class dmet:
         else:
             aoSloc = np.dot (self.ints.ao_ovlp, self.ints.ao2loc)
             locSao = aoSloc.conjugate ().T
+        return aoSloc, locSao
 
-        mat, chkdata = chkdata[:nao**2].reshape (nao, nao, order='C'), chkdata[nao**2:]
+    def _load_checkpoint_mat (self, mat, aoSloc, prev_mol):
         mat = represent_operator_in_basis (mat, aoSloc)
         if self.doLASSCF:
             self.ints.oneRDM_loc = mat.copy ()
@@ -1273,35 +1399,49 @@ class dmet:
         else:
             self.umat = mat.copy ()
 
+    def _load_checkpoint_frag (self, f, ao2amo, oneRDM_amo, twoCDMimp_amo, locSao, prev_mol):
+        f.loc2amo = ao2amo
+        f.oneRDMas_loc = oneRDM_amo
+        print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
+            f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (f.oneRDMas_loc, fmt='{:6.3f}')))
+        f.twoCDMimp_amo = twoCDMimp_amo
+        if prev_mol and same_mol (prev_mol, self.ints.mol, cmp_basis=False): f.loc2amo = project_mo_nr2nr (prev_mol, f.loc2amo, self.ints.mol)
+        f.loc2amo = np.dot (locSao, f.loc2amo)
+        # Normalize
+        amo_norm = (f.loc2amo * f.loc2amo).sum (0)
+        f.loc2amo /= np.sqrt (amo_norm)[None,:]
+        # orthogonalize and natorbify
+        ovlp = np.dot (f.loc2amo.conjugate ().T, f.loc2amo)
+        print ("{} fragment amo overlap matrix (trace = {}):\n{}".format (
+            f.frag_name, np.trace (ovlp), prettyprint (ovlp, fmt='{:6.3f}')))
+        no_occ, no_evecs = matrix_eigen_control_options (f.oneRDMas_loc, b_matrix=ovlp, sort_vecs=-1)
+        f.loc2amo = f.loc2amo @ no_evecs
+        f.oneRDMas_loc = (no_occ[None,:] * f.loc2amo) @ f.loc2amo.conjugate ().T
+        f.twoCDMimp_amo = represent_operator_in_basis (f.twoCDMimp_amo, no_evecs)
+        print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
+            f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (represent_operator_in_basis (f.oneRDMas_loc, f.loc2amo), fmt='{:6.3f}')))
+
+        if np.amax (np.abs (f.twoCDMimp_amo)) > 1e-10:
+            tei = self.ints.dmet_tei (f.loc2amo)
+            f.E2_cum = np.tensordot (tei, f.twoCDMimp_amo, axes=4) / 2
+
+    def _load_checkpoint_npy (self, fname, prev_mol=None):
+        ''' Data array structure: nao_nr, chempot, 1RDM or umat, norbs_amo in frag 1, loc2amo of frag 1, oneRDM_amo of frag 1, twoCDMimp_amo of frag 1, norbs_amo of frag 2, ... '''
+        chkdata = np.load (fname)
+        nao, self.chempot, chkdata = int (round (chkdata[0])), chkdata[1], chkdata[2:] 
+        aoSloc, locSao = self._get_checkpoint_ovlp (nao, prev_mol)
+        mat, chkdata = chkdata[:nao**2].reshape (nao, nao, order='C'), chkdata[nao**2:]
+        self._load_checkpoint_mat (mat, aoSloc, prev_mol)
+
         for f in self.fragments:
             if self.doLASSCF: f.oneRDM_loc = self.ints.oneRDM_loc
             namo, chkdata = int (round (chkdata[0])), chkdata[1:]
             print ("{} active orbitals reported in checkpoint file for fragment {}".format (namo, f.frag_name))
             if namo > 0:
-                f.loc2amo,       chkdata = chkdata[:nao*namo].reshape (nao, namo, order='C'), chkdata[nao*namo:]
-                f.oneRDMas_loc,  chkdata = chkdata[:namo**2].reshape (namo, namo, order='C'), chkdata[namo**2:]
-                print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (f.oneRDMas_loc, fmt='{:6.3f}')))
-                f.twoCDMimp_amo, chkdata = chkdata[:namo**4].reshape (namo, namo, namo, namo, order='C'), chkdata[namo**4:]
-                if prev_mol and same_mol (prev_mol, self.ints.mol, cmp_basis=False): f.loc2amo = project_mo_nr2nr (prev_mol, f.loc2amo, self.ints.mol)
-                f.loc2amo = np.dot (locSao, f.loc2amo)
-                # Normalize
-                amo_norm = (f.loc2amo * f.loc2amo).sum (0)
-                f.loc2amo /= np.sqrt (amo_norm)[None,:]
-                # orthogonalize and natorbify
-                ovlp = np.dot (f.loc2amo.conjugate ().T, f.loc2amo)
-                print ("{} fragment amo overlap matrix (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (ovlp), prettyprint (ovlp, fmt='{:6.3f}')))
-                no_occ, no_evecs = matrix_eigen_control_options (f.oneRDMas_loc, b_matrix=ovlp, sort_vecs=-1)
-                f.loc2amo = f.loc2amo @ no_evecs
-                f.oneRDMas_loc = (no_occ[None,:] * f.loc2amo) @ f.loc2amo.conjugate ().T
-                f.twoCDMimp_amo = represent_operator_in_basis (f.twoCDMimp_amo, no_evecs)
-                print ("{} fragment oneRDM_amo (trace = {}):\n{}".format (
-                    f.frag_name, np.trace (f.oneRDMas_loc), prettyprint (represent_operator_in_basis (f.oneRDMas_loc, f.loc2amo), fmt='{:6.3f}')))
-               
-                if np.amax (np.abs (f.twoCDMimp_amo)) > 1e-10:
-                    tei = self.ints.dmet_tei (f.loc2amo)
-                    f.E2_cum = np.tensordot (tei, f.twoCDMimp_amo, axes=4) / 2
+                ao2amo,        chkdata = chkdata[:nao*namo].reshape (nao, namo, order='C'), chkdata[nao*namo:]
+                oneRDM_amo,    chkdata = chkdata[:namo**2].reshape (namo, namo, order='C'), chkdata[namo**2:]
+                twoCDMimp_amo, chkdata = chkdata[:namo**4].reshape (namo, namo, namo, namo, order='C'), chkdata[namo**4:]
+                self._load_checkpoint_frag (f, ao2amo, oneRDM_amo, twoCDMimp_amo, locSao, prev_mol)
         assert (chkdata.shape == tuple((0,))), chkdata.shape               
 
         if self.doLASSCF: self.ints.setup_wm_core_scf (self.fragments, self.calcname)
@@ -15,15 +15,18 @@ libcsf = load_library ('libcsf')
 # are internally ordered in the same way that PySCF orders CI addresses based on CI strings
 
 def check_csd_mask_size (norb, neleca, nelecb):
-    ''' Calculate the size of the mask index array to reorder a CI vector of (neleca, nelecb) electrons in norb orbitals
-    and assert that it's not too big for 32-bit integers '''
-    ndeta = special.binom (norb, neleca)
-    ndetb = special.binom (norb, nelecb)
+    ''' Calculate the size of the mask index array to reorder a CI vector of (neleca, nelecb) electrons in norb orbitals.
+    Its elements are stored as 32-bit integers if they fit and as 64-bit integers otherwise (see get_mask_dtype). '''
+    ndeta = special.comb (norb, neleca, exact=True)
+    ndetb = special.comb (norb, nelecb, exact=True)
     mask_size = ndeta * ndetb
-    mask_size_lim_gd = 2**32 / 1e9
-    assert (mask_size / 1e9 <= mask_size_lim_gd), '{:.2f} billion determinants; more than {:.2f} billion not supported'.format (mask_size / 1e9, mask_size_lim_gd)
     return mask_size
 
+def get_mask_dtype (nmax):
+    ''' Compact unsigned integer type for mask index arrays whose elements are all less than nmax '''
+    if nmax <= 2**32: return np.uint32
+    return np.uint64
+
 def make_csd_mask (norb, neleca, nelecb):
     ''' Get a mask index to reorder a (flattened) CI vector matrix in terms of
         (double_configuration, single_configuration, spin_configuration) 
@@ -31,9 +34,8 @@ def make_csd_mask (norb, neleca, nelecb):
     mask[idx_csd] = idx_dd '''
 
     t_start = logger.perf_counter ()
-    ndeta = int (special.comb (norb, neleca))
-    ndetb = int (special.comb (norb, nelecb))
-    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    ndet = check_csd_mask_size (norb, neleca, nelecb)
+    mask = np.empty (ndet, dtype=get_mask_dtype (ndet))
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
     pair_size = npair_dconf_size * npair_sconf_size * npair_spins_size
     for npair in range (min_npair, min (neleca, nelecb)+1):
@@ -46,19 +48,21 @@ def make_csd_mask (norb, neleca, nelecb):
 
 def make_econf_det_mask (norb, neleca, nelecb, csd_mask):
     ''' Get a mask index to identify the electron configuration (i.e., in csd order) of a given determinant pair address (in determinant-pair order) '''
-    ndeta = int (special.comb (norb, neleca))
-    ndetb = int (special.comb (norb, nelecb))
-    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    ndet = check_csd_mask_size (norb, neleca, nelecb)
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
     npair_conf_size = npair_dconf_size * npair_sconf_size
     npair_det_size = npair_conf_size * npair_spins_size
+    dtype = get_mask_dtype (np.sum (npair_conf_size))
+    mask = np.empty (ndet, dtype=dtype)
     iconf = 0
     for npair in range (min_npair, min (neleca, nelecb)+1):
         ipair = npair - min_npair
-        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=np.uint32)
+        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=dtype)
         iconf += npair_conf_size[ipair]
         mask[npair_offset[ipair]:][:npair_det_size[ipair]] = np.repeat (irange, npair_spins_size[ipair])
-    return mask[np.argsort (csd_mask)]
+    econf_det_mask = np.empty_like (mask)
+    econf_det_mask[csd_mask] = mask # = mask[np.argsort (csd_mask)]
+    return econf_det_mask
 
 def get_nspin_dets (norb, neleca, nelecb, nspin):
     ''' Grab all determinant pair addresses corresponding to nspin unpaired electrons, sorted by spin configuration
@@ -78,11 +82,22 @@ def get_nspin_dets (norb, neleca, nelecb, nspin):
     offset = npair_offset[npair-min_npair]
     conf_size = npair_dconf_size[npair-min_npair] * npair_sconf_size[npair-min_npair]
     spin_size = npair_spins_size[npair-min_npair]
-    t_ref = logger.perf_counter ()
-    ddaddrs = csdaddrs2ddaddrs (norb, neleca, nelecb, list (range (offset, offset+(conf_size*spin_size))))
-    t_sub = logger.perf_counter () - t_ref
-    ddaddrs = ddaddrs[0,:] * int (round (special.binom (norb, nelecb))) + ddaddrs[1,:]
-    ddaddrs = ddaddrs.reshape (conf_size, spin_size)
+    # The csd addresses of a given npair form a full (dconf, sconf, spins) product, so the
+    # determinant addresses are generated directly from the strings of each factor instead of
+    # decomposing every address (csdaddrs2ddaddrs gives the same result, much more slowly)
+    nup = (nspin + neleca - nelecb) // 2
+    dconf_strs = np.ascontiguousarray (cistring.make_strings (range (norb), npair), dtype=np.uint64)
+    sconf_strs = np.ascontiguousarray (cistring.make_strings (range (norb - npair), nspin),
+                                       dtype=np.uint64)
+    spins_strs = np.ascontiguousarray (cistring.make_strings (range (nspin), nup), dtype=np.uint64)
+    ddaddrs = np.empty ((conf_size, spin_size), dtype=np.int64)
+    libcsf.FCICSFcsd2ddaddrs (ddaddrs.ctypes.data_as (ctypes.c_void_p),
+                              dconf_strs.ctypes.data_as (ctypes.c_void_p),
+                              sconf_strs.ctypes.data_as (ctypes.c_void_p),
+                              spins_strs.ctypes.data_as (ctypes.c_void_p),
+                              ctypes.c_int (norb), ctypes.c_int64 (dconf_strs.size),
+                              ctypes.c_int64 (sconf_strs.size), ctypes.c_int64 (spins_strs.size),
+                              ctypes.c_int64 (cistring.num_strings (norb, nelecb)))
     t_tot = logger.perf_counter () - t_start
     return ddaddrs
 
@@ -131,7 +146,7 @@ def csdaddrs2ddaddrs (norb, neleca, nelecb, csdaddrs):
     t1 = logger.perf_counter ()
     ddstrs = csdstrs2ddstrs (norb, neleca, nelecb, csdstrs)
     t2 = logger.perf_counter ()
-    ddaddrs = np.ascontiguousarray ([cistring.strs2addr (norb, neleca, ddstrs[0]), cistring.strs2addr (norb, nelecb, ddstrs[1])], dtype=np.int32)
+    ddaddrs = np.ascontiguousarray ([cistring.strs2addr (norb, neleca, ddstrs[0]), cistring.strs2addr (norb, nelecb, ddstrs[1])], dtype=np.int64)
     t3 = logger.perf_counter ()
     t_tot = logger.perf_counter () - t_start
     return ddaddrs
@@ -141,7 +156,7 @@ def csdstrs2csdaddrs (norb, neleca, nelecb, csdstrs):
     assert (len (csdstrs[0]) == len (csdstrs[2]))
     assert (len (csdstrs[0]) == len (csdstrs[3]))
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
-    csdaddrs = np.empty (len (csdstrs[0]), dtype=np.int32)
+    csdaddrs = np.empty (len (csdstrs[0]), dtype=np.int64)
     for npair, offset, dconf_size, sconf_size, spins_size in zip (range (min_npair, min (neleca, nelecb)+1), 
             npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size):
         nspins = neleca + nelecb - 2*npair
@@ -157,7 +172,7 @@ def csdstrs2csdaddrs (norb, neleca, nelecb, csdstrs):
                                             + (sconf * spins_size)
                                             + spins for dconf, sconf, spins in zip (
                                             dconf_addr, sconf_addr, spins_addr)],
-                                            dtype=np.int32)
+                                            dtype=np.int64)
     return csdaddrs
 
 
@@ -252,13 +267,13 @@ def get_csdaddrs_shape (norb, neleca, nelecb):
     for nspin in nspins:
         assert ((nspin + neleca - nelecb) % 2 == 0)
 
-    npair_dconf_size = np.asarray ([int (round (special.binom (norb, npair))) for npair in range (min_npair, nless+1)], dtype=np.int32)
-    npair_sconf_size = np.asarray ([int (round (special.binom (nfreeorb, nspin))) for nfreeorb, nspin in zip (nfreeorbs, nspins)], dtype=np.int32)
-    npair_spins_size = np.asarray ([int (round (special.binom (nspin, na))) for nspin, na in zip (nspins, nas)], dtype=np.int32)
+    npair_dconf_size = np.asarray ([special.comb (norb, npair, exact=True) for npair in range (min_npair, nless+1)], dtype=np.int64)
+    npair_sconf_size = np.asarray ([special.comb (nfreeorb, nspin, exact=True) for nfreeorb, nspin in zip (nfreeorbs, nspins)], dtype=np.int64)
+    npair_spins_size = np.asarray ([special.comb (nspin, na, exact=True) for nspin, na in zip (nspins, nas)], dtype=np.int64)
 
-    npair_sizes = np.asarray ([0] + [i * j * k for i,j,k in zip (npair_dconf_size, npair_sconf_size, npair_spins_size)], dtype=np.int32)
-    npair_offset = np.asarray ([np.sum (npair_sizes[:i+1]) for i in range (len (npair_sizes))], dtype=np.int32)
-    assert (npair_offset[-1] == int (round (special.binom (norb, neleca) * special.binom (norb, nelecb)))), npair_offset
+    npair_sizes = np.asarray ([0] + [i * j * k for i,j,k in zip (npair_dconf_size, npair_sconf_size, npair_spins_size)], dtype=np.int64)
+    npair_offset = np.cumsum (npair_sizes)
+    assert (npair_offset[-1] == check_csd_mask_size (norb, neleca, nelecb)), npair_offset
 
     return min_npair, npair_offset[:-1], npair_dconf_size, npair_sconf_size, npair_spins_size
 
@@ -273,7 +288,7 @@ def ddstrs2csdstrs (norb, neleca, nelecb, ddstrs):
         ddstrs = np.ascontiguousarray (ddstrs)
     libcsf.FCICSFddstrs2csdstrs (csdstrs.ctypes.data_as (ctypes.c_void_p),
                                 ddstrs.ctypes.data_as (ctypes.c_void_p),
-                                ctypes.c_int (nstr),
+                                ctypes.c_int64 (nstr),
                                 ctypes.c_int (norb),
                                 ctypes.c_int (neleca), ctypes.c_int (nelecb))
     return csdstrs
@@ -288,7 +303,7 @@ def csdstrs2ddstrs (norb, neleca, nelecb, csdstrs):
         csdstrs = np.ravel (csdstrs)
     libcsf.FCICSFcsdstrs2ddstrs (ddstrs.ctypes.data_as (ctypes.c_void_p),
                                 csdstrs.ctypes.data_as (ctypes.c_void_p),
-                                ctypes.c_int (nstr),
+                                ctypes.c_int64 (nstr),
                                 ctypes.c_int (norb),
                                 ctypes.c_int (neleca), ctypes.c_int (nelecb))
     return ddstrs
@@ -352,7 +367,7 @@ def pretty_ddaddrs (norb, neleca, nelecb, ddaddrs):
 
 def format_ddaddrs (norb, neleca, nelecb, ddaddrs):
     ''' Represent as a 2darray with shape (2,*), given ddaddrs passed as 2darray with shape (*,2) or 1darray with shape (*) '''
-    ddaddrs = np.asarray (ddaddrs, dtype=np.int32) 
+    ddaddrs = np.asarray (ddaddrs, dtype=np.int64) 
     ndeta = int (round (special.binom (norb, neleca)))
     ndetb = int (round (special.binom (norb, nelecb))) 
     assert (len (ddaddrs.shape) < 3), ddaddrs.shape
@@ -365,7 +380,7 @@ def format_ddaddrs (norb, neleca, nelecb, ddaddrs):
             new_ddaddrs = np.ravel (ddaddrs, order=ravelorder).reshape (2, -1)
     else:
         assert (np.all (ddaddrs < ndeta*ndetb))
-        new_ddaddrs = np.empty ((2,len (ddaddrs)), dtype=np.int32)
+        new_ddaddrs = np.empty ((2,len (ddaddrs)), dtype=np.int64)
         new_ddaddrs[0,:] = ddaddrs // ndetb
         new_ddaddrs[1,:] = ddaddrs  % ndetb
     assert (new_ddaddrs.shape[0] == 2)
@@ -1,5 +1,6 @@
 import numpy as np
 import scipy
+import scipy.sparse
 import ctypes
 import time
 from pyscf import lib, ao2mo, __config__
@@ -10,6 +11,7 @@ from mrh.my_pyscf.fci.csdstring import get_csdaddrs_shape
 from mrh.my_pyscf.fci.csfstring import count_all_csfs, get_spin_evecs
 from mrh.my_pyscf.fci.csfstring import get_csfvec_shape
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
+from mrh.my_pyscf.fci.csfstring import transform_civec_det2csf, transform_civec_csf2det
 from mrh.lib.helper import load_library as mrh_load_library
 '''
     MRH 03/24/2019
@@ -65,8 +67,12 @@ def make_hdiag_det (fci, h1e, eri, norb, nelec):
     ''' Wrap to the uhf version in order to use two-component h1e '''
     return direct_uhf.make_hdiag (unpack_h1e_ab (h1e), [eri, eri, eri], norb, nelec)
 
-def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None):
+def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None, max_memory=None):
+    ''' Diagonal of the Hamiltonian in the CSF basis. The determinant-basis diagonal blocks of
+    the configurations are built and contracted with the spin eigenvectors a chunk of
+    configurations at a time, with the chunk size bounded by max_memory (in MB). '''
     smult = transformer.smult
+    if max_memory is None: max_memory = lib.param.MAX_MEMORY
     if hdiag_det is None:
         hdiag_det = make_hdiag_det (None, h1e, eri, norb, nelec)
     eri = ao2mo.restore(1, eri, norb)
@@ -92,7 +98,6 @@ def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None):
         nspin = neleca + nelecb - 2*npair
         csd_offset = npair_csd_offset[ipair]
         csf_offset = npair_csf_offset[ipair]
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
         det_addr = transformer.csd_mask[csd_offset:][:nconf*ndet]
         if ndet == 1:
             # Closed-shell singlets
@@ -100,32 +105,41 @@ def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None):
             hdiag_csf[csf_offset:][:nconf] = hdiag_det[det_addr.flat]
             hdiag_csf_check[csf_offset:][:nconf] = False
             continue
-        det_addra, det_addrb = divmod (det_addr, ndetb_all)
-        det_stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, det_addra).reshape (nconf, ndet, order='C'))
-        det_strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, det_addrb).reshape (nconf, ndet, order='C'))
         det_addr = det_addr.reshape (nconf, ndet, order='C')
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
-        hdiag_conf_det = np.ascontiguousarray (hdiag_det[det_addr], dtype=np.float64)
-        t1 = lib.logger.process_clock ()
-        w1 = lib.logger.perf_counter ()
-        libcsf.FCICSFhdiag (hdiag_conf.ctypes.data_as (ctypes.c_void_p),
-                            hdiag_conf_det.ctypes.data_as (ctypes.c_void_p),
-                            eri.ctypes.data_as (ctypes.c_void_p),
-                            det_stra.ctypes.data_as (ctypes.c_void_p),
-                            det_strb.ctypes.data_as (ctypes.c_void_p),
-                            ctypes.c_uint (norb), ctypes.c_uint (nconf), ctypes.c_uint (ndet))
-        tlib += lib.logger.process_clock () - t1
-        wlib += lib.logger.perf_counter () - w1
-        umat = get_spin_evecs (nspin, neleca, nelecb, smult)
-        hdiag_conf = np.tensordot (hdiag_conf, umat, axes=1)
-        hdiag_conf *= umat[np.newaxis,:,:]
-        hdiag_csf[csf_offset:][:nconf*ncsf] = hdiag_conf.sum (1).ravel (order='C')
+        umat = np.ascontiguousarray (get_spin_evecs (nspin, neleca, nelecb, smult))
+        hdiag_csf_ipair = hdiag_csf[csf_offset:][:nconf*ncsf].reshape (nconf, ncsf)
+        # Per configuration: the determinant-basis block and its product with umat
+        mem_conf = 8 * (ndet*ndet + ndet*ncsf) / 1e6
+        mem_remaining = max_memory - lib.current_memory ()[0]
+        nchunk = max (1, min (nconf, int (mem_remaining // mem_conf)))
+        hconf_buf = np.empty ((nchunk, ndet, ndet), dtype=np.float64)
+        hu_buf = np.empty ((nchunk, ndet, ncsf), dtype=np.float64)
+        for i in range (0, nconf, nchunk):
+            j = min (nconf, i+nchunk)
+            det_addra, det_addrb = divmod (det_addr[i:j], ndetb_all)
+            det_stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, det_addra.ravel ()))
+            det_strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, det_addrb.ravel ()))
+            hdiag_conf_det = np.ascontiguousarray (hdiag_det[det_addr[i:j]], dtype=np.float64)
+            hconf = hconf_buf[:j-i]
+            hconf[:] = 0.0
+            t1 = lib.logger.process_clock ()
+            w1 = lib.logger.perf_counter ()
+            libcsf.FCICSFhdiag (hconf.ctypes.data_as (ctypes.c_void_p),
+                                hdiag_conf_det.ctypes.data_as (ctypes.c_void_p),
+                                eri.ctypes.data_as (ctypes.c_void_p),
+                                det_stra.ctypes.data_as (ctypes.c_void_p),
+                                det_strb.ctypes.data_as (ctypes.c_void_p),
+                                ctypes.c_uint (norb), ctypes.c_uint64 (j-i), ctypes.c_uint (ndet))
+            tlib += lib.logger.process_clock () - t1
+            wlib += lib.logger.perf_counter () - w1
+            hu = np.matmul (hconf, umat, out=hu_buf[:j-i])
+            hu *= umat[np.newaxis,:,:]
+            hu.sum (1, out=hdiag_csf_ipair[i:j])
         hdiag_csf_check[csf_offset:][:nconf*ncsf] = False
     assert (np.count_nonzero (hdiag_csf_check) == 0), np.count_nonzero (hdiag_csf_check)
     #print ("Time in hdiag_csf library: {}, {}".format (tlib, wlib))
     return hdiag_csf
 
-
 def make_hdiag_csf_slower (h1e, eri, norb, nelec, transformer, hdiag_det=None):
     ''' This is tricky because I need the diagonal blocks for each configuration in order to get
     the correct csf hdiag values, not just the diagonal elements for each determinant. '''
@@ -225,16 +239,72 @@ def _debug_g2e (fci, g2e, eri, norb):
     raise ValueError ('g2e has {} infs and {} nans (norb = {}; shape = {})'.format (g2e_ninf, g2e_nnan, norb, g2e.shape))
     return
 
-def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=None, npsp=200):
-    ''' Note that getting pspace for npsp CSFs is substantially more costly than getting it for npsp determinants,
-    until I write code than can evaluate Hamiltonian matrix elements of CSFs directly. On the other hand
-    a pspace of determinants contains many redundant degrees of freedom for the same reason. Therefore I have
-    reduced the default pspace size by a factor of 2.'''
+def _conf_pair_blocks (h1e_a, h1e_b, g2e, bra_stra, bra_strb, ket_stra, ket_strb, umat_bra,
+                       umat_ket, hdiag_bra=None):
+    ''' CSF-basis Hamiltonian blocks between pairs of electron configurations
+
+    Args:
+        h1e_a, h1e_b, g2e: ndarrays
+            Spin-up and spin-down one-electron and unpacked two-electron integrals
+        bra_stra, bra_strb: ndarrays of shape (npair, ndet_bra)
+            Spin-up and spin-down strings of the determinants of the bra configuration
+            of each pair, in the row order of umat_bra
+        ket_stra, ket_strb: ndarrays of shape (npair, ndet_ket)
+            Same as bra_stra, bra_strb for the ket configurations
+        umat_bra, umat_ket: ndarrays of shape (ndet, ncsf)
+            Spin eigenvectors (see csfstring.get_spin_evecs) of the bra and ket configurations
+
+    Kwargs:
+        hdiag_bra: ndarray of shape (npair, ndet_bra)
+            Diagonal elements in the determinant basis, for pairs in which the bra and ket
+            configurations are the same. Otherwise, bra and ket configurations must differ.
+
+    Returns:
+        hblk: ndarray of shape (npair, ncsf_bra, ncsf_ket)
+    '''
+    npair, ndet_bra = bra_stra.shape
+    ndet_ket = ket_stra.shape[1]
+    hblk = np.zeros ((npair, ndet_bra, ndet_ket), dtype=np.float64)
+    libcsf.FCICSFhoffdiag_blocks (hblk.ctypes.data_as (ctypes.c_void_p),
+                                  h1e_a.ctypes.data_as (ctypes.c_void_p),
+                                  h1e_b.ctypes.data_as (ctypes.c_void_p),
+                                  g2e.ctypes.data_as (ctypes.c_void_p),
+                                  bra_stra.ctypes.data_as (ctypes.c_void_p),
+                                  bra_strb.ctypes.data_as (ctypes.c_void_p),
+                                  ket_stra.ctypes.data_as (ctypes.c_void_p),
+                                  ket_strb.ctypes.data_as (ctypes.c_void_p),
+                                  ctypes.c_uint (h1e_a.shape[0]), ctypes.c_uint64 (npair),
+                                  ctypes.c_uint (ndet_bra), ctypes.c_uint (ndet_ket))
+    if hdiag_bra is not None:
+        idx = np.arange (ndet_bra)
+        hblk[:,idx,idx] = hdiag_bra
+    return np.matmul (umat_bra.T, np.matmul (hblk, umat_ket))
+
+def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=None, npsp=200,
+            max_memory=None):
+    ''' Hamiltonian in the basis of the npsp CSFs with the lowest diagonal energies.
+
+    The matrix elements are evaluated directly between the selected CSFs, one pair of electron
+    configurations at a time: the Slater-Condon determinant-basis block between two
+    configurations is contracted with the spin eigenvectors (csfstring.get_spin_evecs) of the
+    two configurations, and pairs of configurations whose occupation numbers differ by more than
+    a double excitation are skipped. Neither the determinant-basis Hamiltonian of the whole
+    pspace nor any CSFs other than the selected ones are ever built, so the cost scales with the
+    number of connected configuration pairs and pspaces of several thousand CSFs are affordable.
+
+    Returns:
+        csf_addr: ndarray of shape (npsp,)
+            Sorted CSF addresses of the pspace
+        h0: ndarray of shape (npsp,npsp)
+            Hamiltonian in the pspace
+    '''
     if norb > 63:
         raise NotImplementedError('norb > 63')
+    if max_memory is None: max_memory = getattr (fci, 'max_memory', 2000)
 
     t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
     neleca, nelecb = _unpack_nelec(nelec)
+    smult = transformer.smult
     h1e = np.ascontiguousarray(h1e)
     eri = ao2mo.restore(1, eri, norb)
     nb = cistring.num_strings(norb, nelecb)
@@ -242,7 +312,7 @@ def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=N
         hdiag_det = fci.make_hdiag(h1e, eri, norb, nelec)
     if hdiag_csf is None:
         hdiag_csf = fci.make_hdiag_csf(h1e, eri, norb, nelec, hdiag_det=hdiag_det)
-    csf_addr = np.arange (hdiag_csf.size, dtype=np.int32)
+    csf_addr = np.arange (hdiag_csf.size, dtype=np.int64)
     if transformer.wfnsym is None:
         ncsf_sym = hdiag_csf.size
     else:
@@ -254,84 +324,280 @@ def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=N
             csf_addr = csf_addr[np.argpartition(hdiag_csf[csf_addr], npsp-1)[:npsp]]
         except AttributeError:
             csf_addr = csf_addr[np.argsort(hdiag_csf[csf_addr])[:npsp]]
+    csf_addr = np.sort (csf_addr)
+    npsp_csf = csf_addr.size
 
-    # To build 
-    econf_addr = np.unique (transformer.econf_csf_mask[csf_addr])
-    det_addr = np.concatenate ([np.nonzero (transformer.econf_det_mask == conf)[0]
-        for conf in econf_addr])
-    lib.logger.debug1 (fci, ("csf.pspace: Lowest-energy %s CSFs correspond to %s configurations"
-        " which are spanned by %s determinants"), npsp, econf_addr.size, det_addr.size)
-
-    addra, addrb = divmod(det_addr, nb)
-    stra = cistring.addrs2str(norb, neleca, addra)
-    strb = cistring.addrs2str(norb, nelecb, addrb)
-    npsp_det = len(det_addr)
-    h0 = np.zeros((npsp_det,npsp_det))
+    # Decompose the CSF addresses into (npair, configuration, spin coupling), and index the
+    # selected CSFs of each configuration by their position in h0 (-1 if not selected)
+    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = get_csdaddrs_shape (
+        norb, neleca, nelecb)
+    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    csf_ipair = np.searchsorted (npair_csf_offset, csf_addr, side='right') - 1
     h1e_ab = unpack_h1e_ab (h1e)
     h1e_a = np.ascontiguousarray(h1e_ab[0])
     h1e_b = np.ascontiguousarray(h1e_ab[1])
-    g2e = ao2mo.restore(1, eri, norb)
-    g2e_ab = g2e_bb = g2e_aa = g2e
+    g2e = np.ascontiguousarray (eri)
     _debug_g2e (fci, g2e, eri, norb) # Exploring g2e nan bug; remove later?
+    blocks = []
+    for ipair in np.unique (csf_ipair):
+        npair = min_npair + ipair
+        ncsf = npair_csf_size[ipair]
+        ndet = npair_sdet_size[ipair]
+        sel = np.where (csf_ipair == ipair)[0]
+        iconf, icsf = divmod (csf_addr[sel] - npair_csf_offset[ipair], ncsf)
+        confs, iconf = np.unique (iconf, return_inverse=True)
+        pos = -np.ones ((confs.size, ncsf), dtype=np.int64)
+        pos[iconf,icsf] = sel
+        nconf = npair_dconf_size[ipair] * npair_sconf_size[ipair]
+        det_addr = transformer.csd_mask[npair_csd_offset[ipair]:][:nconf*ndet]
+        det_addr = det_addr.reshape (nconf, ndet)[confs]
+        addra, addrb = divmod (det_addr, nb)
+        stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, addra.ravel ()),
+                                     dtype=np.uint64).reshape (addra.shape)
+        strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, addrb.ravel ()),
+                                     dtype=np.uint64).reshape (addrb.shape)
+        bits = np.left_shift (1, np.arange (norb, dtype=np.uint64)).astype (np.uint64)
+        occ = ((stra[:,0,None] & bits) > 0).astype (np.int8)
+        occ += ((strb[:,0,None] & bits) > 0).astype (np.int8)
+        nspin = neleca + nelecb - 2*npair
+        umat = np.ascontiguousarray (get_spin_evecs (nspin, neleca, nelecb, smult))
+        blocks.append ((ndet, pos, stra, strb, occ, umat, hdiag_det[det_addr]))
+    lib.logger.debug1 (fci, "csf.pspace: Lowest-energy %s CSFs correspond to %s configurations",
+                       npsp_csf, sum ([b[1].shape[0] for b in blocks]))
     t0 = lib.logger.timer_debug1 (fci, "csf.pspace: index manipulation", *t0)
-    libfci.FCIpspace_h0tril_uhf(h0.ctypes.data_as(ctypes.c_void_p),
-                                h1e_a.ctypes.data_as(ctypes.c_void_p),
-                                h1e_b.ctypes.data_as(ctypes.c_void_p),
-                                g2e_aa.ctypes.data_as(ctypes.c_void_p),
-                                g2e_ab.ctypes.data_as(ctypes.c_void_p),
-                                g2e_bb.ctypes.data_as(ctypes.c_void_p),
-                                stra.ctypes.data_as(ctypes.c_void_p),
-                                strb.ctypes.data_as(ctypes.c_void_p),
-                                ctypes.c_int(norb), ctypes.c_int(npsp_det))
-    t0 = lib.logger.timer_debug1 (fci, "csf.pspace: pspace Hamiltonian in determinant basis", *t0)
-
-    for i in range(npsp_det):
-        h0[i,i] = hdiag_det[det_addr[i]]
-    h0 = lib.hermi_triu(h0)
-
-    try:
-        if fci.verbose >= lib.logger.DEBUG: evals_before = scipy.linalg.eigh (h0)[0]
-    except ValueError as e:
-        lib.logger.debug1 (fci, ("ERROR: h0 has {} infs, {} nans; h1e_a has {} infs, {} nans; "
-            "h1e_b has {} infs, {} nans; g2e has {} infs, {} nans, norb = {}, npsp_det = {}").format (
-            np.count_nonzero (np.isinf (h0)), np.count_nonzero (np.isnan (h0)),
-            np.count_nonzero (np.isinf (h1e_a)), np.count_nonzero (np.isnan (h1e_a)),
-            np.count_nonzero (np.isinf (h1e_b)), np.count_nonzero (np.isnan (h1e_b)),
-            np.count_nonzero (np.isinf (g2e)), np.count_nonzero (np.isnan (g2e)),
-            norb, npsp_det))
-        evals_before = np.zeros (npsp_det)
-
-    h0, csf_addr = transformer.mat_det2csf_confspace (h0, econf_addr)
-    t0 = lib.logger.timer_debug1 (fci, "csf.pspace: transform pspace Hamiltonian into CSF basis", *t0)
-
-    if fci.verbose > lib.logger.DEBUG:
-        lib.logger.debug1 (fci, "csf.pspace: eigenvalues of h0 before transformation %s", evals_before)
-        evals_after = scipy.linalg.eigh (h0)[0]
-        lib.logger.debug1 (fci, "csf.pspace: eigenvalues of h0 after transformation %s", evals_after)
-        idx = [np.argmin (np.abs (evals_before - ev)) for ev in evals_after]
-        resid = evals_after - evals_before[idx]
-        lib.logger.debug1 (fci, "csf.pspace: best h0 eigenvalue matching differences after transformation: %s", resid)
-        lib.logger.debug1 (fci, "csf.pspace: if the transformation of h0 worked the following number will be zero: %s", np.max (np.abs(resid)))
-
-    # We got extra CSFs from building the configurations most of the time.
-    if csf_addr.size > npsp:
-        try:
-            csf_addr_2 = np.argpartition(np.diag (h0), npsp-1)[:npsp]
-        except AttributeError:
-            csf_addr_2 = np.argsort(np.diag (h0))[:npsp]
-        csf_addr = csf_addr[csf_addr_2]
-        h0 = h0[np.ix_(csf_addr_2,csf_addr_2)]
-    npsp_csf = csf_addr.size
-    lib.logger.debug1 (fci, "csf_solver.pspace: asked for %s-CSF pspace; found %s CSFs", npsp, npsp_csf)
 
-    t0 = lib.logger.timer_debug1 (fci, "csf.pspace wrapup", *t0)
+    h0 = np.zeros ((npsp_csf, npsp_csf), dtype=np.float64)
+    for ibra, (ndet_bra, pos_bra, stra_bra, strb_bra, occ_bra, umat_bra, hdiag_bra) in enumerate (blocks):
+        for (ndet_ket, pos_ket, stra_ket, strb_ket, occ_ket, umat_ket, _) in blocks[ibra:]:
+            # Configurations that differ by more than a double excitation don't interact
+            diff = np.abs (occ_bra[:,None,:] - occ_ket[None,:,:]).sum (2)
+            if pos_bra is pos_ket: diff[np.tril_indices (diff.shape[0])] = 99
+            idx_bra, idx_ket = np.nonzero (diff <= 4)
+            if pos_bra is pos_ket:
+                idx_bra = np.append (np.arange (pos_bra.shape[0]), idx_bra)
+                idx_ket = np.append (np.arange (pos_bra.shape[0]), idx_ket)
+            if idx_bra.size == 0: continue
+            mem_pair = 2 * 8 * ndet_bra * ndet_ket / 1e6
+            mem_remaining = max_memory - lib.current_memory ()[0]
+            nchunk = max (1, int (mem_remaining // mem_pair))
+            for i in range (0, idx_bra.size, nchunk):
+                ib, ik = idx_bra[i:i+nchunk], idx_ket[i:i+nchunk]
+                hdiag = None
+                if pos_bra is pos_ket:
+                    ndiag = max (0, min (pos_bra.shape[0] - i, ib.size))
+                    if ndiag > 0:
+                        hblk = _conf_pair_blocks (h1e_a, h1e_b, g2e, stra_bra[ib[:ndiag]],
+                                                  strb_bra[ib[:ndiag]], stra_ket[ik[:ndiag]],
+                                                  strb_ket[ik[:ndiag]], umat_bra, umat_ket,
+                                                  hdiag_bra=hdiag_bra[ib[:ndiag]])
+                        _scatter_pspace_blocks (h0, hblk, pos_bra[ib[:ndiag]], pos_ket[ik[:ndiag]])
+                    ib, ik = ib[ndiag:], ik[ndiag:]
+                if ib.size == 0: continue
+                hblk = _conf_pair_blocks (h1e_a, h1e_b, g2e, stra_bra[ib], strb_bra[ib],
+                                          stra_ket[ik], strb_ket[ik], umat_bra, umat_ket)
+                _scatter_pspace_blocks (h0, hblk, pos_bra[ib], pos_ket[ik])
+    t0 = lib.logger.timer_debug1 (fci, "csf.pspace: pspace Hamiltonian in CSF basis", *t0)
+    lib.logger.debug1 (fci, "csf_solver.pspace: asked for %s-CSF pspace; found %s CSFs", npsp, npsp_csf)
     return csf_addr, h0
 
+def _scatter_pspace_blocks (h0, hblk, pos_bra, pos_ket):
+    ''' Copy the elements of configuration-pair blocks hblk between selected CSFs into the
+    pspace Hamiltonian h0 (and its transpose) '''
+    npair, ncsf_bra, ncsf_ket = hblk.shape
+    rows = np.broadcast_to (pos_bra[:,:,None], hblk.shape)
+    cols = np.broadcast_to (pos_ket[:,None,:], hblk.shape)
+    idx = (rows >= 0) & (cols >= 0)
+    rows, cols, hblk = rows[idx], cols[idx], hblk[idx]
+    h0[rows,cols] = hblk
+    h0[cols,rows] = hblk
+
+def _get_conf_blocks (norb, neleca, nelecb, smult, csd_mask):
+    ''' Determinant strings, occupation strings and spin-coupling matrices of all electron
+    configurations, grouped by their number of doubly-occupied orbitals
+
+    Returns:
+        blocks: list of tuples
+            (csf_offset, ncsf, stra, strb, socc, docc, umat) for each number of doubly-occupied
+            orbitals with at least one CSF. stra, strb are ndarrays of shape (nconf, ndet), and
+            socc, docc of shape (nconf,) are the strings of the occupied and doubly-occupied
+            orbitals of each configuration.
+    '''
+    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = get_csdaddrs_shape (
+        norb, neleca, nelecb)
+    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    nb = cistring.num_strings (norb, nelecb)
+    blocks = []
+    for ipair, ncsf in enumerate (npair_csf_size):
+        nconf = npair_dconf_size[ipair] * npair_sconf_size[ipair]
+        ndet = npair_sdet_size[ipair]
+        if ncsf == 0 or nconf == 0: continue
+        det_addr = csd_mask[npair_csd_offset[ipair]:][:nconf*ndet]
+        addra, addrb = divmod (det_addr, nb)
+        stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, addra),
+                                     dtype=np.uint64).reshape (nconf, ndet)
+        strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, addrb),
+                                     dtype=np.uint64).reshape (nconf, ndet)
+        socc = np.ascontiguousarray (stra[:,0] | strb[:,0])
+        docc = np.ascontiguousarray (stra[:,0] & strb[:,0])
+        nspin = neleca + nelecb - 2*(min_npair + ipair)
+        umat = np.ascontiguousarray (get_spin_evecs (nspin, neleca, nelecb, smult))
+        blocks.append ((npair_csf_offset[ipair], ncsf, stra, strb, socc, docc, umat))
+    return blocks
+
+def _conf_pairs (bra_socc, bra_docc, ket_socc, ket_docc, triu=False):
+    ''' Indices of the pairs of bra and ket configurations which differ by at most a double
+    excitation (i.e., the sum over orbitals of the absolute difference of their occupation numbers
+    is at most 4), sorted by bra. If triu, only pairs with ket index >= bra index. '''
+    nbra, nket = bra_socc.size, ket_socc.size
+    counts = np.empty (nbra, dtype=np.int64)
+    args = [bra_socc.ctypes.data_as (ctypes.c_void_p), bra_docc.ctypes.data_as (ctypes.c_void_p),
+            ket_socc.ctypes.data_as (ctypes.c_void_p), ket_docc.ctypes.data_as (ctypes.c_void_p),
+            ctypes.c_int64 (nbra), ctypes.c_int64 (nket), ctypes.c_int (int (triu))]
+    libcsf.FCICSFconf_pair_counts (counts.ctypes.data_as (ctypes.c_void_p), *args)
+    offsets = np.zeros (nbra+1, dtype=np.int64)
+    offsets[1:] = np.cumsum (counts)
+    idx_ket = np.empty (offsets[-1], dtype=np.int64)
+    libcsf.FCICSFconf_pair_list (idx_ket.ctypes.data_as (ctypes.c_void_p),
+                                 offsets.ctypes.data_as (ctypes.c_void_p), *args)
+    idx_bra = np.repeat (np.arange (nbra, dtype=np.int64), counts)
+    return idx_bra, idx_ket
+
+def _hdiag_dets (h1e_a, h1e_b, g2e, stra, strb):
+    ''' Determinant-basis diagonal Hamiltonian elements of the determinants with strings stra,
+    strb (any shape) '''
+    hdiag = np.empty (stra.shape, dtype=np.float64)
+    libcsf.FCICSFhdiag_dets (hdiag.ctypes.data_as (ctypes.c_void_p),
+                             h1e_a.ctypes.data_as (ctypes.c_void_p),
+                             h1e_b.ctypes.data_as (ctypes.c_void_p),
+                             g2e.ctypes.data_as (ctypes.c_void_p),
+                             stra.ctypes.data_as (ctypes.c_void_p),
+                             strb.ctypes.data_as (ctypes.c_void_p),
+                             ctypes.c_uint (h1e_a.shape[0]), ctypes.c_uint64 (stra.size))
+    return hdiag
+
+def make_hcsf_conf (fci, h2e, norb, nelec, transformer, max_memory=None):
+    ''' The Hamiltonian in the basis of all CSFs, as a sparse matrix built directly from the
+    blocks between pairs of electron configurations which differ by at most a double excitation
+    (see csf.pspace), without ever expanding a vector in the determinant basis. Used by
+    kernel in place of contract_2e if fci.sigma_backend == 'conf'.
+
+    Args:
+        fci: instance of :class:`FCISolver`
+            Only used for logging
+        h2e: ndarray
+            Two-electron integrals with the one-electron part absorbed, as passed to contract_2e.
+            If it is tagged with h1e_s, that is included as in FCISolver.contract_2e.
+        norb: integer
+        nelec: integer or tuple of length 2
+        transformer: instance of :class:`CSFTransformer`
+
+    Kwargs:
+        max_memory: float
+            In MB. Defaults to lib.param.MAX_MEMORY.
+
+    Returns:
+        hcsf: scipy.sparse.csr_matrix of shape (ncsf, ncsf) or None
+            The upper triangle of the CSF-basis Hamiltonian with its diagonal blocks halved, so
+            that H|c> = hcsf @ c + hcsf.T @ c. None if it would not fit in max_memory.
+    '''
+    if max_memory is None: max_memory = lib.param.MAX_MEMORY
+    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    neleca, nelecb = _unpack_nelec (nelec)
+    smult = transformer.smult
+    ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
+    # sum_pqrs g_pqrs E_pq E_rs = sum_pq (sum_r g_prrq) E_pq + 1/2 sum_pqrs 2 g_pqrs p'r's q
+    g2e = ao2mo.restore (1, np.asarray (h2e), norb)
+    h1e = np.einsum ('prrq->pq', g2e)
+    g2e = np.ascontiguousarray (2 * g2e)
+    h1e_s = getattr (h2e, 'h1e_s', None)
+    if h1e_s is None: h1e_s = 0
+    h1e_a = np.ascontiguousarray (h1e + h1e_s)
+    h1e_b = np.ascontiguousarray (h1e - h1e_s)
+    blocks = _get_conf_blocks (norb, neleca, nelecb, smult, transformer.csd_mask)
+
+    # Screen configuration pairs and count nonzero elements
+    pairs = []
+    nnz = 0
+    for ibra, (_, ncsf_bra, _, _, socc_bra, docc_bra, _) in enumerate (blocks):
+        for iket, (_, ncsf_ket, _, _, socc_ket, docc_ket, _) in enumerate (blocks[ibra:], ibra):
+            idx_bra, idx_ket = _conf_pairs (socc_bra, docc_bra, socc_ket, docc_ket,
+                                            triu=(ibra==iket))
+            if idx_bra.size == 0: continue
+            pairs.append ((ibra, iket, idx_bra, idx_ket))
+            nnz += idx_bra.size * ncsf_bra * ncsf_ket
+    mem_nnz = nnz * 36 / 1e6 # COO indices and values, plus their CSR copy
+    mem_remaining = max_memory - lib.current_memory ()[0]
+    lib.logger.debug1 (fci, "csf.make_hcsf_conf: %d nonzero elements among %d CSFs (%.1f MB)",
+                       nnz, ncsf_all, mem_nnz)
+    if mem_nnz > mem_remaining:
+        lib.logger.warn (fci, ("csf.make_hcsf_conf: CSF-basis Hamiltonian needs %.1f MB; only "
+                               "%.1f MB available"), mem_nnz, mem_remaining)
+        return None
+    t0 = lib.logger.timer_debug1 (fci, "csf.make_hcsf_conf: screening configuration pairs", *t0)
+
+    rows = np.empty (nnz, dtype=np.int64)
+    cols = np.empty (nnz, dtype=np.int64)
+    vals = np.empty (nnz, dtype=np.float64)
+    i0 = 0
+    for ibra, iket, idx_bra, idx_ket in pairs:
+        offs_bra, ncsf_bra, stra_bra, strb_bra, _, _, umat_bra = blocks[ibra]
+        offs_ket, ncsf_ket, stra_ket, strb_ket, _, _, umat_ket = blocks[iket]
+        ndet_bra, ndet_ket = stra_bra.shape[1], stra_ket.shape[1]
+        mem_pair = 8 * (2 * ndet_bra * ndet_ket + ncsf_bra * ndet_ket) / 1e6
+        mem_remaining = max_memory - lib.current_memory ()[0]
+        nchunk = max (1, int (mem_remaining // (2*mem_pair)))
+        for i in range (0, idx_bra.size, nchunk):
+            ib, ik = idx_bra[i:i+nchunk], idx_ket[i:i+nchunk]
+            hdiag = None
+            if ibra == iket:
+                # Diagonal blocks come first in each bra configuration's list, so treat the pairs
+                # of identical configurations separately and halve them
+                diag = ib == ik
+                hblk = np.empty ((ib.size, ncsf_bra, ncsf_ket), dtype=np.float64)
+                if np.any (diag):
+                    hdiag = _hdiag_dets (h1e_a, h1e_b, g2e, stra_bra[ib[diag]], strb_bra[ib[diag]])
+                    hblk[diag] = 0.5 * _conf_pair_blocks (h1e_a, h1e_b, g2e, stra_bra[ib[diag]],
+                                                          strb_bra[ib[diag]], stra_ket[ik[diag]],
+                                                          strb_ket[ik[diag]], umat_bra, umat_ket,
+                                                          hdiag_bra=hdiag)
+                offd = ~diag
+                if np.any (offd):
+                    hblk[offd] = _conf_pair_blocks (h1e_a, h1e_b, g2e, stra_bra[ib[offd]],
+                                                    strb_bra[ib[offd]], stra_ket[ik[offd]],
+                                                    strb_ket[ik[offd]], umat_bra, umat_ket)
+            else:
+                hblk = _conf_pair_blocks (h1e_a, h1e_b, g2e, stra_bra[ib], strb_bra[ib],
+                                          stra_ket[ik], strb_ket[ik], umat_bra, umat_ket)
+            i1 = i0 + hblk.size
+            r = offs_bra + ib[:,None]*ncsf_bra + np.arange (ncsf_bra)[None,:]
+            c = offs_ket + ik[:,None]*ncsf_ket + np.arange (ncsf_ket)[None,:]
+            rows[i0:i1] = np.broadcast_to (r[:,:,None], hblk.shape).ravel ()
+            cols[i0:i1] = np.broadcast_to (c[:,None,:], hblk.shape).ravel ()
+            vals[i0:i1] = hblk.ravel ()
+            i0 = i1
+    assert (i0 == nnz)
+    hcsf = scipy.sparse.csr_matrix ((vals, (rows, cols)), shape=(ncsf_all, ncsf_all))
+    lib.logger.timer_debug1 (fci, "csf.make_hcsf_conf: configuration-pair blocks", *t0)
+    return hcsf
+
 def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
            tol=None, lindep=None, max_cycle=None, max_space=None,
            nroots=None, davidson_only=None, pspace_size=None, max_memory=None,
-           orbsym=None, wfnsym=None, ecore=0, transformer=None, **kwargs):
+           orbsym=None, wfnsym=None, ecore=0, transformer=None, prep=None, **kwargs):
+    ''' Kwargs:
+        prep: dict or None
+            Cache of the Hamiltonian-dependent preparations (diagonal elements, pspace and its
+            eigendecomposition, absorbed h2e, link indices and, if fci.sigma_backend == 'conf',
+            the sparse CSF-basis Hamiltonian or, for csf_symm, the irrep-blocked determinant
+            space). Missing entries are computed and
+            stored in it, existing entries are reused. Pass the same dict to several calls only
+            if they share h1e, eri, norb, nelec, smult and orbsym (see H1EZipFCISolver.kernel
+            in mrh.my_pyscf.mcscf.addons). Calls for different irreps (wfnsym) may share it:
+            every entry which depends on the irrep must be keyed by it, like the pspace and
+            the sliced CSF-basis Hamiltonian (by idx_sym) and the irrep-blocked space.
+    '''
     t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    if prep is None: prep = {}
     if 'verbose' in kwargs:
         verbose = kwargs['verbose']
         kwargs.pop ('verbose')
@@ -345,9 +611,13 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     nelec = _unpack_nelec(nelec, fci.spin)
     neleca, nelecb = nelec
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: throat-clearing", *t0)
-    hdiag_det = fci.make_hdiag (h1e, eri, norb, nelec)
+    if 'hdiag_det' not in prep:
+        prep['hdiag_det'] = fci.make_hdiag (h1e, eri, norb, nelec)
+    hdiag_det = prep['hdiag_det']
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: hdiag_det", *t0)
-    hdiag_csf = fci.make_hdiag_csf (h1e, eri, norb, nelec, hdiag_det=hdiag_det)
+    if 'hdiag_csf' not in prep:
+        prep['hdiag_csf'] = fci.make_hdiag_csf (h1e, eri, norb, nelec, hdiag_det=hdiag_det)
+    hdiag_csf = prep['hdiag_csf']
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: hdiag_csf", *t0)
     ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
     if idx_sym is None:
@@ -357,20 +627,36 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     nroots = min(ncsf_sym, nroots)
     if nroots is not None:
         assert (ncsf_sym >= nroots), "Can't find {} roots among only {} CSFs".format (nroots, ncsf_sym)
-    link_indexa, link_indexb = _unpack(norb, nelec, None)
+    if 'link_index' not in prep:
+        prep['link_index'] = _unpack(norb, nelec, None)
+    link_indexa, link_indexb = prep['link_index']
     na = link_indexa.shape[0]
     nb = link_indexb.shape[0]
 
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: throat-clearing", *t0)
-    addr, h0 = fci.pspace(h1e, eri, norb, nelec, idx_sym=idx_sym, hdiag_det=hdiag_det, hdiag_csf=hdiag_csf, npsp=max(pspace_size,nroots))
-    lib.logger.debug1 (fci, 'csf.kernel: error of hdiag_csf: %s', np.amax (np.abs (hdiag_csf[addr]-np.diag (h0))))
-    t0 = lib.logger.timer_debug1 (fci, "csf.kernel: make pspace", *t0)
-    if pspace_size > 0:
-        pw, pv = fci.eig (h0)
-    else:
-        pw = pv = None
+    npsp = max(pspace_size,nroots)
+    psp_key = ('pspace', npsp, None if idx_sym is None else np.packbits (idx_sym).tobytes ())
+    if psp_key not in prep:
+        addr, h0 = fci.pspace(h1e, eri, norb, nelec, idx_sym=idx_sym, hdiag_det=hdiag_det, hdiag_csf=hdiag_csf, npsp=npsp)
+        lib.logger.debug1 (fci, 'csf.kernel: error of hdiag_csf: %s', np.amax (np.abs (hdiag_csf[addr]-np.diag (h0))))
+        t0 = lib.logger.timer_debug1 (fci, "csf.kernel: make pspace", *t0)
+        if pspace_size > 0:
+            pw, pv = fci.eig (h0)
+        else:
+            pw = pv = None
+        prep[psp_key] = addr, h0, pw, pv
+    addr, h0, pw, pv = prep[psp_key]
 
-    if pspace_size >= ncsf_sym and not davidson_only:
+    if pspace_size >= ncsf_sym and not davidson_only and fci.ci_basis == 'csf':
+        if ncsf_sym == 1 or nroots == 1 and abs(pw[0]-pw[1]) > 1e-12:
+            civec = np.zeros (ncsf_all)
+            civec[addr] = pv[:,0]
+            return pw[0]+ecore, civec
+        elif nroots > 1:
+            civec = np.zeros ((nroots,ncsf_all))
+            civec[:,addr] = pv[:,:nroots].T
+            return pw[:nroots]+ecore, [c for c in civec]
+    elif pspace_size >= ncsf_sym and not davidson_only:
         if ncsf_sym == 1:
             civec = transformer.vec_csf2det (pv[:,0].reshape (1,1))
             return pw[0]+ecore, civec
@@ -399,12 +685,30 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
                        tol, lindep, max_cycle, max_space, nroots,
                        davidson_only, pspace_size, ecore=ecore, **kwargs)
     '''
-    h2e = fci.absorb_h1e(h1e, eri, norb, nelec, .5)
+    if 'h2e' not in prep:
+        prep['h2e'] = fci.absorb_h1e(h1e, eri, norb, nelec, .5)
+    h2e = prep['h2e']
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: h2e", *t0)
-    def hop(x):
-        x_det = transformer.vec_csf2det (x)
-        hx = fci.contract_2e(h2e, x_det, norb, nelec, (link_indexa,link_indexb))
-        return transformer.vec_det2csf (hx, normalize=False).ravel ()
+    hcsf = None
+    if fci.sigma_backend == 'conf' and not fci._contract_2e_overridden ():
+        # The full matrix is shared by all point-group sectors; its blocks are keyed like pspace
+        hcsf_key = ('hcsf', psp_key[2])
+        if hcsf_key not in prep:
+            if 'hcsf' not in prep:
+                prep['hcsf'] = make_hcsf_conf (fci, h2e, norb, nelec, transformer,
+                                               max_memory=(max_memory or fci.max_memory))
+            hcsf = prep['hcsf']
+            if hcsf is not None and idx_sym is not None:
+                hcsf = hcsf[idx_sym][:,idx_sym]
+            prep[hcsf_key] = hcsf
+            t0 = lib.logger.timer_debug1 (fci, "csf.kernel: hcsf", *t0)
+        hcsf = prep[hcsf_key]
+    if hcsf is not None:
+        def hop(x):
+            return hcsf @ x + hcsf.T @ x
+    else:
+        hop = fci.gen_hop_csf (h2e, norb, nelec, transformer, link_index=(link_indexa,link_indexb),
+                               prep=prep)
 
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: make hop", *t0)
     if ci0 is None:
@@ -421,6 +725,10 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
                     x[addr[i]] = 1
                     x0.append(x)
                 return x0
+    elif isinstance(ci0, np.ndarray) and fci._is_csf_vec (ci0, norb, nelec):
+        ci0 = [transformer.pack_csf (ci0)]
+    elif not isinstance(ci0, np.ndarray) and all ([fci._is_csf_vec (c, norb, nelec) for c in ci0]):
+        ci0 = [transformer.pack_csf (c) for c in ci0]
     else:
         if isinstance(ci0, np.ndarray) and ci0.size == na*nb:
             ci0 = [transformer.vec_det2csf (ci0.ravel ())]
@@ -447,6 +755,10 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
                        max_memory=max_memory, verbose=verbose, follow_state=True,
                        tol_residual=tol_residual, **kwargs)
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: running fci.eig", *t0)
+    if fci.ci_basis == 'csf':
+        c = transformer.unpack_csf (np.asarray (c))
+        if nroots > 1: return e+ecore, [ci for ci in c]
+        return e+ecore, c
     c = transformer.vec_csf2det (c, order='C')
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: transforming final ci vector", *t0)
     if nroots > 1:
@@ -454,15 +766,135 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     else:
         return e+ecore, c.reshape(na,nb)
 
-class CSFFCISolver: # tag class
-    pass
+class CSFFCISolver:
+    ''' Mixin of the CSF-based FCI solvers. If ci_basis is 'csf', the kernel returns CI vectors
+    as 1D arrays of the coefficients of all CSFs of the given spin in the canonical order of
+    csfstring.py (i.e., not packed by point-group symmetry) instead of determinant-basis
+    arrays. The methods below accept either and transform CSF-basis vectors to determinants only
+    when they need to; contract_2e and transform_ci_for_orbital_rotation return vectors in the
+    basis of their argument.
+
+    In 'csf' mode, every 1D vector with the length of a CSF vector is taken to be one, so
+    determinant-basis vectors must be passed with shape (ndeta, ndetb).
+
+    sigma_backend selects how the kernel applies the Hamiltonian to its CSF-basis trial vectors:
+    'det' expands them into the determinant basis and calls contract_2e, 'conf' builds the
+    CSF-basis Hamiltonian once per Hamiltonian as a sparse matrix from configuration pairs
+    (see make_hcsf_conf), so that each iteration costs time and memory proportional to the
+    number of CSFs rather than determinants. 'conf' pays off when ncsf << ndet (e.g., high-spin
+    states with many singly-occupied orbitals), and falls back to 'det' if the sparse matrix
+    does not fit in max_memory or if a subclass overrides contract_2e (e.g., fix_spin_).
+    '''
 
-class FCISolver (direct_spin1.FCISolver, CSFFCISolver):
+    ci_basis = getattr(__config__, 'fci_csf_FCI_ci_basis', 'det')
+    sigma_backend = getattr(__config__, 'fci_csf_FCI_sigma_backend', 'det')
+
+    def gen_hop_csf (self, h2e, norb, nelec, transformer, link_index=None, prep=None):
+        ''' The Hamiltonian-vector product of the kernel for sigma_backend == 'det', on the
+        (symmetry-packed) CSF-basis trial vectors '''
+        na, nb = transformer.ndeta, transformer.ndetb
+        def hop(x):
+            x_det = transformer.vec_csf2det (x).reshape (na,nb)
+            hx = self.contract_2e(h2e, x_det, norb, nelec, link_index)
+            return transformer.vec_det2csf (hx, normalize=False).ravel ()
+        return hop
+
+    def _contract_2e_overridden (self):
+        ''' Whether a subclass (e.g., from fix_spin_) overrides the contract_2e of the CSF solver,
+        which the 'conf' sigma backend and the blocked spaces of csf_symm do not reproduce '''
+        for cls in type (self).__mro__:
+            if 'contract_2e' in vars (cls): return CSFFCISolver not in cls.__bases__
+        return True
+
+    def _is_csf_vec (self, civec, norb, nelec):
+        if self.ci_basis != 'csf' or np.ndim (civec) != 1: return False
+        neleca, nelecb = _unpack_nelec (nelec, self.spin)
+        return np.size (civec) == count_all_csfs (norb, neleca, nelecb, self.smult)
+
+    def _get_spin_transformer (self, norb, nelec):
+        # Only the spin part of the cache is needed (or touched) to change basis
+        neleca, nelecb = _unpack_nelec (nelec, self.spin)
+        if self.transformer is None:
+            self.transformer = CSFTransformer (norb, neleca, nelecb, self.smult)
+        else:
+            self.transformer._update_spin_cache (norb, neleca, nelecb, self.smult)
+        return self.transformer
+
+    def ci_to_det (self, civec, norb, nelec):
+        ''' CI vector in the determinant basis, with shape (ndeta, ndetb) '''
+        if not self._is_csf_vec (civec, norb, nelec): return civec
+        t = self._get_spin_transformer (norb, nelec)
+        civec = transform_civec_csf2det (np.asarray (civec), norb, t.neleca, t.nelecb, self.smult,
+                                         csd_mask=t.csd_mask, do_normalize=False)[0]
+        return civec.reshape (t.ndeta, t.ndetb)
+
+    def ci_to_csf (self, civec, norb, nelec):
+        ''' CI vector in the basis of all CSFs of the solver's spin (1D) '''
+        if self._is_csf_vec (civec, norb, nelec): return civec
+        t = self._get_spin_transformer (norb, nelec)
+        return transform_civec_det2csf (np.asarray (civec).ravel (), norb, t.neleca, t.nelecb,
+                                        self.smult, csd_mask=t.csd_mask, do_normalize=False)[0]
+
+    def make_rdm1 (self, fcivec, norb, nelec, *args, **kwargs):
+        fcivec = self.ci_to_det (fcivec, norb, nelec)
+        return super().make_rdm1 (fcivec, norb, nelec, *args, **kwargs)
+
+    def make_rdm1s (self, fcivec, norb, nelec, *args, **kwargs):
+        fcivec = self.ci_to_det (fcivec, norb, nelec)
+        return super().make_rdm1s (fcivec, norb, nelec, *args, **kwargs)
+
+    def make_rdm2 (self, fcivec, norb, nelec, *args, **kwargs):
+        fcivec = self.ci_to_det (fcivec, norb, nelec)
+        return super().make_rdm2 (fcivec, norb, nelec, *args, **kwargs)
+
+    def make_rdm12 (self, fcivec, norb, nelec, *args, **kwargs):
+        fcivec = self.ci_to_det (fcivec, norb, nelec)
+        return super().make_rdm12 (fcivec, norb, nelec, *args, **kwargs)
+
+    def make_rdm12s (self, fcivec, norb, nelec, *args, **kwargs):
+        fcivec = self.ci_to_det (fcivec, norb, nelec)
+        return super().make_rdm12s (fcivec, norb, nelec, *args, **kwargs)
+
+    def trans_rdm1 (self, cibra, ciket, norb, nelec, *args, **kwargs):
+        cibra = self.ci_to_det (cibra, norb, nelec)
+        ciket = self.ci_to_det (ciket, norb, nelec)
+        return super().trans_rdm1 (cibra, ciket, norb, nelec, *args, **kwargs)
+
+    def trans_rdm1s (self, cibra, ciket, norb, nelec, *args, **kwargs):
+        cibra = self.ci_to_det (cibra, norb, nelec)
+        ciket = self.ci_to_det (ciket, norb, nelec)
+        return super().trans_rdm1s (cibra, ciket, norb, nelec, *args, **kwargs)
+
+    def trans_rdm12 (self, cibra, ciket, norb, nelec, *args, **kwargs):
+        cibra = self.ci_to_det (cibra, norb, nelec)
+        ciket = self.ci_to_det (ciket, norb, nelec)
+        return super().trans_rdm12 (cibra, ciket, norb, nelec, *args, **kwargs)
+
+    def trans_rdm12s (self, cibra, ciket, norb, nelec, *args, **kwargs):
+        cibra = self.ci_to_det (cibra, norb, nelec)
+        ciket = self.ci_to_det (ciket, norb, nelec)
+        return super().trans_rdm12s (cibra, ciket, norb, nelec, *args, **kwargs)
+
+    def spin_square (self, fcivec, norb, nelec):
+        return super().spin_square (self.ci_to_det (fcivec, norb, nelec), norb, nelec)
+
+    def large_ci (self, fcivec, norb, nelec, *args, **kwargs):
+        return super().large_ci (self.ci_to_det (fcivec, norb, nelec), norb, nelec, *args, **kwargs)
+
+    def transform_ci_for_orbital_rotation (self, fcivec, norb, nelec, u):
+        is_csf = self._is_csf_vec (fcivec, norb, nelec)
+        fcivec = super().transform_ci_for_orbital_rotation (self.ci_to_det (fcivec, norb, nelec),
+                                                            norb, nelec, u)
+        if is_csf: fcivec = self.ci_to_csf (fcivec, norb, nelec)
+        return fcivec
+
+class FCISolver (CSFFCISolver, direct_spin1.FCISolver):
     r''' get_init_guess uses csfstring.py and csdstring.py to construct a spin-symmetry-adapted initial guess, and the Davidson algorithm is carried
-    out in the CSF basis. However, the ci attribute is put in the determinant basis at the end of it all, and "ci0" is also assumed
-    to be in the determinant basis.'''
+    out in the CSF basis. By default (ci_basis='det'), the ci attribute is put in the determinant basis at the end of it all, and "ci0"
+    is also assumed to be in the determinant basis. With ci_basis='csf', the ci attribute is left in the CSF basis instead, and "ci0"
+    may be given in either basis (see CSFFCISolver).'''
 
-    pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 200)
+    pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 1000)
 
     def __init__(self, mol=None, smult=None):
         self.smult = smult
@@ -476,11 +908,13 @@ class FCISolver (direct_spin1.FCISolver, CSFFCISolver):
         self.check_transformer_cache ()
         return get_init_guess (norb, nelec, nroots, hdiag_csf, self.transformer)
 
-    def make_hdiag_csf (self, h1e, eri, norb, nelec, hdiag_det=None):
+    def make_hdiag_csf (self, h1e, eri, norb, nelec, hdiag_det=None, max_memory=None):
         self.norb = norb
         self.nelec = nelec
         self.check_transformer_cache ()
-        return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det)
+        if max_memory is None: max_memory = self.max_memory
+        return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det,
+                               max_memory=max_memory)
 
     make_hdiag = make_hdiag_det
 
@@ -492,6 +926,10 @@ class FCISolver (direct_spin1.FCISolver, CSFFCISolver):
         return h2eff
 
     def contract_2e(self, eri, fcivec, norb, nelec, link_index=None, **kwargs):
+        if self._is_csf_vec (fcivec, norb, nelec):
+            hc = self.contract_2e (eri, self.ci_to_det (fcivec, norb, nelec), norb, nelec,
+                                   link_index=link_index, **kwargs)
+            return self.ci_to_csf (hc, norb, nelec)
         hc = super().contract_2e(eri, fcivec, norb, nelec, link_index, **kwargs)
         if hasattr (eri, 'h1e_s'):
            hc += direct_uhf.contract_1e ([eri.h1e_s, -eri.h1e_s], fcivec, norb, nelec, link_index)  
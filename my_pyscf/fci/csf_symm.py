@@ -1,12 +1,15 @@
 import numpy as np
 import scipy
-from pyscf import symm, __config__
+import ctypes
+from pyscf import symm, ao2mo, lib, __config__
 from pyscf.lib import logger, davidson1
 from pyscf.fci import direct_spin1_symm, cistring, direct_uhf
 from pyscf.lib.numpy_helper import tag_array
 from pyscf.fci.direct_spin1 import _unpack_nelec, _get_init_guess, kernel_ms1
-from pyscf.fci.direct_spin1_symm import _gen_strs_irrep, _id_wfnsym
-from mrh.my_pyscf.fci.csfstring import CSFTransformer
+from pyscf.fci.direct_spin1_symm import _gen_strs_irrep, _id_wfnsym, TOTIRREPS, libfci
+from mrh.my_pyscf.fci.csfstring import CSFTransformer, get_csfvec_shape, get_spin_evecs
+from mrh.my_pyscf.fci.csfstring import _transform_det2csf_blk
+from mrh.my_pyscf.fci.csdstring import get_csdaddrs_shape
 from mrh.my_pyscf.fci.csf import kernel, pspace, get_init_guess, make_hdiag_csf, make_hdiag_det, unpack_h1e_cs, CSFFCISolver
 '''
     MRH 03/24/2019
@@ -20,15 +23,180 @@ from mrh.my_pyscf.fci.csf import kernel, pspace, get_init_guess, make_hdiag_csf,
 '''
 
 
-class FCISolver (direct_spin1_symm.FCISolver, CSFFCISolver):
+class SymmBlockedSpace (object):
+    ''' The determinants of point-group symmetry wfnsym, stored as in direct_spin1_symm.contract_2e:
+    a 1D array concatenating the blocks c[aidx[ir]][:,bidx[wfnsym^ir]] of all irreps ir of the
+    alpha strings. Only the electron configurations of symmetry wfnsym are transformed between it
+    and the symmetry-packed CSF vectors of the kernel, and the Hamiltonian is applied to it block
+    by block, so the Davidson iterations of FCISolver.kernel never touch the determinants of the
+    other irreps.
+
+    Args:
+        norb: integer
+        nelec: integer or tuple of length 2
+        transformer: instance of :class:`CSFTransformer`
+            With orbsym and wfnsym set
+    '''
+    def __init__(self, norb, nelec, transformer):
+        neleca, nelecb = _unpack_nelec (nelec)
+        self.norb, self.nelec = norb, (neleca, nelecb)
+        self.orbsym = orbsym = np.asarray (transformer.orbsym)
+        self.wfnsym = wfnsym = transformer.wfnsym % 10
+        self.strsa = cistring.make_strings (range (norb), neleca)
+        self.strsb = cistring.make_strings (range (norb), nelecb)
+        airreps = _gen_strs_irrep (self.strsa, orbsym)
+        birreps = _gen_strs_irrep (self.strsb, orbsym)
+        self.aidx = [np.where (airreps == ir)[0] for ir in range (TOTIRREPS)]
+        self.bidx = [np.where (birreps == ir)[0] for ir in range (TOTIRREPS)]
+        self.nas = nas = np.asarray ([x.size for x in self.aidx], dtype=np.int64)
+        self.nbs = nbs = np.asarray ([x.size for x in self.bidx], dtype=np.int64)
+        # Block ir has shape (nas[ir], nbs[wfnsym^ir]); the transposed blocks used for the
+        # beta-string half of contract_2e have shape (nbs[ir], nas[wfnsym^ir])
+        irs = np.arange (TOTIRREPS)
+        self.offsets = np.append (0, np.cumsum (nas * nbs[wfnsym^irs]))
+        self.offsets_t = np.append (0, np.cumsum (nbs * nas[wfnsym^irs]))
+        self.ndet = self.offsets[-1]
+
+        # Position in the blocked vector of each determinant of symmetry wfnsym
+        arank = np.empty (airreps.size, dtype=np.int64)
+        brank = np.empty (birreps.size, dtype=np.int64)
+        for ir in range (TOTIRREPS):
+            arank[self.aidx[ir]] = np.arange (nas[ir])
+            brank[self.bidx[ir]] = np.arange (nbs[ir])
+        def det_pos (det_addr):
+            ia, ib = np.divmod (det_addr.astype (np.int64), birreps.size)
+            ir = airreps[ia]
+            return self.offsets[ir] + arank[ia] * nbs[wfnsym^ir] + brank[ib]
+
+        # Configurations of symmetry wfnsym, by number of electron pairs (cf. _transform_det2csf)
+        smult = transformer.smult
+        confsym = transformer.confsym
+        csd_mask = transformer.csd_mask
+        min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = \
+            get_csdaddrs_shape (norb, neleca, nelecb)
+        npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)[-1]
+        self.blocks = []
+        iconf = csf_offset = 0
+        for ipair, ncsf in enumerate (npair_csf_size):
+            nconf = npair_dconf_size[ipair] * npair_sconf_size[ipair]
+            ndet = npair_sdet_size[ipair]
+            idx = confsym[iconf:iconf+nconf] == transformer.wfnsym
+            iconf += nconf
+            nconf_sym = np.count_nonzero (idx)
+            if ncsf == 0 or nconf_sym == 0: continue
+            det_addr = csd_mask[npair_csd_offset[ipair]:][:nconf*ndet].reshape (nconf, ndet)[idx]
+            nspin = neleca + nelecb - 2*(min_npair + ipair)
+            umat = np.asarray (get_spin_evecs (nspin, neleca, nelecb, smult))
+            self.blocks.append ((csf_offset, det_pos (det_addr), umat))
+            csf_offset += nconf_sym*ncsf
+        self.ncsf = csf_offset
+
+    def vec_csf2det (self, csfvec):
+        ''' Symmetry-packed CSF vector -> blocked determinant vector '''
+        csfvec = np.ascontiguousarray (csfvec, dtype=np.float64).reshape (1, self.ncsf)
+        detvec = np.zeros ((1, self.ndet), dtype=np.float64)
+        for csf_offset, det_pos, umat in self.blocks:
+            _transform_det2csf_blk (csfvec, detvec, det_pos, umat, csf_offset, reverse=True)
+        return detvec[0]
+
+    def vec_det2csf (self, detvec):
+        ''' Blocked determinant vector -> symmetry-packed CSF vector (not normalized) '''
+        detvec = np.ascontiguousarray (detvec, dtype=np.float64).reshape (1, self.ndet)
+        csfvec = np.empty ((1, self.ncsf), dtype=np.float64)
+        for csf_offset, det_pos, umat in self.blocks:
+            _transform_det2csf_blk (csfvec, detvec, det_pos, umat, csf_offset)
+        return csfvec[0]
+
+    def _block_ptrs (self, vec, offsets):
+        return (ctypes.c_void_p*TOTIRREPS)(*[vec[p0:].ctypes.data_as (ctypes.c_void_p)
+                                            for p0 in offsets[:-1]])
+
+    def gen_contract_2e (self, h2e, link_index=None):
+        ''' Function applying h2e, as absorbed by FCISolver.absorb_h1e (including h1e_s if it is
+        tagged with it), to a blocked determinant vector: the same as FCISolver.contract_2e on the
+        determinants of symmetry wfnsym '''
+        norb, nelec, orbsym, wfnsym = self.norb, self.nelec, self.orbsym, self.wfnsym
+        nas, nbs, offsets, offsets_t = self.nas, self.nbs, self.offsets, self.offsets_t
+        link_indexa, link_indexb = direct_spin1_symm.direct_spin1._unpack (norb, nelec, link_index)
+        nlinka, nlinkb = link_indexa.shape[1], link_indexb.shape[1]
+        eri = ao2mo.restore (4, np.asarray (h2e), norb)
+        eri_irs, rank_eri, irrep_eri = direct_spin1_symm.reorder_eri (eri, norb, orbsym)
+        linka = direct_spin1_symm.gen_str_irrep (self.strsa, orbsym, link_indexa, rank_eri,
+                                                 irrep_eri)[1]
+        linkb = direct_spin1_symm.gen_str_irrep (self.strsb, orbsym, link_indexb, rank_eri,
+                                                 irrep_eri)[1]
+        dimirrep = (ctypes.c_int*TOTIRREPS)(*[x.shape[0] for x in eri_irs])
+        c_nas = (ctypes.c_int*TOTIRREPS)(*nas)
+        c_nbs = (ctypes.c_int*TOTIRREPS)(*nbs)
+        shapes = [(nas[ir], nbs[wfnsym^ir]) for ir in range (TOTIRREPS)]
+
+        # Spin-dependent one-body term (see FCISolver.contract_2e) as sparse matrices of the
+        # string excitations within each irrep
+        h1e_s = getattr (h2e, 'h1e_s', None)
+        if h1e_s is not None:
+            h1e_s = lib.unpack_tril (lib.pack_tril (np.asarray (h1e_s)))
+            def get_h1s_blocks (strs, nelec_s, fac):
+                link = cistring.gen_linkstr_index (range (norb), nelec_s, strs)
+                a, i, str1, sgn = [link[:,:,k].ravel () for k in range (4)]
+                str0 = np.repeat (np.arange (len (strs)), link.shape[1])
+                h = scipy.sparse.csr_matrix ((fac * sgn * h1e_s[a,i], (str1, str0)),
+                                             shape=(len (strs),)*2)
+                return [h[idx][:,idx] for idx in (self.aidx, self.bidx)[fac<0]]
+            h1s_a = get_h1s_blocks (self.strsa, nelec[0], 1)
+            h1s_b = get_h1s_blocks (self.strsb, nelec[1], -1)
+
+        def contract_2e (ci0):
+            # The pointer arrays are built here so that the closure keeps the arrays alive
+            Tirrep = ctypes.c_void_p*TOTIRREPS
+            linka_ptr = Tirrep(*[x.ctypes.data_as (ctypes.c_void_p) for x in linka])
+            linkb_ptr = Tirrep(*[x.ctypes.data_as (ctypes.c_void_p) for x in linkb])
+            eri_ptrs = Tirrep(*[x.ctypes.data_as (ctypes.c_void_p) for x in eri_irs])
+            ci0 = np.ascontiguousarray (ci0)
+            ci1 = np.zeros_like (ci0)
+            libfci.FCIcontract_2e_symm1 (eri_ptrs, self._block_ptrs (ci0, offsets),
+                                         self._block_ptrs (ci1, offsets),
+                                         ctypes.c_int (norb), c_nas, c_nbs,
+                                         ctypes.c_int (nlinka), ctypes.c_int (nlinkb),
+                                         linka_ptr, linkb_ptr, dimirrep, ctypes.c_int (wfnsym))
+            blk0 = [ci0[p0:p1].reshape (shape) for p0, p1, shape
+                    in zip (offsets[:-1], offsets[1:], shapes)]
+            blk1 = [ci1[p0:p1].reshape (shape) for p0, p1, shape
+                    in zip (offsets[:-1], offsets[1:], shapes)]
+            ci0_t = np.empty (offsets_t[-1], dtype=ci0.dtype)
+            ci1_t = np.zeros_like (ci0_t)
+            for ir in range (TOTIRREPS):
+                if blk0[wfnsym^ir].size:
+                    lib.transpose (blk0[wfnsym^ir], out=ci0_t[offsets_t[ir]:offsets_t[ir+1]].reshape (
+                        nbs[ir], nas[wfnsym^ir]))
+            libfci.FCIcontract_2e_symm1 (eri_ptrs, self._block_ptrs (ci0_t, offsets_t),
+                                         self._block_ptrs (ci1_t, offsets_t),
+                                         ctypes.c_int (norb), c_nbs, c_nas,
+                                         ctypes.c_int (nlinkb), ctypes.c_int (nlinka),
+                                         linkb_ptr, linka_ptr, dimirrep, ctypes.c_int (wfnsym))
+            for ir in range (TOTIRREPS):
+                if blk1[wfnsym^ir].size:
+                    blk1[wfnsym^ir] += ci1_t[offsets_t[ir]:offsets_t[ir+1]].reshape (
+                        nbs[ir], nas[wfnsym^ir]).T
+            if h1e_s is not None:
+                for ir in range (TOTIRREPS):
+                    if blk0[ir].size:
+                        blk1[ir] += h1s_a[ir] @ blk0[ir]
+                        blk1[ir] += (h1s_b[wfnsym^ir] @ blk0[ir].T).T
+            return ci1
+
+        return contract_2e
+
+
+class FCISolver (CSFFCISolver, direct_spin1_symm.FCISolver):
     r''' get_init_guess uses csfstring.py and csdstring.py to construct a spin-symmetry-adapted initial guess, and the Davidson algorithm is carried
-    out in the CSF basis. However, the ci attribute is put in the determinant basis at the end of it all, and "ci0" is also assumed
-    to be in the determinant basis.
+    out in the CSF basis. By default (ci_basis='det'), the ci attribute is put in the determinant basis at the end of it all, and "ci0"
+    is also assumed to be in the determinant basis. With ci_basis='csf', the ci attribute is left in the CSF basis instead, and "ci0"
+    may be given in either basis (see CSFFCISolver).
 
     ...However, I want to also do point-group symmetry better than direct_spin1_symm...
     '''
 
-    pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 200)
+    pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 1000)
 
     def __init__(self, mol=None, smult=None):
         self.smult = smult
@@ -45,15 +213,40 @@ class FCISolver (direct_spin1_symm.FCISolver, CSFFCISolver):
         return h2eff
 
     def contract_2e(self, eri, fcivec, norb, nelec, link_index=None, **kwargs):
+        if self._is_csf_vec (fcivec, norb, nelec):
+            hc = self.contract_2e (eri, self.ci_to_det (fcivec, norb, nelec), norb, nelec,
+                                   link_index=link_index, **kwargs)
+            return self.ci_to_csf (hc, norb, nelec)
         hc = super().contract_2e(eri, fcivec, norb, nelec, link_index, **kwargs)
         if hasattr (eri, 'h1e_s'):
            hc += direct_uhf.contract_1e ([eri.h1e_s, -eri.h1e_s], fcivec, norb, nelec, link_index)  
         return hc
 
-    def make_hdiag_csf (self, h1e, eri, norb, nelec, hdiag_det=None):
+    def make_hdiag_csf (self, h1e, eri, norb, nelec, hdiag_det=None, max_memory=None):
         self.norb, self.nelec = norb, nelec
         self.check_transformer_cache ()
-        return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det)
+        if max_memory is None: max_memory = self.max_memory
+        return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det,
+                               max_memory=max_memory)
+
+    def gen_hop_csf (self, h2e, norb, nelec, transformer, link_index=None, prep=None):
+        ''' Works on the determinants of the target irrep only (see SymmBlockedSpace), unless
+        contract_2e is overridden (e.g., by fix_spin_), in which case the whole determinant space
+        is passed to it '''
+        if (self._contract_2e_overridden () or transformer.orbsym is None
+                or transformer.wfnsym is None):
+            return super().gen_hop_csf (h2e, norb, nelec, transformer, link_index=link_index)
+        if prep is None: prep = {}
+        # prep may be shared among solvers of different irreps (see csf.kernel)
+        space_key = ('symm_space', transformer.wfnsym,
+                     np.asarray (transformer.orbsym).tobytes ())
+        if space_key not in prep:
+            prep[space_key] = SymmBlockedSpace (norb, nelec, transformer)
+        space = prep[space_key]
+        contract_2e = space.gen_contract_2e (h2e, link_index=link_index)
+        def hop(x):
+            return space.vec_det2csf (contract_2e (space.vec_csf2det (x)))
+        return hop
 
     def pspace (self, h1e, eri, norb, nelec, hdiag_det=None, hdiag_csf=None, npsp=200, **kwargs):
         self.norb, self.nelec = norb, nelec
@@ -86,7 +279,12 @@ class FCISolver (direct_spin1_symm.FCISolver, CSFFCISolver):
 
         # The order of the four things below is super sensitive
         self.orbsym = orbsym
-        wfnsym = self.guess_wfnsym(norb, nelec, ci0, **kwargs)
+        ci0_det = ci0
+        if isinstance (ci0, np.ndarray):
+            ci0_det = self.ci_to_det (ci0, norb, nelec)
+        elif ci0 is not None:
+            ci0_det = [self.ci_to_det (c, norb, nelec) for c in ci0]
+        wfnsym = self.guess_wfnsym(norb, nelec, ci0_det, **kwargs)
         self.wfnsym = wfnsym
         kwargs['wfnsym'] = wfnsym
         self.check_transformer_cache ()
@@ -1,6 +1,7 @@
 import numpy as np
 import sys, os, time
 import ctypes
+import weakref
 from mrh.my_pyscf.fci import csdstring
 from pyscf.fci import cistring
 from pyscf.fci.spin_op import spin_square0
@@ -31,6 +32,57 @@ class ImpossibleSpinError (ImpossibleCIvecError):
                                       neleca=neleca, nelecb=nelecb)
         self.smult = smult
 
+class CSFTables (object):
+    ''' Read-only mask index arrays relating the determinant, csd and csf addressing of a given
+    norb, neleca, nelecb, and smult. Get them from get_csf_tables, which shares one instance among
+    all CSFTransformers of the same quantum numbers.
+
+    Attributes:
+        csd_mask: ndarray of ints
+            csd_mask[idx_csd] = idx_dd
+        econf_det_mask: ndarray of ints
+            econf_det_mask[idx_dd] = idx_econf
+        econf_csf_mask: ndarray of ints
+            econf_csf_mask[idx_csf] = idx_econf
+        nconf: integer
+            Total number of electron configurations
+        econf_det_index, econf_csf_index: tuples of ndarrays
+            (offset, addr) inverses of econf_det_mask and econf_csf_mask (see make_econf_index),
+            built on first use
+    '''
+    def __init__(self, norb, neleca, nelecb, smult):
+        self.csd_mask = csdstring.make_csd_mask (norb, neleca, nelecb)
+        self.econf_det_mask = csdstring.make_econf_det_mask (norb, neleca, nelecb, self.csd_mask)
+        self.econf_csf_mask = make_econf_csf_mask (norb, neleca, nelecb, smult)
+        self.nconf = int (self.econf_det_mask.max ()) + 1 if self.econf_det_mask.size else 0
+        self._econf_det_index = self._econf_csf_index = None
+        for arr in (self.csd_mask, self.econf_det_mask, self.econf_csf_mask):
+            arr.flags.writeable = False
+
+    @property
+    def econf_det_index (self):
+        if self._econf_det_index is None:
+            self._econf_det_index = make_econf_index (self.econf_det_mask, self.nconf)
+        return self._econf_det_index
+
+    @property
+    def econf_csf_index (self):
+        if self._econf_csf_index is None:
+            self._econf_csf_index = make_econf_index (self.econf_csf_mask, self.nconf)
+        return self._econf_csf_index
+
+# Held weakly, so a set of tables lives exactly as long as some CSFTransformer uses it
+_csf_tables_cache = weakref.WeakValueDictionary ()
+
+def get_csf_tables (norb, neleca, nelecb, smult):
+    ''' The CSFTables of (norb, neleca, nelecb, smult), built only if no other object currently
+    holds them '''
+    key = (int (norb), int (neleca), int (nelecb), int (smult))
+    tables = _csf_tables_cache.get (key)
+    if tables is None:
+        tables = _csf_tables_cache[key] = CSFTables (*key)
+    return tables
+
 class CSFTransformer (lib.StreamObject):
     def __init__(self, norb, neleca, nelecb, smult, orbsym=None, wfnsym=None):
         self._norb = self._neleca = self._nelecb = self._smult = self._orbsym = None
@@ -66,9 +118,34 @@ class CSFTransformer (lib.StreamObject):
 
     def mat_det2csf_confspace (self, mat, confs):
         mat, csf_addr = transform_opmat_det2csf_pspace (mat, confs, self._norb, self._neleca,
-            self._nelecb, self._smult, self.csd_mask, self.econf_det_mask, self.econf_csf_mask) 
+            self._nelecb, self._smult, self.csd_mask, self.econf_det_mask, self.econf_csf_mask,
+            econf_det_index=self.econf_det_index, econf_csf_index=self.econf_csf_index)
         return mat, csf_addr
 
+    @property
+    def econf_det_index (self):
+        ''' (offset, addr): the determinant addresses of the ith electron configuration are
+        addr[offset[i]:offset[i+1]] (see make_econf_index) '''
+        return self._tables.econf_det_index
+
+    @property
+    def econf_csf_index (self):
+        ''' (offset, addr): the CSF addresses of the ith electron configuration are
+        addr[offset[i]:offset[i+1]] (see make_econf_index) '''
+        return self._tables.econf_csf_index
+
+    @property
+    def nconf (self):
+        return self._tables.nconf
+
+    def get_econf_det_addrs (self, econfs):
+        ''' Sorted determinant addresses of each of the electron configurations econfs, concatenated '''
+        return get_econf_addrs (*self.econf_det_index, econfs)
+
+    def get_econf_csf_addrs (self, econfs):
+        ''' Sorted CSF addresses of each of the electron configurations econfs, concatenated '''
+        return get_econf_addrs (*self.econf_csf_index, econfs)
+
     def pack_csf (self, csfvec, order='C'):
         if self.wfnsym is None or self._orbsym is None:
             return csfvec
@@ -102,9 +179,10 @@ class CSFTransformer (lib.StreamObject):
 
     def _update_spin_cache (self, norb, neleca, nelecb, smult):
         if any ([self._norb != norb, self._neleca != neleca, self._nelecb != nelecb, self._smult != smult]):
-            self.csd_mask = csdstring.make_csd_mask (norb, neleca, nelecb)
-            self.econf_det_mask = csdstring.make_econf_det_mask (norb, neleca, nelecb, self.csd_mask)
-            self.econf_csf_mask = make_econf_csf_mask (norb, neleca, nelecb, smult)
+            self._tables = get_csf_tables (norb, neleca, nelecb, smult)
+            self.csd_mask = self._tables.csd_mask
+            self.econf_det_mask = self._tables.econf_det_mask
+            self.econf_csf_mask = self._tables.econf_csf_mask
             self._norb = norb
             self._neleca = neleca
             self._nelecb = nelecb
@@ -563,8 +641,8 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
     ncol_out = (ncsf_all, ndet_all)[reverse or project]
     ncol_in = (ncsf_all, ndet_all)[~reverse or project]
     if not project:
-        outarr = np.ascontiguousarray (np.zeros ((nrow, ncol_out), dtype=np.float_))
-        csf_addrs = np.zeros (ncsf_all, dtype=np.bool_)
+        inparr = np.ascontiguousarray (inparr, dtype=np.float64)
+        outarr = np.zeros ((nrow, ncol_out), dtype=np.float64)
     # Initialization is necessary because not all determinants have a csf for all spin states
 
     #max_npair = min (nelecb, (neleca + nelecb - int (round (2*s))) // 2)
@@ -579,9 +657,6 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
         csd_offset = npair_csd_offset[ipair]
         if (ncsf == 0) and not project:
             continue
-        if not project:
-            csf_addrs[:] = False
-            csf_addrs_ipair = csf_addrs[csf_offset:][:nconf*ncsf].reshape (nconf, ncsf) # Note: this is a view, i.e., a pointer
 
         t_ref = lib.logger.perf_counter ()
         if csd_mask is None:
@@ -606,20 +681,13 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
             Pmat = np.dot (umat, umat.T)
         time_umat += lib.logger.perf_counter () - t_ref
 
-        if not project:
-            csf_addrs_ipair[:,:ncsf_blk] = True # Note: edits csf_addrs
-
-        # The elements of csf_addrs and det_addrs are addresses for the flattened vectors and matrices (inparr.flat and outarr.flat)
-        # Passing them unflattened as indices of the flattened arrays should result in a 3-dimensional array if I understand numpy's indexing rules correctly
-        # For the lvalues, I think it's necessary to flatten csf_addrs and det_addrs to avoid an exception
-        # Hopefully this is parallel under the hood, and hopefully the OpenMP reduction epsilon doesn't ruin the spin eigenvectors
         t_ref = lib.logger.perf_counter ()
         if project:
             inparr[:,det_addrs] = np.tensordot (inparr[:,det_addrs], Pmat, axes=1)
         elif not reverse:
-            outarr[:,csf_addrs] = np.tensordot (inparr[:,det_addrs], umat, axes=1).reshape (nrow, ncsf_blk*nconf)
+            _transform_det2csf_blk (outarr, inparr, det_addrs, umat, csf_offset)
         else:
-            outarr[:,det_addrs] = np.tensordot (inparr[:,csf_addrs].reshape (nrow, nconf, ncsf_blk), umat, axes=((2,),(1,)))
+            _transform_det2csf_blk (inparr, outarr, det_addrs, umat, csf_offset, reverse=True)
         time_mult += lib.logger.perf_counter () - t_ref
 
     if project:
@@ -636,7 +704,46 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
     '''
     return outarr
 
-def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd_mask, econf_det_mask, econf_csf_mask):
+def _transform_det2csf_blk (csfarr, detarr, det_addrs, umat, csf_offset, reverse=False):
+    ''' Transform the determinants det_addrs of the rows of detarr into the CSFs
+    csf_offset:csf_offset+nconf*ncsf of the rows of csfarr or, if reverse, the reverse, with the
+    OpenMP-parallel gather-GEMM-scatter kernels FCICSFdet2csf_blk and FCICSFcsf2det_blk.
+    Elements of the output outside of the given configurations are not touched.
+
+    Args
+    csfarr: C-contiguous ndarray of shape (nrow, ncsf_all), float64
+    detarr: C-contiguous ndarray of shape (nrow, ndet_all), float64
+    det_addrs: ndarray of shape (nconf, ndet), nonnegative ints
+        Determinant addresses of nconf configurations of the same number of unpaired electrons
+    umat: ndarray of shape (ndet, ncsf)
+        Spin eigenvectors of these configurations (see get_spin_evecs)
+    csf_offset: integer
+    '''
+    nconf, ndet = det_addrs.shape
+    ncsf = umat.shape[1]
+    if nconf == 0 or csfarr.shape[0] == 0: return
+    assert (csfarr.flags.c_contiguous and detarr.flags.c_contiguous)
+    assert (csfarr.dtype == detarr.dtype == np.float64)
+    assert (csfarr.shape[0] == detarr.shape[0])
+    assert (csf_offset + nconf*ncsf <= csfarr.shape[1])
+    det_addrs = np.ascontiguousarray (det_addrs)
+    if det_addrs.dtype not in (np.uint32, np.uint64, np.int64):
+        det_addrs = det_addrs.astype (np.int64)
+    umat = np.ascontiguousarray (umat, dtype=np.float64)
+    csfptr = csfarr[:,csf_offset:].ctypes.data_as (ctypes.c_void_p)
+    detptr = detarr.ctypes.data_as (ctypes.c_void_p)
+    if reverse:
+        fn, outptr, inptr = libcsf.FCICSFcsf2det_blk, detptr, csfptr
+    else:
+        fn, outptr, inptr = libcsf.FCICSFdet2csf_blk, csfptr, detptr
+    fn (outptr, inptr, det_addrs.ctypes.data_as (ctypes.c_void_p),
+        ctypes.c_int (det_addrs.dtype.itemsize == 8), umat.ctypes.data_as (ctypes.c_void_p),
+        ctypes.c_int (csfarr.shape[0]), ctypes.c_int64 (csfarr.shape[1]),
+        ctypes.c_int64 (detarr.shape[1]), ctypes.c_uint64 (nconf), ctypes.c_int (ndet),
+        ctypes.c_int (ncsf))
+
+def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd_mask, econf_det_mask, econf_csf_mask,
+                                    econf_det_index=None, econf_csf_index=None):
     ''' Transform an operator matrix from the determinant basis to the csf basis, in a subspace of determinants spanning
         the electron configurations addressed by econfs
 
@@ -660,6 +767,11 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
         econf_csf_mask: ndarray of ints
             econf_det_mask[idx_csf] = idx_econf
 
+    Kwargs:
+        econf_det_index, econf_csf_index: tuples of ndarrays of ints
+            (offset, addr) inverses of econf_det_mask and econf_csf_mask from make_econf_index.
+            Computed here if omitted; pass the ones cached by CSFTransformer to avoid that.
+
     Returns:
         op: ndarray
             In csf basis
@@ -667,12 +779,16 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
             CI vector element addresses in CSF basis
     '''
 
+    econfs = np.asarray (econfs)
     nconf_all = econfs.size 
-    # I basically need to invert econf_det_mask and econf_csf_mask. I can't use argsort for this because their elements aren't unique
+    # I basically need to invert econf_det_mask and econf_csf_mask (see make_econf_index).
     # csf_addrs needs to be sorted because I don't want to make a second reduced_csd_mask index for the csf-basis version (see below);
     # just return the damn thing in the canonical order!
-    det_addrs = np.concatenate ([np.nonzero (econf_det_mask == conf)[0] for conf in econfs])
-    csf_addrs = np.sort (np.concatenate ([np.nonzero (econf_csf_mask == conf)[0] for conf in econfs]))
+    nconf_tot = int (econf_det_mask.max ()) + 1
+    if econf_det_index is None: econf_det_index = make_econf_index (econf_det_mask, nconf_tot)
+    if econf_csf_index is None: econf_csf_index = make_econf_index (econf_csf_mask, nconf_tot)
+    det_addrs = get_econf_addrs (*econf_det_index, econfs)
+    csf_addrs = np.sort (get_econf_addrs (*econf_csf_index, econfs))
     ndet_all = det_addrs.size
     ncsf_all = csf_addrs.size
     # econfs could have been provided in any order and defines the indexing of "op" (via det_addrs as generated above).
@@ -684,13 +800,16 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
     #   Then np.argsort (np.argsort (csd_mask)[det_addrs])[csd_addrs] inverts it twice, and gives you determinant addresses,
     #   but if det_addrs doesn't span the whole space, then csd_addrs can't either. In other words, the csd indices are compressed
     #   and correspond to the elements of op.
-    reduced_csd_mask = np.argsort (np.argsort (csd_mask)[det_addrs])
+    csd_addrs = np.empty (csd_mask.size, dtype=np.int64)
+    csd_addrs[csd_mask] = np.arange (csd_mask.size, dtype=np.int64) # = np.argsort (csd_mask)
+    reduced_csd_mask = np.argsort (csd_addrs[det_addrs])
     assert (op.shape == (ndet_all, ndet_all)), "operator matrix shape problem ({} for det_addrs of size {})".format (op.shape, det_addrs.size)
     min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = csdstring.get_csdaddrs_shape (norb, neleca, nelecb)
     _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
     npair_econf_size = npair_dconf_size * npair_sconf_size
     max_npair = min (neleca, nelecb)
     csf_idx = np.zeros (ncsf_all, dtype=np.bool_)
+    sorted_econfs = np.sort (econfs)
     def ax_b (mat):
         nrow = mat.shape[0]
         assert (mat.shape[1] == ndet_all)
@@ -702,7 +821,7 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
         for npair in range (min_npair, max_npair+1):
             ipair = npair - min_npair
             nconf_full = npair_econf_size[ipair]
-            nconf = np.count_nonzero (np.isin (range (full_conf_offset, full_conf_offset+nconf_full), econfs))
+            nconf = np.searchsorted (sorted_econfs, full_conf_offset+nconf_full) - np.searchsorted (sorted_econfs, full_conf_offset)
             full_conf_offset += nconf_full
             ncsf = npair_csf_size[ipair]
             ndet = npair_sdet_size[ipair]
@@ -732,18 +851,48 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
             
 
 
+def make_econf_index (econf_mask, nconf):
+    ''' Invert a mask index matching determinants or csfs to electron configurations (i.e.,
+    econf_det_mask or econf_csf_mask) in compressed-sparse-row style
+
+    Args:
+        econf_mask: ndarray of ints
+            econf_mask[idx] = idx_econf
+        nconf: integer
+            Total number of electron configurations
+
+    Returns:
+        offset: ndarray of ints of shape (nconf+1,)
+        addr: ndarray of ints of shape (econf_mask.size,)
+            addr[offset[i]:offset[i+1]] are the sorted addresses idx for which econf_mask[idx] = i
+    '''
+    addr = np.argsort (econf_mask, kind='stable')
+    offset = np.zeros (nconf+1, dtype=np.int64)
+    offset[1:] = np.cumsum (np.bincount (econf_mask, minlength=nconf))
+    return offset, addr
+
+def get_econf_addrs (offset, addr, econfs):
+    ''' Concatenate the addresses addr[offset[i]:offset[i+1]] for i in econfs (see make_econf_index) '''
+    econfs = np.asarray (econfs, dtype=np.int64).ravel ()
+    start = offset[econfs]
+    size = offset[econfs+1] - start
+    nout = size.sum ()
+    idx = np.arange (nout, dtype=np.int64) + np.repeat (start - np.cumsum (size) + size, size)
+    return addr[idx]
+
 def make_econf_csf_mask (norb, neleca, nelecb, smult):
     ''' Make a mask index matching csfs to electron configurations '''
     
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
     ncsf = count_all_csfs (norb, neleca, nelecb, smult)
-    mask = np.empty (ncsf, dtype=np.uint32)
     npair_conf_size = npair_dconf_size * npair_sconf_size
     npair_size = npair_conf_size * npair_csf_size
+    dtype = csdstring.get_mask_dtype (np.sum (npair_conf_size))
+    mask = np.empty (ncsf, dtype=dtype)
     iconf = 0
     for npair in range (min_npair, min (neleca, nelecb)+1):
         ipair = npair - min_npair
-        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=np.uint32)
+        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=dtype)
         iconf += npair_conf_size[ipair]
         mask[npair_offset[ipair]:][:npair_size[ipair]] = np.repeat (irange, npair_csf_size[ipair])
     return mask
@@ -832,12 +981,12 @@ def get_csfvec_shape (norb, neleca, nelecb, smult):
     for nspin in nspins:
         assert ((nspin + neleca - nelecb) % 2 == 0)
 
-    npair_dconf_size = np.asarray ([special.comb (norb, npair, exact=True) for npair in range (min_npair, nless+1)], dtype=np.int32)
-    npair_sconf_size = np.asarray ([special.comb (nfreeorb, nspin, exact=True) for nfreeorb, nspin in zip (nfreeorbs, nspins)], dtype=np.int32)
-    npair_csf_size = np.asarray ([count_csfs (nspin, smult) for nspin in nspins]).astype (np.int32)
+    npair_dconf_size = np.asarray ([special.comb (norb, npair, exact=True) for npair in range (min_npair, nless+1)], dtype=np.int64)
+    npair_sconf_size = np.asarray ([special.comb (nfreeorb, nspin, exact=True) for nfreeorb, nspin in zip (nfreeorbs, nspins)], dtype=np.int64)
+    npair_csf_size = np.asarray ([count_csfs (nspin, smult) for nspin in nspins]).astype (np.int64)
 
-    npair_sizes = np.asarray ([0] + [i * j * k for i,j,k in zip (npair_dconf_size, npair_sconf_size, npair_csf_size)], dtype=np.int32)
-    npair_offset = np.asarray ([np.sum (npair_sizes[:i+1]) for i in range (len (npair_sizes))], dtype=np.int32)
+    npair_sizes = np.asarray ([0] + [i * j * k for i,j,k in zip (npair_dconf_size, npair_sconf_size, npair_csf_size)], dtype=np.int64)
+    npair_offset = np.cumsum (npair_sizes)
     ndeta, ndetb = (special.comb (norb, n, exact=True) for n in (neleca, nelecb))
     assert (npair_offset[-1] <= ndeta*ndetb), "{} determinants and {} csfs".format (ndeta*ndetb, npair_offset[-1])
 
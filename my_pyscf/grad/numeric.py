@@ -1,9 +1,12 @@
 import numpy as np
+import multiprocessing
+from pyscf import lib
 from pyscf.grad import rhf as rhf_grad
 from pyscf.lib import param, logger
 
 STEPSIZE_DEFAULT=0.001
 SCANNER_VERBOSE_DEFAULT=4
+SCHEME_DEFAULT='central'
 
 # MRH 05/04/2020: I don't know why I have to present the molecule instead
 # of just the coordinates, but somehow I can't get the units right any other
@@ -23,12 +26,141 @@ def _numgrad_1df (mol, scanner, coords, iatm, icoord, delta=0.002):
     de_states = (ep_states - em_states) / (2*delta)*param.BOHR
     return (ep-em) / (2*delta)*param.BOHR, de_states
 
+# Finite-difference stencils: displacements in units of the stepsize and the
+# corresponding weights. The reference point (displacement 0) is evaluated
+# once in Gradients.kernel and is never dispatched to a worker.
+STENCILS = {'forward': ((1,), (1.0,), 1.0),
+            'backward': ((-1,), (-1.0,), -1.0),
+            'central': ((1,-1), (0.5,-0.5), 0.0),
+            'richardson': ((1,-1,2,-2), (8/12,-8/12,-1/12,1/12), 0.0)}
+
+def get_guess (scanner):
+    ''' Copy the wave function of the last scanner calculation to seed later
+    calculations with. Only the attributes that the scanner actually has
+    (i.e., mo_coeff and ci for MC-SCF scanners, mo_coeff of the SCF scanner)
+    are copied. '''
+    guess = {}
+    for key in ('mo_coeff', 'ci'):
+        val = getattr (scanner, key, None)
+        if val is not None: guess[key] = _copy_guess (val)
+    mf = getattr (scanner, '_scf', None)
+    if mf is not None and getattr (mf, 'mo_coeff', None) is not None:
+        guess['_scf'] = {'mo_coeff': _copy_guess (mf.mo_coeff),
+                         'mo_occ': _copy_guess (mf.mo_occ)}
+    return guess
+
+def _copy_guess (val):
+    if isinstance (val, np.ndarray): return val.copy ()
+    if isinstance (val, (list, tuple)): return type (val) ([_copy_guess (v) for v in val])
+    return val
+
+def set_guess_ (scanner, guess):
+    ''' Reset the scanner to the wave function stored by get_guess. The scanner
+    projects the MO coefficients onto the basis of the displaced geometry
+    itself (mcscf.addons.project_init_guess, or the SCF scanner's own dm0
+    projection), so we only need to put the reference back in place. '''
+    for key, val in guess.items ():
+        if key == '_scf':
+            for mfkey, mfval in val.items ():
+                setattr (scanner._scf, mfkey, _copy_guess (mfval))
+        else:
+            setattr (scanner, key, _copy_guess (val))
+    return scanner
+
+def _energy (scanner, mol, coords):
+    e = scanner (_make_mol (mol, coords))
+    return e, np.array (getattr (scanner, 'e_states', [e]))
+
+# Module-level state of a worker process. Workers are forked, so the scanner
+# doesn't need to be picklable.
+_worker = {}
+
+def _worker_init (nthreads):
+    lib.num_threads (nthreads)
+    scanner = _worker['scanner']
+    # Forked processes must not fight over the parent's chkfile
+    scanner.chkfile = None
+    if getattr (scanner, '_scf', None) is not None: scanner._scf.chkfile = None
+
+def _worker_batch (batch):
+    scanner, mol, coords0, guess = [_worker[key] for key in ('scanner', 'mol', 'coords', 'guess')]
+    results = []
+    for iatm, icoord, disp in batch:
+        coords = coords0.copy ()
+        coords[iatm,icoord] += disp
+        if guess is not None: set_guess_ (scanner, guess)
+        results.append (_energy (scanner, mol, coords))
+    return results
+
+def displaced_energies (scanner, mol, coords, tasks, guess=None, max_workers=1):
+    ''' Evaluate the energies at a list of displaced geometries.
+
+    Args:
+        scanner : callable
+            Energy scanner, as returned by the as_scanner method
+        mol : gto.Mole
+            Molecule; only used for the atom symbols
+        coords : ndarray of shape (natm,3)
+            Reference coordinates in Angstrom
+        tasks : list of lists of (iatm, icoord, disp)
+            Batches of displacements (in Angstrom). All displacements in one
+            batch are evaluated sequentially in the same process.
+
+    Kwargs:
+        guess : dict or None
+            Wave function to start every displaced calculation from; see
+            get_guess
+        max_workers : int
+            Number of processes among which the batches are distributed. If
+            1, everything happens in the calling process.
+
+    Returns:
+        energies : list of lists of (e_tot, e_states)
+            In the same order as tasks
+    '''
+    _worker.update (scanner=scanner, mol=mol, coords=coords, guess=guess)
+    try:
+        if max_workers == 1:
+            return [_worker_batch (batch) for batch in tasks]
+        nthreads = max (1, lib.num_threads () // max_workers)
+        ctx = multiprocessing.get_context ('fork')
+        with ctx.Pool (processes=max_workers, initializer=_worker_init,
+                       initargs=(nthreads,)) as pool:
+            # Pool.map preserves the task order regardless of which worker
+            # finishes first
+            return pool.map (_worker_batch, tasks, chunksize=1)
+    finally:
+        _worker.clear ()
+
 
 class Gradients (rhf_grad.GradientsMixin):
+    ''' Numeric nuclear gradients by finite differences of scanner energies
+
+    Extra attributes:
+        stepsize : float
+            Displacement in Angstrom. Default is 0.001
+        scheme : str
+            Finite-difference scheme. One of 'central' (default), 'forward',
+            'backward' (one-sided, half as many energies but only first-order
+            accurate), or 'richardson' (4-point Richardson extrapolation of
+            the central difference; fourth-order accurate)
+        max_workers : int
+            Number of processes among which the displaced energies are
+            distributed. Each process gets lib.num_threads () // max_workers
+            OpenMP threads. Default is 1 (serial)
+        reuse_guess : bool
+            If True (default), every displaced calculation starts from the
+            wave function of the reference geometry, projected onto the
+            displaced basis, rather than from whatever the scanner did last
+    '''
 
-    def __init__(self, method, stepsize=STEPSIZE_DEFAULT, scanner_verbose=SCANNER_VERBOSE_DEFAULT):
+    def __init__(self, method, stepsize=STEPSIZE_DEFAULT, scanner_verbose=SCANNER_VERBOSE_DEFAULT,
+                 scheme=SCHEME_DEFAULT, max_workers=1, reuse_guess=True):
         self.stepsize = stepsize
-        self.scanner = None 
+        self.scheme = scheme
+        self.max_workers = max_workers
+        self.reuse_guess = reuse_guess
+        self.scanner = None
         # MRH 05/04/2020: there must be a better way to do this
         if hasattr (self.scanner, '_scf'):
             self.scanner._scf.verbose = scanner_verbose
@@ -40,21 +172,79 @@ class Gradients (rhf_grad.GradientsMixin):
         return _numgrad_1df (self.mol, self.scanner, self.mol.atom_coords () * param.BOHR,
             iatm, icoord, delta=self.stepsize)
 
-    def kernel (self, atmlst=None, stepsize=None, state=None):
+    def get_tasks (self, atmlst, stepsize, scheme=None, max_workers=None):
+        ''' Group the displacements into batches for displaced_energies. One
+        batch contains every displacement of a range of Cartesian components,
+        so that the same process does e.g. both +h and -h of one component,
+        and there are at most max_workers batches (if max_workers > 1) or one
+        batch per component (if max_workers == 1). '''
+        if scheme is None: scheme = self.scheme
+        if max_workers is None: max_workers = self.max_workers
+        disps = STENCILS[scheme][0]
+        comps = [(i, j) for i in atmlst for j in range (3)]
+        if max_workers > 1:
+            nbatch = min (len (comps), max_workers)
+        else:
+            nbatch = len (comps)
+        tasks = []
+        for batch in np.array_split (np.arange (len (comps)), nbatch):
+            tasks.append ([(comps[k][0], comps[k][1], d*stepsize)
+                           for k in batch for d in disps])
+        return tasks
+
+    def kernel (self, atmlst=None, stepsize=None, state=None, scheme=None, max_workers=None):
         if atmlst is None:
             atmlst = self.atmlst
         if stepsize is None:
             stepsize = self.stepsize
         else:
             self.stepsize = stepsize
+        if scheme is None:
+            scheme = self.scheme
+        else:
+            self.scheme = scheme
+        if max_workers is None:
+            max_workers = self.max_workers
+        else:
+            self.max_workers = max_workers
         if atmlst is None:
             atmlst = list (range (self.mol.natm))
-        
+        if scheme not in STENCILS:
+            raise RuntimeError ("Unknown finite-difference scheme {}; choose from {}".format (
+                scheme, list (STENCILS.keys ())))
+        disps, weights, w0 = STENCILS[scheme]
+        log = logger.new_logger (self, self.verbose)
+        t0 = (logger.process_clock (), logger.perf_counter ())
+
+        # Reference point first: it provides the guess and the one-sided
+        # schemes need its energy anyway
         coords = self.mol.atom_coords () * param.BOHR
-        de = [[self._numgrad_1df (i, j) for j in range (3)] for i in atmlst]
-        self.scanner (_make_mol (self.mol, coords)) # Reset!
-        self.de = np.asarray ([[i for i,j in k] for k in de])
-        self.de_states = np.asarray ([[j for i,j in k] for k in de]).transpose (2,0,1)
+        e0, e0_states = _energy (self.scanner, self.mol, coords)
+        guess = get_guess (self.scanner) if self.reuse_guess else None
+        tasks = self.get_tasks (atmlst, stepsize, scheme=scheme, max_workers=max_workers)
+        log.info ('Numeric gradients: %d displaced energies (%s scheme) in %d batches on %d '
+                  'process(es)', sum ([len (t) for t in tasks]), scheme, len (tasks), max_workers)
+        results = displaced_energies (self.scanner, self.mol, coords, tasks, guess=guess,
+                                      max_workers=max_workers)
+        t0 = log.timer ('numeric gradient displaced energies', *t0)
+
+        de = np.zeros ((len (atmlst), 3))
+        de_states = np.zeros ((len (atmlst), 3, len (e0_states)))
+        atmidx = {iatm: ix for ix, iatm in enumerate (atmlst)}
+        ndisp = len (disps)
+        for batch, res in zip (tasks, results):
+            for k, ((iatm, icoord, disp), (e, e_states)) in enumerate (zip (batch, res)):
+                w = weights[k % ndisp] / stepsize * param.BOHR
+                de[atmidx[iatm],icoord] += w * e
+                de_states[atmidx[iatm],icoord] += w * e_states
+        de -= w0 / stepsize * param.BOHR * e0
+        de_states -= w0 / stepsize * param.BOHR * e0_states
+
+        # Reset!
+        if guess is not None: set_guess_ (self.scanner, guess)
+        self.scanner (_make_mol (self.mol, coords))
+        self.de = de
+        self.de_states = de_states.transpose (2,0,1)
         if state is not None: self.de = self.de_states[state]
         return self.de
 
@@ -81,4 +271,3 @@ class Gradients (rhf_grad.GradientsMixin):
             self._write(self.mol, self.de, self.atmlst)
             logger.note(self, '----------------------------------------------')
 
-
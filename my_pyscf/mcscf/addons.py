@@ -6,6 +6,7 @@ from pyscf.mcscf.addons import StateAverageMCSCFSolver, StateAverageMixFCISolver
 from pyscf.mcscf.addons import StateAverageMixFCISolver_state_args as _state_arg
 from pyscf.mcscf.addons import StateAverageMixFCISolver_solver_args as _solver_arg
 from pyscf.fci.direct_spin1 import _unpack_nelec
+from mrh.my_pyscf.fci.csf import CSFFCISolver
 
 class StateAverageNMixFCISolver (StateAverageMixFCISolver):
     def _get_nelec (self, solver, nelec):
@@ -47,6 +48,24 @@ def state_average_n_mix_(casscf, fcisolvers, weights=(0.5,0.5)):
 class H1EZipFCISolver (object):
     pass
 
+def _get_shared_prep (solver, h1e, norb, nelec, prep_cache):
+    ''' Get the dict of Hamiltonian-dependent preparations (see the prep kwarg of
+    mrh.my_pyscf.fci.csf.kernel) shared by all CSF solvers with the same h1e, orbital and
+    electron numbers, and spin, adding a new one to prep_cache if necessary. Returns None for
+    solvers that aren't CSF solvers. The point-group symmetry of the wave function is not part
+    of the key: orbsym is the same for all solvers of one kernel call, and the entries of prep
+    which depend on wfnsym are keyed by it inside the dict (see the prep kwarg of csf.kernel), so
+    that states of different irreps still share the diagonal, h2e, etc. '''
+    if not isinstance (solver, CSFFCISolver): return None
+    key = (solver.__class__, norb, tuple (_unpack_nelec (nelec)), solver.smult)
+    h1e = np.asarray (h1e)
+    for key1, h1e1, prep in prep_cache:
+        if key1 == key and h1e1.shape == h1e.shape and np.all (h1e1 == h1e):
+            return prep
+    prep = {}
+    prep_cache.append ((key, h1e, prep))
+    return prep
+
 def get_h1e_zipped_fcisolver (fcisolver):
     ''' Wrap a state-average-mix FCI solver to take a list of h1es to apply to each state.
     I'm not sure how orthogonality works into this, but in the most straightforward
@@ -71,12 +90,17 @@ def get_h1e_zipped_fcisolver (fcisolver):
             if isinstance (ecore, (int, float, np.integer, np.floating)):
                 ecore = [ecore,] * len (h1)
             if orbsym is None: orbsym=self.orbsym
+            # States with the same Hamiltonian and spin share the diagonal, pspace, etc.
+            prep_cache = []
             for solver, my_args, my_kwargs in self._loop_solver(_state_arg (ci0), _state_arg (h1), _state_arg (ecore)):
                 c0 = my_args[0]
                 h1e = my_args[1]
                 e0 = my_args[2]
-                e, c = solver.kernel(h1e, h2, norb, self._get_nelec(solver, nelec), c0,
-                                     orbsym=orbsym, verbose=log, ecore=e0, **kwargs)
+                ne = self._get_nelec(solver, nelec)
+                prep = _get_shared_prep (solver, h1e, norb, ne, prep_cache)
+                prep_kwargs = {} if prep is None else {'prep': prep}
+                e, c = solver.kernel(h1e, h2, norb, ne, c0, orbsym=orbsym, verbose=log,
+                                     ecore=e0, **prep_kwargs, **kwargs)
                 if solver.nroots == 1:
                     es.append(e)
                     cs.append(c)
@@ -169,7 +193,9 @@ def get_h1e_zipped_fcisolver (fcisolver):
             ci1 = []
             for solver, my_args, _ in self._loop_solver (_state_arg (ci0)):
                 ne = self._get_nelec (solver, nelec)
-                ci0_i = my_args[0].reshape ([special.comb (norb, n, exact=True) for n in ne])
+                ci0_i = my_args[0]
+                if getattr (solver, 'ci_basis', 'det') != 'csf':
+                    ci0_i = ci0_i.reshape ([special.comb (norb, n, exact=True) for n in ne])
                 ci1.append (solver.transform_ci_for_orbital_rotation (ci0_i, norb, ne, umat))
             return ci1
 
@@ -198,7 +224,7 @@ def las2cas_civec (las):
     from mrh.my_pyscf.mcscf.lassi_op_o0 import ci_outer_product
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver in fcibox.fcisolvers] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
-    ci, nelec = ci_outer_product (las.ci, norb_f, nelec_fr)
+    ci, nelec = ci_outer_product (las.ci_to_det (), norb_f, nelec_fr)
     return ci, nelec
 
 def debug_lasscf_hessian_(las, check_horb_matvec=False, perfect_orbital_preconditioner=False):
@@ -470,13 +470,43 @@ def get_init_guess_ci (las, mo_coeff=None, h2eff_sub=None, ci0=None):
         for iy, solver in enumerate (fcibox.fcisolvers):
             nelec = fcibox._get_nelec (solver, nelecas)
             ndet = tuple ([cistring.num_strings (norb, n) for n in nelec])
+            csf_basis = getattr (solver, 'ci_basis', 'det') == 'csf'
+            if isinstance (ci0[ix][iy], np.ndarray) and csf_basis:
+                ci0[ix][iy] = solver.ci_to_csf (ci0[ix][iy], norb, nelec)
+                continue
             if isinstance (ci0[ix][iy], np.ndarray) and ci0[ix][iy].size==ndet[0]*ndet[1]: continue
             if hasattr (mo_coeff, 'orbsym'):
                 solver.orbsym = mo_coeff.orbsym[ncore+i:ncore+j]
             hdiag_csf = solver.make_hdiag_csf (h1e, eri, norb, nelec)
             ci0[ix][iy] = solver.get_init_guess (norb, nelec, solver.nroots, hdiag_csf)[0]
+            if csf_basis:
+                ci0[ix][iy] = solver.ci_to_csf (ci0[ix][iy].reshape (ndet), norb, nelec)
     return ci0
 
+def ci_to_det (las, ci=None):
+    ''' Fragment CI vectors in the determinant basis, for code that needs them there (e.g.,
+    LASSI) regardless of las.ci_basis. Vectors which are already in the determinant basis are
+    returned as they are.
+
+    Kwargs:
+        ci : list of length nfrags of list of length nroots of ndarrays
+            Defaults to las.ci
+
+    Returns:
+        ci : list of length nfrags of list of length nroots of ndarrays
+            Each of shape (ndeta, ndetb) if it was transformed
+    '''
+    if ci is None: ci = las.ci
+    if ci is None: return None
+    ci1 = []
+    for fcibox, norb, nelecas, ci_f in zip (las.fciboxes, las.ncas_sub, las.nelecas_sub, ci):
+        ci1.append ([])
+        for solver, c in zip (fcibox.fcisolvers, ci_f):
+            if c is not None and getattr (solver, 'ci_basis', 'det') == 'csf':
+                c = solver.ci_to_det (c, norb, fcibox._get_nelec (solver, nelecas))
+            ci1[-1].append (c)
+    return ci1
+
 def get_state_info (las):
     ''' Retrieve the quantum numbers defining the states of a LASSCF calculation '''
     nfrags, nroots = las.nfrags, las.nroots
@@ -586,8 +616,10 @@ def state_average_(las, weights=[0.5,0.5], charges=None, spins=None,
     new_states = np.stack ([charges, spins, smults, wfnsyms], axis=-1)
     if assert_no_dupes: assert_no_duplicates (las, tab=new_states)
 
+    ci_basis = las.ci_basis
     las.fciboxes = [get_h1e_zipped_fcisolver (state_average_n_mix (
-        las, [csf_solver (las.mol, smult=s2p1).set (charge=c, spin=m2, wfnsym=ir)
+        las, [csf_solver (las.mol, smult=s2p1).set (charge=c, spin=m2, wfnsym=ir,
+                                                    ci_basis=ci_basis)
               for c, m2, s2p1, ir in zip (c_r, m2_r, s2p1_r, ir_r)], weights).fcisolver)
         for c_r, m2_r, s2p1_r, ir_r in zip (charges.T, spins.T, smults.T, wfnsyms.T)]
     las.e_states = np.zeros (nroots)
@@ -684,7 +716,10 @@ def run_lasci (las, mo_coeff=None, ci0=None, verbose=0, assert_no_dupes=False):
         for c1, c2, s, no, ne in zip (ci1, ci_i, solver.fcisolvers, ncas_sub, nelecas_sub):
             ne = solver._get_nelec (s, ne)
             ndet = tuple ([cistring.num_strings (no, n) for n in ne])
-            c1[state] = c2.reshape (*ndet)
+            if getattr (s, 'ci_basis', 'det') == 'csf':
+                c1[state] = c2
+            else:
+                c1[state] = c2.reshape (*ndet)
         if not conv: log.warn ('State %d LASCI not converged!', state)
         converged = converged and conv
         t = log.timer ('State {} LASCI'.format (state), *t)
@@ -720,9 +755,17 @@ class LASCINoSymm (casci.CASCI):
         self.ah_level_shift = 1e-8
         self.max_cycle_macro = 50
         self.max_cycle_micro = 5
+        self.ci_conv_tol_scale = None
+        self.ci_conv_tol_max = 1e-4
+        self.ci_skip_tol = None
+        self.prec_dense_aa = True
+        self.trust_radius = 1.0
+        self.trust_radius_max = 2.0
+        self.hop_update_tol = 1e-2
         keys = set(('e_states', 'fciboxes', 'nroots', 'weights', 'ncas_sub', 'nelecas_sub',
                     'conv_tol_grad', 'conv_tol_self', 'max_cycle_macro', 'max_cycle_micro',
-                    'ah_level_shift'))
+                    'ah_level_shift', 'ci_conv_tol_scale', 'ci_conv_tol_max', 'ci_skip_tol',
+                    'prec_dense_aa', 'trust_radius', 'trust_radius_max', 'hop_update_tol'))
         self._keys = set(self.__dict__.keys()).union(keys)
         self.fciboxes = []
         if isinstance(spin_sub,int):
@@ -742,6 +785,25 @@ class LASCINoSymm (casci.CASCI):
     @property
     def nfrags (self): return len (self.ncas_sub)
 
+    @property
+    def ci_basis (self):
+        ''' 'csf' if the fragment CI vectors are kept in the CSF basis (see CSFFCISolver in
+        mrh.my_pyscf.fci.csf) and 'det' if they are kept in the determinant basis '''
+        basis = [getattr (s, 'ci_basis', 'det') for f in self.fciboxes for s in f.fcisolvers]
+        return 'csf' if all ([b == 'csf' for b in basis]) else 'det'
+    @ci_basis.setter
+    def ci_basis (self, basis):
+        assert (basis in ('det', 'csf')), basis
+        if basis == 'det': self.ci = self.ci_to_det ()
+        for fcibox in self.fciboxes:
+            for solver in fcibox.fcisolvers:
+                solver.ci_basis = basis
+        if basis == 'csf' and self.ci is not None:
+            self.ci = [[c if c is None else s.ci_to_csf (c, norb, f._get_nelec (s, nelecas))
+                        for s, c in zip (f.fcisolvers, ci_f)]
+                       for f, norb, nelecas, ci_f in zip (self.fciboxes, self.ncas_sub,
+                                                          self.nelecas_sub, self.ci)]
+
     def get_mo_slice (self, idx, mo_coeff=None):
         if mo_coeff is None: mo_coeff = self.mo_coeff
         mo = mo_coeff[:,self.ncore:]
@@ -1322,6 +1384,7 @@ class LASCINoSymm (casci.CASCI):
     las2cas_civec = las2cas_civec
     assert_no_duplicates = assert_no_duplicates
     get_init_guess_ci = get_init_guess_ci
+    ci_to_det = ci_to_det
 
 class LASCISymm (casci_symm.CASCI, LASCINoSymm):
 
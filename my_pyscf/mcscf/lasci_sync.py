@@ -56,10 +56,16 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
     ugg = None
     converged = False
     ci1 = ci0
+    ci_tol = get_ci_conv_tol (las)
+    ci_hprev = [None for idx in range (las.nfrags)]
+    trust_radius = las.trust_radius
+    norm_gci_sub = None
+    H_op = x_rem = None
     t2 = (t1[0], t1[1])
     it = 0
     for it in range (las.max_cycle_macro):
-        e_cas, ci1 = ci_cycle (las, mo_coeff, ci1, veff, h2eff_sub, casdm1frs, log)
+        e_cas, ci1 = ci_cycle (las, mo_coeff, ci1, veff, h2eff_sub, casdm1frs, log,
+                               ci_tol=ci_tol, hprev=ci_hprev, norm_gci_sub=norm_gci_sub)
         if ugg is None: ugg = las.get_ugg (mo_coeff, ci1)
         log.info ('LASCI subspace CI energies: {}'.format (e_cas))
         t1 = log.timer ('LASCI ci_cycle', *t1)
@@ -75,6 +81,7 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
         if orbsym is not None:
             mo_coeff = lib.tag_array (mo_coeff, orbsym=orbsym)
         h2eff_sub[:,:] = umat.conj ().T @ h2eff_sub
+        if x_rem is not None: x_rem = _rotate_step (ugg, x_rem, umat)
 
         casdm1s_new = las.make_casdm1s_sub (ci=ci1)
         if not isinstance (las, _DFLASCI) or las.verbose > lib.logger.DEBUG:
@@ -91,8 +98,11 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
         casdm1s_sub = casdm1s_new
 
         t1 = log.timer ('LASCI get_veff after ci', *t1)
-        H_op = las.get_hop (ugg=ugg, mo_coeff=mo_coeff, ci=ci1, h2eff_sub=h2eff_sub, veff=veff,
-                            do_init_eri=False)
+        if H_op is None:
+            H_op = las.get_hop (ugg=ugg, mo_coeff=mo_coeff, ci=ci1, h2eff_sub=h2eff_sub,
+                                veff=veff, do_init_eri=False)
+        else:
+            H_op.update_(mo_coeff, ci1, h2eff_sub, veff=veff)
         g_vec = H_op.get_grad ()
         if las.verbose > lib.logger.INFO:
             g_orb_test, g_ci_test = las.get_grad (ugg=ugg, mo_coeff=mo_coeff, ci=ci1,
@@ -111,14 +121,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
             err = linalg.norm (g_ci_test - g_vec[ugg.nvar_orb:])
             assert (err < 1e-5), '{}'.format (err)
         gx = H_op.get_gx ()
-        prec_op = H_op.get_prec ()
-        prec = prec_op (np.ones_like (g_vec)) # Check for divergences
         norm_gorb = linalg.norm (g_vec[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
         norm_gci = linalg.norm (g_vec[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
         norm_gx = linalg.norm (gx) if gx.size else 0.0
-        x0 = prec_op._matvec (-g_vec)
-        norm_xorb = linalg.norm (x0[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
-        norm_xci = linalg.norm (x0[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
+        ncsf_frag = np.cumsum ([0,] + ugg.ncsf_sub.sum (1).tolist ()) + ugg.nvar_orb
+        norm_gci_sub = [linalg.norm (g_vec[i:j]) for i, j in zip (ncsf_frag[:-1], ncsf_frag[1:])]
+        ci_tol = get_ci_conv_tol (las, norm_gorb=norm_gorb, norm_gci_sub=norm_gci_sub)
         lib.logger.info (
             las, 'LASCI macro %d : E = %.15g ; |g_int| = %.15g ; |g_ci| = %.15g ; |g_x| = %.15g',
             it, H_op.e_tot, norm_gorb, norm_gci, norm_gx)
@@ -130,6 +138,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
             break
         H_op._init_eri_() 
         # ^ This is down here to save time in case I am already converged at initialization
+        # The preconditioner uses the ERIs, so it comes after
+        prec_op = H_op.get_prec ()
+        prec = prec_op (np.ones_like (g_vec)) # Check for divergences
+        x0 = get_warm_start (H_op, g_vec, prec_op, x_prev=x_rem)
+        norm_xorb = linalg.norm (x0[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
+        norm_xci = linalg.norm (x0[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
         t1 = log.timer ('LASCI Hessian constructor', *t1)
         microit = [0]
         last_x = [0]
@@ -176,33 +190,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
                                   maxiter=las.max_cycle_micro, callback=my_callback,
                                   M=prec_op)[0]
             t1 = log.timer ('LASCI {} microcycles'.format (microit[0]), *t1)
-            mo_coeff, ci1, h2eff_sub = H_op.update_mo_ci_eri (x, h2eff_sub)
-            t1 = log.timer ('LASCI Hessian update', *t1)
-
-            #veff = las.get_veff (mo_coeff=mo_coeff, ci=ci1)
-            veff = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo_coeff, ci=ci1))
-            veff = las.split_veff (veff, h2eff_sub, mo_coeff=mo_coeff, ci=ci1)
-            t1 = log.timer ('LASCI get_veff after secondorder', *t1)
         except MicroIterInstabilityException as e:
             log.info ('Unstable microiteration aborted: %s', str (e))
             x = last_x[0]
-            for i in range (3): # Make up to 3 attempts to scale-down x if necessary
-                mo2, ci2, h2eff_sub2 = H_op.update_mo_ci_eri (x, h2eff_sub)
-                t1 = log.timer ('LASCI Hessian update', *t1)
-                veff2 = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo2, ci=ci2))
-                veff2 = las.split_veff (veff2, h2eff_sub2, mo_coeff=mo2, ci=ci2)
-                t1 = log.timer ('LASCI get_veff after secondorder', *t1)
-                e2 = las.energy_nuc () + las.energy_elec (mo_coeff=mo2, ci=ci2, h2eff=h2eff_sub2,
-                                                          veff=veff2)
-                if e2 < H_op.e_tot:
-                    break
-                log.info ('New energy ({}) is higher than keyframe energy ({})'.format (
-                    e2, H_op.e_tot))
-                log.info ('Attempt {} of 3 to scale down trial step vector'.format (i+1))
-                x *= .5
-            mo_coeff, ci1, h2eff_sub, veff = mo2, ci2, h2eff_sub2, veff2
-
-
+        mo_coeff, ci1, h2eff_sub, veff, trust_radius, x_rem = trust_region_step (
+            las, H_op, x, h2eff_sub, trust_radius, log)
+        t1 = log.timer ('LASCI trust-region step', *t1)
 
         casdm1frs = las.states_make_casdm1s_sub (ci=ci1)
         casdm1s_sub = las.make_casdm1s_sub (ci=ci1)
@@ -243,8 +236,210 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
 
     return converged, e_tot, e_states, mo_energy, mo_coeff, e_cas, ci1, h2eff_sub, veff
 
-def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log):
+def trust_region_step (las, H_op, x, h2eff_sub, trust_radius, log):
+    ''' Move from the keyframe of H_op along the step vector x, with the step length controlled
+    by a trust radius that adapts to how well the quadratic model of H_op predicts the change
+    in energy. If the energy goes up, x is halved and only the energy is reevaluated (no CI
+    cycle and no new Hessian operator), up to 3 times.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        H_op : instance of :class:`LASCI_HessianOperator`
+            For the current keyframe
+        x : ndarray of shape (ugg.nvar_tot)
+            Step vector (usually the CG solution of H_op.x = -g)
+        h2eff_sub : ndarray of shape (nmo,ncas**2*(ncas+1)/2)
+            ERIs of the current keyframe
+        trust_radius : float
+            Maximum norm of x
+        log : instance of :class:`pyscf.lib.logger.Logger`
+
+    Returns:
+        mo_coeff, ci1, h2eff_sub, veff :
+            Orbitals, CI vectors, ERIs, and spin-separated effective potential after the step
+        trust_radius : float
+            Updated trust radius for the next macrocycle
+        x_rem : ndarray of shape (ugg.nvar_tot) or None
+            The part of x that was not taken, if the step was along x. If the quadratic model
+            were exact, this would be the solution of the next macrocycle's CG problem.
+    '''
+    ugg = H_op.ugg
+    g_vec = H_op.get_grad ()
+    x_cg = x
+    def model (x):
+        # Quadratic model along x, as in the kernel's microcycle callback:
+        # E(a) = H_op.e_tot + a * (xs.g) + a**2 * (xs.Hx) / 2
+        xorb, xci = ugg.unpack (x)
+        xci = [[x_s * las.weights[iroot] for iroot, x_s in enumerate (x_rs)] for x_rs in xci]
+        xs = ugg.pack (xorb, xci)
+        return xs.dot (g_vec), xs.dot (H_op._matvec (x)) / 2
+    norm_x = linalg.norm (x)
+    if norm_x > trust_radius:
+        log.info ('LASCI step |x| = %.6g scaled down to trust radius %.6g', norm_x, trust_radius)
+        x = x * (trust_radius / norm_x)
+        norm_x = trust_radius
+    de_lin, de_quad = model (x)
+    if de_lin + de_quad >= 0:
+        # Not a descent direction of the model (i.e., the Hessian is indefinite and CG found
+        # the wrong side of a saddle point): fall back to the Cauchy point
+        x = -g_vec
+        de_lin, de_quad = model (x)
+        alpha = trust_radius / linalg.norm (x)
+        if de_quad > 0: alpha = min (alpha, -de_lin / de_quad / 2)
+        x, de_lin, de_quad = alpha * x, alpha * de_lin, alpha * alpha * de_quad
+        norm_x = linalg.norm (x)
+        x_cg = None
+        log.info ('LASCI step is uphill in the quadratic model; Cauchy point |x| = %.6g', norm_x)
+    alpha = 1.0
+    for i in range (3):
+        mo2, ci2, h2eff_sub2 = H_op.update_mo_ci_eri (alpha*x, h2eff_sub)
+        veff2 = las.get_veff (dm1s = las.make_rdm1 (mo_coeff=mo2, ci=ci2))
+        veff2 = las.split_veff (veff2, h2eff_sub2, mo_coeff=mo2, ci=ci2)
+        e2 = las.energy_nuc () + las.energy_elec (mo_coeff=mo2, ci=ci2, h2eff=h2eff_sub2,
+                                                  veff=veff2)
+        de = e2 - H_op.e_tot
+        de_pred = alpha * de_lin + alpha * alpha * de_quad
+        ratio = de / de_pred if abs (de_pred) > 1e-14 else 1.0
+        log.info ('LASCI step |x| = %.6g : dE = %.6g ; predicted dE = %.6g ; ratio = %.3g',
+                  alpha*norm_x, de, de_pred, ratio)
+        accept = (de < 0) or (abs (de) < las.conv_tol_self)
+        if (not accept) or (ratio < 0.25):
+            trust_radius = max (0.5 * alpha * norm_x, las.conv_tol_grad)
+        elif (ratio > 0.75) and (alpha * norm_x > 0.8 * trust_radius):
+            trust_radius = min (2 * trust_radius, las.trust_radius_max)
+        x_taken = alpha * x
+        if accept: break
+        log.info ('New energy ({}) is higher than keyframe energy ({})'.format (e2, H_op.e_tot))
+        log.info ('Attempt {} of 3 to scale down trial step vector'.format (i+1))
+        alpha *= .5
+    log.debug ('LASCI trust radius = %.6g', trust_radius)
+    x_rem = None if x_cg is None else x_cg - x_taken
+    return mo2, ci2, h2eff_sub2, veff2, trust_radius, x_rem
+
+def _rotate_step (ugg, x, umat):
+    ''' Express the orbital part of a step vector in the MO basis mo_coeff @ umat and zero its
+    CI part, which doesn't survive the CI cycle '''
+    kappa, xci = ugg.unpack (x)
+    kappa = umat.conj ().T @ kappa @ umat
+    xci = [[np.zeros_like (x_s) for x_s in x_rs] for x_rs in xci]
+    return ugg.pack (kappa, xci)
+
+def get_warm_start (H_op, g_vec, prec_op, x_prev=None):
+    ''' Initial guess for the CG solution of H_op.x = -g_vec. This is the preconditioned
+    gradient, unless the previous macrocycle left part of its step untaken (x_prev), in which
+    case it is the minimum of the quadratic model of H_op in the span of both, at the cost of
+    two Hessian-vector products.
+
+    Args:
+        H_op : instance of :class:`LASCI_HessianOperator`
+        g_vec : ndarray of shape (ugg.nvar_tot)
+            Gradient
+        prec_op : instance of :class:`scipy.sparse.linalg.LinearOperator`
+            Preconditioner
+
+    Kwargs:
+        x_prev : ndarray of shape (ugg.nvar_tot) or None
+            Remainder of the previous step, in the current MO basis
+
+    Returns:
+        x0 : ndarray of shape (ugg.nvar_tot)
+    '''
+    x0 = prec_op._matvec (-g_vec)
+    if x_prev is None or not np.any (x_prev): return x0
+    basis = np.stack ([x0, x_prev], axis=0)
+    hbasis = np.stack ([H_op._matvec (b) for b in basis], axis=0)
+    hmat = basis.conj () @ hbasis.T
+    hmat = (hmat + hmat.conj ().T) / 2
+    try:
+        coeffs = linalg.solve (hmat, -basis.conj () @ g_vec, assume_a='pos')
+    except (linalg.LinAlgError, ValueError):
+        # Not positive-definite in this subspace
+        return x0
+    return coeffs @ basis
+
+def get_ci_conv_tol (las, norm_gorb=None, norm_gci_sub=None):
+    ''' Davidson energy thresholds for the fragment CI problems of the next macrocycle.
+
+    The CI vectors only need to be as accurate as the current keyframe, so the threshold of
+    each fragment follows the larger of the orbital gradient and that fragment's own CI gradient
+    (an inexact-Newton scheme): tol = (las.ci_conv_tol_scale * |g|)**2. It is squared because
+    the Davidson residual threshold defaults to sqrt (tol). The result is bounded from above by
+    las.ci_conv_tol_max and from below by the conv_tol of the fragment's CI solvers, so near
+    convergence the CI problems are solved exactly as tightly as requested.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+
+    Kwargs:
+        norm_gorb : float
+            Norm of the orbital-rotation gradient. If omitted (as in the first macrocycle),
+            the loosest threshold is returned.
+        norm_gci_sub : list of length nfrags of floats
+            Norms of the CI gradient of each fragment
+
+    Returns:
+        ci_tol : list of length nfrags of floats or None
+            None if las.ci_conv_tol_scale is 0 or None, in which case the CI solvers' own
+            conv_tol is always used.
+    '''
+    scale = getattr (las, 'ci_conv_tol_scale', None)
+    if not scale: return None
+    tol_max = las.ci_conv_tol_max
+    if norm_gci_sub is None: norm_gci_sub = [None for idx in range (las.nfrags)]
+    ci_tol = []
+    for fcibox, norm_gci in zip (las.fciboxes, norm_gci_sub):
+        tol_min = min ([solver.conv_tol for solver in fcibox.fcisolvers])
+        if norm_gorb is None or norm_gci is None:
+            tol = tol_max
+        else:
+            tol = min (tol_max, (scale * max (norm_gorb, norm_gci))**2)
+        ci_tol.append (max (tol, tol_min))
+    return ci_tol
+
+def _ci_skip (las, isub, h1e, eri_cas, hprev, norm_gci_sub):
+    ''' Whether the CI problem of fragment isub can be skipped in this macrocycle: its CI
+    gradient was converged at the last keyframe and its effective Hamiltonian has not changed
+    by more than las.ci_skip_tol since the fragment was last solved. Returns the maximum change in the
+    Hamiltonian, or None if the fragment has to be solved. '''
+    skip_tol = getattr (las, 'ci_skip_tol', None)
+    if (not skip_tol) or (hprev is None) or (hprev[isub] is None) or (norm_gci_sub is None):
+        return None
+    if norm_gci_sub[isub] >= las.conv_tol_grad: return None
+    h1e_prev, eri_prev = hprev[isub][:2]
+    h1e = np.asarray (h1e)
+    if h1e.shape != h1e_prev.shape: return None
+    dh = max (np.amax (np.abs (h1e - h1e_prev)), np.amax (np.abs (eri_cas - eri_prev)))
+    if dh >= skip_tol: return None
+    return dh
+
+def _ci_energy (fcibox, h1e, eri_cas, ncas, nelecas, ci):
+    ''' State-averaged expectation value of the fragment Hamiltonian; one H|ci> product
+    instead of a Davidson solve '''
+    h2eff = fcibox.states_absorb_h1e (h1e, eri_cas, ncas, nelecas, .5)
+    hc = fcibox.states_contract_2e (h2eff, ci, ncas, nelecas)
+    e_states = [c.ravel ().dot (h.ravel ()) for c, h in zip (ci, hc)]
+    return np.dot (e_states, fcibox.weights)
+
+def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log, ci_tol=None, hprev=None,
+              norm_gci_sub=None):
+    ''' Solve the CI problem of each fragment in the field of the other fragments
+
+    Kwargs:
+        ci_tol : list of length nfrags of floats
+            Davidson energy thresholds for each fragment (see get_ci_conv_tol). If None,
+            the CI solvers' own conv_tol is used.
+        hprev : list of length nfrags
+            Effective Hamiltonians of the fragments the last time they were solved, as
+            (h1e, eri_cas, CI vector shapes); modified in place. If provided together with
+            norm_gci_sub, fragments with a CI gradient below las.conv_tol_grad whose h1e and
+            eri_cas have changed by less than las.ci_skip_tol are not re-solved: ci0 is returned
+            for them instead, and their energy is the expectation value of ci0.
+        norm_gci_sub : list of length nfrags of floats
+            Norm of the CI gradient of each fragment at the keyframe of the previous
+            macrocycle, before the step that led to ci0, which is not evaluated again
+    '''
     if ci0 is None: ci0 = [None for idx in range (las.nfrags)]
+    if ci_tol is None: ci_tol = [None for idx in range (las.nfrags)]
     # CI problems
     t1 = (lib.logger.process_clock(), lib.logger.perf_counter())
     h1eff_sub = las.get_h1eff (mo, veff=veff, h2eff_sub=h2eff_sub, casdm1frs=casdm1frs)
@@ -280,12 +475,28 @@ def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log):
                 log.debug1 ("LASCI subspace {} state {} with wfnsym {}".format (isub, state,
                                                                                 wfnsym_str))
 
+        dh = None
+        if fcivec is not None and not any ([c is None for c in fcivec]):
+            dh = _ci_skip (las, isub, h1e, eri_cas, hprev, norm_gci_sub)
+        if dh is not None:
+            log.info ("LASCI subspace %d CI problem skipped (|g_ci| = %.3g ; |dH| = %.3g)",
+                      isub, norm_gci_sub[isub], dh)
+            fcivec = [c.reshape (shape) for c, shape in zip (fcivec, hprev[isub][2])]
+            e_cas.append (_ci_energy (fcibox, h1e, eri_cas, ncas, nelecas, fcivec))
+            ci1.append (fcivec)
+            continue
+        kwargs = {}
+        if ci_tol[isub] is not None:
+            log.info ("LASCI subspace %d CI conv_tol = %.3g", isub, ci_tol[isub])
+            kwargs['tol'] = ci_tol[isub]
         e_sub, fcivec = fcibox.kernel(h1e, eri_cas, ncas, nelecas,
                                       ci0=fcivec, verbose=log,
                                       max_memory=max_memory,
-                                      ecore=e0, orbsym=orbsym)
+                                      ecore=e0, orbsym=orbsym, **kwargs)
         e_cas.append (e_sub)
         ci1.append (fcivec)
+        if hprev is not None:
+            hprev[isub] = (np.asarray (h1e), eri_cas, [c.shape for c in fcivec])
         t1 = log.timer ('FCI box for subspace {}'.format (isub), *t1)
     return e_cas, ci1
 
@@ -342,6 +553,10 @@ class LASCI_UnitaryGroupGenerators (object):
         ci_transformer : sequence of shape (nfrags,nroots) of :class:`CSFTransformer`
             Element [i][j] transforms between single determinants and CSFs for the ith fragment in
             the jth state
+        ci_basis : sequence of shape (nfrags,nroots) of str
+            Element [i][j] is 'csf' if the CI vector of the ith fragment in the jth state is
+            stored in the CSF basis (see CSFFCISolver in mrh.my_pyscf.fci.csf), and 'det'
+            otherwise
         nvar_orb : int
             Total number of nonredundant orbital-rotation degrees of freedom
         ncsf_sub : ndarray of shape (nfrags,nroots)
@@ -383,6 +598,7 @@ class LASCI_UnitaryGroupGenerators (object):
 
     def _init_ci (self, las, mo_coeff, ci):
         self.ci_transformers = []
+        self.ci_basis = []
         for norb, nelec, fcibox in zip (las.ncas_sub, las.nelecas_sub, las.fciboxes):
             tf_list = []
             for solver in fcibox.fcisolvers:
@@ -391,12 +607,16 @@ class LASCI_UnitaryGroupGenerators (object):
                 solver.check_transformer_cache ()
                 tf_list.append (solver.transformer)
             self.ci_transformers.append (tf_list)
+            self.ci_basis.append ([getattr (s, 'ci_basis', 'det') for s in fcibox.fcisolvers])
 
     def pack (self, kappa, ci_sub):
         x = kappa[self.uniq_orb_idx]
-        for trans_frag, ci_frag in zip (self.ci_transformers, ci_sub):
-            for transformer, ci in zip (trans_frag, ci_frag):
-                x = np.append (x, transformer.vec_det2csf (ci, normalize=False))
+        for trans_frag, basis_frag, ci_frag in zip (self.ci_transformers, self.ci_basis, ci_sub):
+            for transformer, basis, ci in zip (trans_frag, basis_frag, ci_frag):
+                if basis == 'csf':
+                    x = np.append (x, transformer.pack_csf (ci))
+                else:
+                    x = np.append (x, transformer.vec_det2csf (ci, normalize=False))
         assert (x.shape[0] == self.nvar_tot)
         return x
 
@@ -407,11 +627,14 @@ class LASCI_UnitaryGroupGenerators (object):
 
         y = x[self.nvar_orb:]
         ci_sub = []
-        for trans_frag in self.ci_transformers:
+        for trans_frag, basis_frag in zip (self.ci_transformers, self.ci_basis):
             ci_frag = []
-            for transformer in trans_frag:
+            for transformer, basis in zip (trans_frag, basis_frag):
                 ncsf = transformer.ncsf
-                ci_frag.append (transformer.vec_csf2det (y[:ncsf], normalize=False))
+                if basis == 'csf':
+                    ci_frag.append (transformer.unpack_csf (y[:ncsf]))
+                else:
+                    ci_frag.append (transformer.vec_csf2det (y[:ncsf], normalize=False))
                 y = y[ncsf:]
             ci_sub.append (ci_frag)
 
@@ -478,6 +701,7 @@ class LASCISymm_UnitaryGroupGenerators (LASCI_UnitaryGroupGenerators):
         sub_slice = np.cumsum ([0] + las.ncas_sub.tolist ()) + las.ncore
         orbsym_sub = [orbsym[i:sub_slice[isub+1]] for isub, i in enumerate (sub_slice[:-1])]
         self.ci_transformers = []
+        self.ci_basis = []
         for norb, nelec, orbsym, fcibox in zip (las.ncas_sub, las.nelecas_sub, orbsym_sub,
                                                 las.fciboxes):
             tf_list = []
@@ -489,6 +713,7 @@ class LASCISymm_UnitaryGroupGenerators (LASCI_UnitaryGroupGenerators):
                 solver.check_transformer_cache ()
                 tf_list.append (solver.transformer)
             self.ci_transformers.append (tf_list)
+            self.ci_basis.append ([getattr (s, 'ci_basis', 'det') for s in fcibox.fcisolvers])
 
 def _init_df_(h_op):
     from mrh.my_pyscf.mcscf.lasci import _DFLASCI
@@ -641,6 +866,96 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         # turn this off for extra optimization in kernel
         if do_init_eri: self._init_eri_()
 
+    def update_(self, mo_coeff, ci, h2eff_sub, veff=None, casdm1frs=None, casdm2fr=None):
+        ''' Move this operator to a new keyframe in place, instead of constructing a new one.
+        The density matrices, effective Hamiltonian, and CI-dependent intermediates are
+        recomputed, as in the constructor, but the FCI linkstr arrays are kept, and the
+        ERI-dependent intermediates are carried over by _update_eri_, which rotates them into
+        the new MO basis if possible and discards them otherwise. Either way, call _init_eri_
+        afterwards before using the operator.
+
+        Args:
+            mo_coeff : ndarray of shape (nao,nmo)
+                Molecular orbitals for the new keyframe
+            ci : list (length = nfrags) of lists (length = nroots) of ndarrays
+                CI vectors for the new keyframe
+            h2eff_sub : ndarray of shape (nmo,ncas**2*(ncas+1)/2)
+                ERIs (p1a1|a2a3) for the new keyframe
+
+        Kwargs:
+            veff, casdm1frs, casdm2fr :
+                Same as the corresponding constructor kwargs. If veff is not provided, it is
+                built from the AO basis, not from the carried-over bPpj, which is approximate
+
+        Returns:
+            self
+        '''
+        las = self.las
+        if casdm1frs is None: casdm1frs = las.states_make_casdm1s_sub (ci=ci,
+            ncas_sub=self.ncas_sub, nelecas_sub=self.nelecas_sub)
+        if casdm2fr is None: casdm2fr = las.states_make_casdm2_sub (ci=ci,
+            ncas_sub=self.ncas_sub, nelecas_sub=self.nelecas_sub)
+        self._update_eri_(mo_coeff)
+        self.mo_coeff = mo_coeff
+        self.ci = [[c.ravel () for c in cr] for cr in ci]
+        self._Horb_aa = None
+        self._init_dms_(casdm1frs, casdm2fr)
+        if veff is None:
+            # _init_ham_ would build veff from bPpj, which determines the gradient
+            veff = las.get_veff (dm1s = np.dot (mo_coeff, np.dot (self.dm1s.sum (0),
+                                                                  mo_coeff.conjugate ().T)))
+            veff = las.split_veff (veff, h2eff_sub, mo_coeff=mo_coeff,
+                                   casdm1s_sub=self.casdm1fs)
+        self._init_ham_(h2eff_sub, veff)
+        self._init_orb_()
+        self._init_ci_()
+        return self
+
+    def _update_eri_(self, mo_coeff):
+        ''' Rotate bPpj from the MO basis of the current keyframe into that of mo_coeff by a
+        low-rank update.
+
+        With U = mo_old^H S mo_new = 1 + D, (P|p'j') = U^H_p'q (P|qr) U_rj'. D is factorized by
+        SVD and singular values below las.hop_update_tol/100 are dropped, so near convergence,
+        when D is small, the cost is proportional to its rank instead of nmo. If the rank
+        exceeds nmo/4, rebuilding bPpj from the AOs is cheaper, and bPpj is discarded instead.
+        Only (P|qr) with at least one occupied index is stored, so the term with both q and r
+        virtual is missing; its error is first order in the virtual-occupied block of U. update_
+        never builds veff from the rotated bPpj, so it enters only the Hessian, not the
+        gradient, and these errors only affect the rate of convergence. bPpj is discarded when
+        their sum, accumulated over keyframes, exceeds las.hop_update_tol. Discarded bPpj is
+        rebuilt by _init_eri_.
+        '''
+        self._bPvv_diag = None
+        if self.bPpj is None: return
+        nocc, nmo = self.nocc, self.nmo
+        tol = self.las.hop_update_tol
+        umat = self.mo_coeff.conj ().T @ self.las._scf.get_ovlp () @ mo_coeff
+        lvecs, svals, rvecsH = linalg.svd (umat - np.eye (nmo))
+        rank = np.count_nonzero (svals > tol/100)
+        self._bPpj_err = getattr (self, '_bPpj_err', 0.0)
+        self._bPpj_err += np.amax (np.abs (umat[nocc:,:nocc]), initial=0)
+        self._bPpj_err += np.amax (svals[rank:], initial=0)
+        lib.logger.debug (self.las, 'bPpj update: rank %d of %d; accumulated error %.3g', rank,
+                          nmo, self._bPpj_err)
+        if (self._bPpj_err > tol) or (4*rank > nmo):
+            self.bPpj = None
+            self._bPpj_err = 0.0
+            return
+        if not rank: return
+        lvecs = lvecs[:,:rank] * svals[None,:rank]
+        rvecs = rvecsH[:rank].conj ().T
+        # D = lvecs @ rvecs^H. First index j: (P|q j') = (P|q j) + (P|q r) D_rj', where
+        # (P|q r) = (P|r q) is available for occupied q and virtual r
+        bPpj = self.bPpj
+        bPpk = np.dot (bPpj, lvecs[:nocc])
+        bPpk[:,:nocc,:] += np.dot (bPpj[:,nocc:,:].transpose (0,2,1), lvecs[nocc:])
+        bPpj = bPpj + np.dot (bPpk, rvecs[:nocc].conj ().T)
+        # Second index p: (P|p' j') = (P|p' j') + D^H_p'q (P|q j')
+        bPkj = np.matmul (lvecs.conj ().T, bPpj)
+        bPpj += np.matmul (rvecs, bPkj)
+        self.bPpj = bPpj
+
     def _init_dms_(self, casdm1frs, casdm2fr):
         las, ncore, nocc = self.las, self.ncore, self.nocc
         self.casdm1frs = casdm1frs 
@@ -735,11 +1050,12 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
 
     def _init_ci_(self):
         ci, ncas_sub, nelecas_sub = self.ci, self.ncas_sub, self.nelecas_sub
-        self.linkstrl = []
-        self.linkstr = []
-        for fcibox, no, ne in zip (self.fciboxes, ncas_sub, nelecas_sub):
-            self.linkstrl.append (fcibox.states_gen_linkstr (no, ne, True)) 
-            self.linkstr.append (fcibox.states_gen_linkstr (no, ne, False))
+        if not hasattr (self, 'linkstr'): # update_ keeps them
+            self.linkstrl = []
+            self.linkstr = []
+            for fcibox, no, ne in zip (self.fciboxes, ncas_sub, nelecas_sub):
+                self.linkstrl.append (fcibox.states_gen_linkstr (no, ne, True))
+                self.linkstr.append (fcibox.states_gen_linkstr (no, ne, False))
         self.hci0 = self.Hci_all (None, self.h1frs, self.eri_cas, ci)
         self.e0 = [[hc.dot (c) for hc, c in zip (hcr, cr)] for hcr, cr in zip (self.hci0, ci)]
         self.hci0 = [[hc - c*e for hc, c, e in zip (hcr, cr, er)]
@@ -1206,7 +1522,32 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         # We can't mask everything, because that behavior would obfuscate the problem
         # If NO stable D.O.F. exist, then keyframe is just bad and it has to be handled upstream
         if np.count_nonzero (~idx_unstable): Hdiag[idx_unstable] = np.inf
-        return sparse_linalg.LinearOperator (self.shape,matvec=(lambda x:x/Hdiag),dtype=self.dtype)
+        prec_aa = None
+        if getattr (self.las, 'prec_dense_aa', False):
+            prec_aa = self._get_prec_aa (idx_unstable)
+        if prec_aa is None:
+            return sparse_linalg.LinearOperator (self.shape,matvec=(lambda x:x/Hdiag),
+                                                 dtype=self.dtype)
+        idx_aa, cf_aa = prec_aa
+        def prec_op (x):
+            y = x/Hdiag
+            y[idx_aa] = linalg.cho_solve (cf_aa, x[idx_aa])
+            return y
+        return sparse_linalg.LinearOperator (self.shape,matvec=prec_op,dtype=self.dtype)
+
+    def _get_prec_aa (self, idx_unstable):
+        ''' Cholesky factor of the (level-shifted) active-active block of the orbital-rotation
+        Hessian, to invert that block exactly in the preconditioner. Returns None (i.e., use the
+        diagonal) if the block is empty, has any masked degrees of freedom, or isn't positive-
+        definite. '''
+        idx_aa, Horb_aa = self._get_Horb_aa ()
+        if (not len (idx_aa)) or np.any (idx_unstable[idx_aa]): return None
+        Horb_aa = Horb_aa + self.ah_level_shift * np.eye (len (idx_aa))
+        try:
+            cf_aa = linalg.cho_factor (Horb_aa)
+        except linalg.LinAlgError:
+            return None
+        return idx_aa, cf_aa
 
     def _get_Horb_diag (self):
         fock = np.stack ([np.diag (h) for h in list (self.h1s)], axis=0)
@@ -1214,10 +1555,108 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         Horb_diag = sum ([np.multiply.outer (f,n) for f,n in zip (fock, num)])
         Horb_diag -= np.diag (self.fock1)[None,:]
         Horb_diag += Horb_diag.T
-        # This is where I stop unless I want to add the split-c and split-x terms
-        # Split-c and split-x, for inactive-external rotations, requires I calculate a bunch
-        # of extra eris (g^aa_ii, g^ai_ai)
-        return Horb_diag[self.ugg.uniq_orb_idx]
+        # Split-c and split-x terms: the response of veff to the rotation of the 1-RDM,
+        # sum_s c_s veff'_s[p,q] with c_s = n_qs - n_ps and
+        # veff'_s[p,q] = 2 (c_a + c_b) (pq|pq) - c_s ((pp|qq) + (pq|pq)).
+        # Only where both (pp|qq) and (pq|pq) are available (see _get_eri_diag); without
+        # density fitting, inactive-external rotations in particular still go without.
+        jdiag, kdiag = self._get_eri_diag ()
+        c = num[:,None,:] - num[:,:,None]
+        Horb_2e = (2*(c.sum (0)**2) - (c*c).sum (0)) * kdiag - (c*c).sum (0) * jdiag
+        Horb_2e[np.isnan (Horb_2e)] = 0.0
+        Horb_diag += Horb_2e
+        Horb_diag = Horb_diag[self.ugg.uniq_orb_idx]
+        # Active-active rotations: the exact diagonal is cheap
+        idx_aa, Horb_aa = self._get_Horb_aa ()
+        Horb_diag[idx_aa] = np.diag (Horb_aa)
+        return Horb_diag
+
+    def _get_Horb_aa (self):
+        ''' Exact block of the orbital-rotation Hessian between active-active (inter-fragment)
+        rotations. The first-order densities of these rotations are confined to the active
+        space, so unlike the rest of the orbital-rotation Hessian this block only requires
+        quantities with active-orbital indices.
+
+        Returns:
+            idx_aa : ndarray of ints
+                Positions of the active-active rotations in the orbital sector of the packed
+                step vector
+            Horb_aa : ndarray of shape (len (idx_aa), len (idx_aa))
+        '''
+        ncore, nocc = self.ncore, self.nocc
+        orb_idx = np.argwhere (self.ugg.uniq_orb_idx)
+        is_aa = np.all ((orb_idx >= ncore) & (orb_idx < nocc), axis=1)
+        idx_aa = np.where (is_aa)[0]
+        if getattr (self, '_Horb_aa', None) is not None: return idx_aa, self._Horb_aa
+        p, q = (orb_idx[is_aa] - ncore).T
+        ncas = self.ncas
+        h1s = self.h1s[:,ncore:nocc,ncore:nocc]
+        fock1 = self.fock1[ncore:nocc,ncore:nocc]
+        Horb_aa = np.zeros ((len (idx_aa), len (idx_aa)), dtype=self.dtype)
+        for col, (r, t) in enumerate (zip (p, q)):
+            # Same as orbital_response and get_veff_Heff, but in the active space only
+            kappa = np.zeros ((ncas, ncas), dtype=self.dtype)
+            kappa[r,t], kappa[t,r] = 1, -1
+            edm1s = -np.dot (self.casdm1s, kappa)
+            edm1s += edm1s.transpose (0,2,1)
+            ecm2 = np.zeros_like (self.cascm2)
+            ecm2[:,:,:,t] = -self.cascm2[:,:,:,r]
+            ecm2[:,:,:,r] = self.cascm2[:,:,:,t]
+            ecm2 += ecm2.transpose (1,0,3,2)
+            ecm2 += ecm2.transpose (2,3,0,1)
+            vj = np.tensordot (self.eri_cas, edm1s.sum (0), axes=2)
+            vk = np.tensordot (edm1s, self.eri_cas, axes=((1,2),(1,2)))
+            fock1_prime = h1s[0] @ edm1s[0] + h1s[1] @ edm1s[1]
+            fock1_prime += (vj - vk[0]) @ self.casdm1s[0] + (vj - vk[1]) @ self.casdm1s[1]
+            fock1_prime += np.tensordot (self.eri_cas, ecm2, axes=((1,2,3),(1,2,3)))
+            fock1_prime += (np.dot (fock1, kappa) - np.dot (kappa, fock1)) / 2
+            Horb_aa[:,col] = (fock1_prime - fock1_prime.T)[p,q]
+        self._Horb_aa = Horb_aa
+        return idx_aa, Horb_aa
+
+    def _get_eri_diag (self):
+        ''' Coulomb-like (pp|qq) and exchange-like (pq|pq) ERIs for the diagonal of the
+        orbital-rotation Hessian, taken from eri_cas and, if it has been initialized, bPpj.
+        Elements that can't be had for free are nan. With bPpj, all elements with at least one
+        occupied index are available; those with an external index p also need (P|pp) (see
+        _get_bPvv_diag).
+
+        Returns:
+            jdiag : ndarray of shape (nmo,nmo)
+                (pp|qq)
+            kdiag : ndarray of shape (nmo,nmo)
+                (pq|pq)
+        '''
+        nmo, ncore, nocc = self.nmo, self.ncore, self.nocc
+        jdiag = np.full ((nmo,nmo), np.nan)
+        kdiag = np.full ((nmo,nmo), np.nan)
+        jdiag[ncore:nocc,ncore:nocc] = np.einsum ('ppqq->pq', self.eri_cas)
+        kdiag[ncore:nocc,ncore:nocc] = np.einsum ('pqpq->pq', self.eri_cas)
+        if self.bPpj is not None:
+            bPjj = np.einsum ('Pjj->Pj', self.bPpj[:,:nocc,:])
+            bPpp = np.append (bPjj, self._get_bPvv_diag (), axis=1)
+            jdiag[:,:nocc] = np.dot (bPpp.T, bPjj)
+            kdiag[:,:nocc] = np.einsum ('Ppj,Ppj->pj', self.bPpj, self.bPpj)
+            jdiag[:nocc,:] = jdiag[:,:nocc].T
+            kdiag[:nocc,:] = kdiag[:,:nocc].T
+        return jdiag, kdiag
+
+    def _get_bPvv_diag (self):
+        ''' (P|aa) for the external orbitals a, in one pass over the AO-basis 3-index tensor.
+        It is only built the first time the preconditioner needs it after bPpj changes. '''
+        if getattr (self, '_bPvv_diag', None) is not None: return self._bPvv_diag
+        mo_ext = self.mo_coeff[:,self.nocc:]
+        nao, nvirt = mo_ext.shape
+        bPvv = np.empty ((self.with_df.get_naoaux (), nvirt), dtype=mo_ext.dtype)
+        b0 = 0
+        for eri1 in self.with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            eri1 = lib.unpack_tril (eri1).reshape ((b1-b0)*nao, nao)
+            eri1 = np.dot (eri1, mo_ext).reshape (b1-b0, nao, nvirt)
+            bPvv[b0:b1] = np.einsum ('Pma,ma->Pa', eri1, mo_ext.conj ())
+            b0 = b1
+        self._bPvv_diag = bPvv
+        return bPvv
 
     def _get_Hci_diag (self):
         Hci_diag = []
@@ -1269,20 +1708,25 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         return ci1
 
     def _update_h2eff_sub (self, mo1, umat, h2eff_sub):
+        ''' Rotate the (p1a1|a2a3) ERIs without leaving the lower-triangular packed storage of
+        a2a3, except in blocks of p1 sized to fit into the available memory '''
         ncore, ncas, nocc, nmo = self.ncore, self.ncas, self.nocc, self.nmo
+        npair = ncas*(ncas+1)//2
         ucas = umat[ncore:nocc, ncore:nocc]
         bmPu = None
         if hasattr (h2eff_sub, 'bmPu'): bmPu = h2eff_sub.bmPu
-        h2eff_sub = h2eff_sub.reshape (nmo*ncas, ncas*(ncas+1)//2)
-        h2eff_sub = lib.numpy_helper.unpack_tril (h2eff_sub)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas, ncas)
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(1))) # bpaa
-        h2eff_sub = np.tensordot (umat, h2eff_sub, axes=((0),(1))) # qbaa
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbab
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbbb
-        ix_i, ix_j = np.tril_indices (ncas)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas*ncas)
-        h2eff_sub = h2eff_sub[:,:,(ix_i*ncas)+ix_j]
+        # p1: one GEMM
+        h2eff_sub = np.dot (umat.T, np.asarray (h2eff_sub).reshape (nmo, ncas*npair))
+        h2eff_sub = h2eff_sub.reshape (nmo, ncas, npair)
+        # a1 and a2a3: unpack only a block of p1 at a time
+        max_memory = max (400, self.las.max_memory-lib.current_memory ()[0])
+        blksize = int (max (1, min (nmo, max_memory*1e6/8/(3*ncas**3))))
+        for p0 in range (0, nmo, blksize):
+            p1 = min (nmo, p0+blksize)
+            h2blk = np.matmul (ucas.T, h2eff_sub[p0:p1])
+            h2blk = lib.unpack_tril (h2blk.reshape ((p1-p0)*ncas, npair))
+            h2blk = np.matmul (np.matmul (ucas.T, h2blk), ucas)
+            h2eff_sub[p0:p1] = lib.pack_tril (h2blk).reshape (p1-p0, ncas, npair)
         h2eff_sub = h2eff_sub.reshape (nmo, -1)
         if bmPu is not None:
             bmPu = np.dot (bmPu, ucas)
@@ -46,7 +46,7 @@ def kernel (las, mo_coeff=None, ci0=None, conv_tol_grad=1e-4,
     nfrags = len (las.ncas_sub)
     for it in range (las.max_cycle_macro):
         pass
-        # 1. Divide into fragments
+        # 1. Divide into fragments (lasscf_async_crunch.update_impurity_heff_)
         # 2. CASSCF on each fragment
         # 3. Combine from fragments
 
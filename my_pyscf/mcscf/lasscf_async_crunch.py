@@ -1,20 +1,28 @@
+import numpy as np
+import copy
+import h5py
+import tempfile
+from scipy import linalg
 from pyscf import gto, scf, mcscf, ao2mo, lib
 from pyscf.fci.direct_spin1 import _unpack_nelec
 
 class ImpurityMole (gto.Mole):
-    def __init__(self, las, nelec_imp):
+    def __init__(self, las, imporb_coeff, nelec_imp, stdout=None, output=None):
+        gto.Mole.__init__(self)
         self._las = las
         self.verbose = las.verbose
         self.max_memory = las.max_memory
-        self._update_nelec_imp_(nelec_imp)
+        # Placeholder atom; the electron count is set by _update_space after build
         self.atom.append (('H', (0, 0, 0)))
+        self.spin = 1
         if stdout is None and output is None:
             self.stdout = las.stdout
-        elif stdout is not None
+        elif stdout is not None:
             self.stdout = stdout
         elif output is not None:
             self.output = output
         self.build ()
+        self._update_space (imporb_coeff, nelec_imp)
 
     def _update_space (self, imporb_coeff, nelec_imp):
         self._imporb_coeff = imporb_coeff
@@ -26,33 +34,79 @@ class ImpurityMole (gto.Mole):
     def nao_nr (self): return self._imporb_coeff.shape[-1]
     def nao (self): return self._imporb_coeff.shape[-1]
 
+def make_impurity_cderi (las, imporb_coeffs, erifile=None):
+    ''' Transform the DF 3-index tensor of las into the impurity-orbital bases of all
+    fragments at once, in a single pass over the parent tensor, and write the results to
+    one on-disk dataset per fragment, so that the memory footprint doesn't depend on the
+    number of fragments.
+
+    Args:
+        las : instance of :class:`LASCINoSymm` with density fitting
+        imporb_coeffs : list of length nfrags of ndarrays of shape (nao,nimp[i])
+            Impurity orbitals of each fragment
+
+    Kwargs:
+        erifile : str or file object
+            HDF5 file to write to. Defaults to a temporary file in lib.param.TMPDIR, which is
+            deleted when the returned object is garbage-collected.
+
+    Returns:
+        erifile : str or file object
+            Same as the kwarg; keep a reference to it while the datasets are in use
+        datanames : list of length nfrags of str
+            Names of the datasets of shape (naux,nimp[i]*(nimp[i]+1)//2) in erifile
+    '''
+    with_df = las._scf.with_df
+    if erifile is None: erifile = tempfile.NamedTemporaryFile (dir=lib.param.TMPDIR)
+    naux = with_df.get_naoaux ()
+    nao = imporb_coeffs[0].shape[0]
+    dtype = np.result_type (*imporb_coeffs)
+    mos = [ao2mo.incore._conc_mos (c, c, compact=True) for c in imporb_coeffs]
+    npairs = [mij_pair for ijmosym, mij_pair, moij, ijslice in mos]
+    datanames = ['j3c_imp/{}'.format (ifrag) for ifrag in range (len (imporb_coeffs))]
+    # One block of the parent tensor and of every impurity tensor in memory at a time
+    mem_avail = max (las.max_memory - lib.current_memory ()[0], 1)
+    blksize = int (mem_avail*1e6/8/(nao*(nao+1)//2 + sum (npairs)))
+    blksize = max (1, min (blksize, with_df.blockdim, naux))
+    with h5py.File (getattr (erifile, 'name', erifile), 'w') as f:
+        dsets = [f.create_dataset (name, (naux, npair), dtype)
+                 for name, npair in zip (datanames, npairs)]
+        b0 = 0
+        for eri1 in with_df.loop (blksize):
+            b1 = b0 + eri1.shape[0]
+            for dset, (ijmosym, mij_pair, moij, ijslice) in zip (dsets, mos):
+                dset[b0:b1] = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2',
+                                                  mosym=ijmosym)
+            b0 = b1
+    return erifile, datanames
+
 class ImpuritySCF (scf.hf.SCF):
-    def _update_heff_(self, veff, dm1s, de=0):
+    def _update_heff_(self, veff, dm1s, de=0, cderi=None):
+        ''' cderi is (erifile, dataname), one fragment's share of the return value of
+        make_impurity_cderi, which should be called once for all fragments, as
+        update_impurity_heff_ does. If it is omitted when the LAS object uses density fitting,
+        this impurity's tensor is made by itself. '''
         imporb_coeff = self.mol.get_imporb_coeff ()
         nimp = self.mol.nao ()
         mf = self.mol._las._scf
         # Two-electron integrals
-        if hasattr (mf, '_eri'):
+        if getattr (mf, '_eri', None) is not None:
             self._eri = ao2mo.full (mf._eri, imporb_coeff, 4)
         if hasattr (mf, 'with_df'):
-            # TODO: impurity outcore cderi
-            self.with_df._cderi = np.empty ((mf.with_df.get_naoaux (), nimp*(nimp+1)//2),
-                                            dtype=imporb_coeff.dtype)
-            ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (imporb_coeff, imporb_coeff,
-                                                                        compact=True)
-            b0 = 0
-            for eri1 in mf.with_df.loop ():
-                b1 = b0 + eri1.shape[0]
-                eri2 = self._cderi[b0:b1]
-                eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym,
-                                           out=eri2)
-                b0 = b1
+            if cderi is None:
+                erifile, datanames = make_impurity_cderi (self.mol._las, [imporb_coeff])
+                cderi = (erifile, datanames[0])
+            erifile, dataname = cderi
+            # Read lazily by with_df.loop
+            self._imporb_erifile = erifile
+            self.with_df._cderi = getattr (erifile, 'name', erifile)
+            self.with_df._dataname = dataname
         # External mean-field; potentially spin-broken
         h1s = mf.get_hcore ()[None,:,:] + veff
         h1s = np.dot (imporb_coeff.conj ().T, np.dot (h1s, imporb_coeff)).transpose (1,0,2)
         smo = mf.get_ovlp () @ imporb_coeff
         dm1s = np.dot (smo.conj ().T, np.dot (dm1s, smo)).transpose (1,0,2)
-        vj, vk = self.get_jk (dm1s)
+        vj, vk = self.get_jk (self.mol, dm1s)
         veff1 = vj.sum (0)[None,:,:] - vk
         h1s -= veff1
         self._imporb_h1 = h1s.sum (0) / 2
@@ -112,6 +166,31 @@ def ImpurityHF (mol):
     if mol.spin == 0: return ImpurityRHF (mol)
     else: return ImpurityROHF (mol)
 
+def update_impurity_heff_(imp_scfs, veff, dm1s, erifile=None):
+    ''' Update the effective Hamiltonians of the impurity SCF objects of all fragments for a
+    new keyframe. With density fitting, their 3-index tensors are made together by
+    make_impurity_cderi, in a single pass over that of the LAS object.
+
+    Args:
+        imp_scfs : list of length nfrags of :class:`ImpuritySCF`
+        veff : ndarray of shape (2,nao,nao)
+            Spin-separated effective potential of the whole molecule
+        dm1s : ndarray of shape (2,nao,nao)
+            Spin-separated 1-RDM of the whole molecule
+
+    Kwargs:
+        erifile : str or file object
+            Passed to make_impurity_cderi
+    '''
+    las = imp_scfs[0].mol._las
+    cderis = [None,]*len (imp_scfs)
+    if hasattr (las._scf, 'with_df'):
+        imporb_coeffs = [imp_scf.mol.get_imporb_coeff () for imp_scf in imp_scfs]
+        erifile, datanames = make_impurity_cderi (las, imporb_coeffs, erifile=erifile)
+        cderis = [(erifile, dataname) for dataname in datanames]
+    for imp_scf, cderi in zip (imp_scfs, cderis):
+        imp_scf._update_heff_(veff, dm1s, cderi=cderi)
+
 # Monkeypatch the monkeypatch from mc1step.py
 def _fake_h_for_fast_casci(casscf, mo, eris):
     mc = copy.copy(casscf)
@@ -121,13 +200,13 @@ def _fake_h_for_fast_casci(casscf, mo, eris):
 
     mo_core = mo[:,:ncore]
     mo_cas = mo[:,ncore:nocc]
-    core_dm = numpy.dot(mo_core, mo_core.T) * 2
+    core_dm = np.dot(mo_core, mo_core.T) * 2
     hcore = casscf.get_hcore()
     hcore_sz = casscf._scf.get_hcore_sz()
     hcore = np.stack ([hcore+hcore_sz, hcore-hcore_sz], axis=0)
     hcore = hcore[None,:,:,:] + casscf.get_hcore_cishift ()
     energy_core = casscf.energy_nuc()
-    energy_core += numpy.einsum('ij,ji', core_dm, hcore)
+    energy_core += np.einsum('ij,ji', core_dm, hcore)
     energy_core += eris.vhf_c[:ncore,:ncore].trace()
     h1eff = np.tensordot (mo_cas.conj (), np.dot (hcore, mo_cas), axes=((0),(2))).transpose (1,2,0,3)
     h1eff += eris.vhf_c[None,None,ncore:nocc,ncore:nocc]
@@ -140,7 +219,7 @@ def _fake_h_for_fast_casci(casscf, mo, eris):
 
 
 # This is the really tricky part
-def ImpurityCASSCF (mcscf.mc1step.CASSCF):
+class ImpurityCASSCF (mcscf.mc1step.CASSCF):
 
     def _update_keyframe (self, mo_coeff, ci):
         # Project mo_coeff and ci keyframe into impurity space and cache
@@ -148,7 +227,7 @@ def ImpurityCASSCF (mcscf.mc1step.CASSCF):
         mf = las._scf
         ifrag = self._ifrag
         imporb_coeff = self.mol.get_imporb_coeff ()
-        self.ci = ci[_ifrag]
+        self.ci = ci[ifrag]
         # Inactive orbitals
         mo_core = mo_coeff[:,:las.ncore]
         s0 = mf.get_ovlp ()
@@ -158,8 +237,8 @@ def ImpurityCASSCF (mcscf.mc1step.CASSCF):
         self.ncore = np.count_nonzero (np.isclose (svals, 1))
         # Active and virtual orbitals (note self.ncas must be set at construction)
         nocc = self.ncore + self.ncas
-        i = las.ncore + sum (las.ncas_sub[:_ifrag])
-        j = i + las.ncas_sub[_ifrag]
+        i = las.ncore + sum (las.ncas_sub[:ifrag])
+        j = i + las.ncas_sub[ifrag]
         mo_las = mo_coeff[:,i:j]
         ovlp = (imporb_coeff @ self.mo_coeff[:,self.ncore:]).conj ().T @ s0 @ mo_las
         u, svals, vh = linalg.svd (ovlp)
@@ -217,8 +296,8 @@ def ImpurityCASSCF (mcscf.mc1step.CASSCF):
             bPuu = np.tensordot (bPmu, mo_ext, axes=((1),(0)))
             return np.tensordot (bPuu, dm1rs_ext, axes=((1,2),(-2,-1)))
         else: # Safety case: AO-basis SCF driver
-            output_shape = list (dm1rs.shape[:-2]) + [self.mol.nao (), self.mol.nao ()]
-            dm1 = dm1rs.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
+            output_shape = list (dm1rs_ext.shape[:-2]) + [self.mol.nao (), self.mol.nao ()]
+            dm1 = dm1rs_ext.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
             dm1 = np.dot (mo_ext.conj ().T, np.dot (dm1, mo_ext)).transpose (1,0,2)
             return self.mol._las.scf.get_j (dm1).reshape (*output_shape)
 
@@ -229,8 +308,8 @@ def ImpurityCASSCF (mcscf.mc1step.CASSCF):
             vuPi = np.tensordot (dm1rs_ext, bPiu, axes=((-1),(-1)))
             return np.tensordot (bPiu, vuPi, axes=((0,2),(-2,-3)))
         else: # Safety case: AO-basis SCF driver
-            output_shape = list (dm1rs.shape[:-2]) + [self.mol.nao (), self.mol.nao ()]
-            dm1 = dm1rs.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
+            output_shape = list (dm1rs_ext.shape[:-2]) + [self.mol.nao (), self.mol.nao ()]
+            dm1 = dm1rs_ext.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
             dm1 = np.dot (mo_ext.conj ().T, np.dot (dm1, mo_ext)).transpose (1,0,2)
             return self.mol._las.scf.get_k (dm1).reshape (*output_shape)
             
@@ -246,8 +325,8 @@ def ImpurityCASSCF (mcscf.mc1step.CASSCF):
         mo_cas = mo_coeff[:,ncore:][:,:ncas]
         h1_avg_sz = mo_cas.conj ().T @ self._scf.get_hcore_sz () @ mo_cas
         h1_avg = np.stack ([h1_avg_spinless + h1_avg_sz, h1_avg_spinless - h1_avg_sz], axis=0)
-        h1 += mo_cas.conj ().T @ self.get_hcore_cishift () @ mo_cas
-        return h1, energy_core
+        h1_avg += mo_cas.conj ().T @ self.get_hcore_cishift () @ mo_cas
+        return h1_avg, energy_core
 
     def casci (self, mo_coeff, ci0=None, eris=None, verbose=None, envs=None):
         from pyscf.mcscf import mc1step
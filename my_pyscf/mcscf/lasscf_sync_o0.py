@@ -158,6 +158,22 @@ class LASSCF_HessianOperator (lasci_sync.LASCI_HessianOperator):
         ncore, ncas = self.ncore, self.ncas
         nocc = ncore + ncas
 
+    def _update_eri_(self, mo_coeff):
+        # ppaa and papa can't be rotated without the rest of the ERIs
+        lasci_sync.LASCI_HessianOperator._update_eri_(self, mo_coeff)
+        self.cas_type_eris = None
+
+    def _get_eri_diag (self):
+        jdiag, kdiag = lasci_sync.LASCI_HessianOperator._get_eri_diag (self)
+        eris = getattr (self, 'cas_type_eris', None)
+        if eris is None: return jdiag, kdiag
+        ncore, nocc = self.ncore, self.nocc
+        jdiag[:,ncore:nocc] = np.einsum ('ppuu->pu', eris.ppaa)
+        kdiag[:,ncore:nocc] = np.einsum ('pupu->pu', eris.papa)
+        jdiag[ncore:nocc,:] = jdiag[:,ncore:nocc].T
+        kdiag[ncore:nocc,:] = kdiag[:,ncore:nocc].T
+        return jdiag, kdiag
+
     def get_veff (self, dm1s_mo=None):
         mo = self.mo_coeff
         moH = mo.conjugate ().T
@@ -173,11 +173,184 @@ class LASSIOop01DisagreementError (RuntimeError):
     def __str__(self):
         return self.message
 
+class LASSIHamiltonian (object):
+    ''' Second-quantized Hamiltonian of a LASSI calculation together with a cache of the
+    Hamiltonian, spin-squared and overlap matrices of each symmetry block and of the
+    fragment-local intermediates (`lassi_op_o1.LSTDMint1`) from which they were built. Repeated
+    calls for the same or a changed set of LAS states (e.g., in iterative model-space
+    selection, or to compute RDMs after diagonalization) only compute the matrix elements
+    and intermediates involving states that were not present in the previous call for the
+    same symmetry block.
+
+    LAS states are identified by the identity (not the value) of their CI vectors, so CI
+    vectors must not be modified in place between calls. Only the o1 algorithm without
+    spin-orbit coupling is supported.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+
+    Kwargs:
+        mo_coeff : ndarray of shape (nao,nmo)
+        veff_c : ndarray of shape (nao,nao)
+            Effective potential of the inactive electrons
+        h2eff_sub : ndarray of shape (nmo,ncas**2*(ncas+1)/2)
+            Two-electron integrals of the active orbitals
+
+    Attributes:
+        mo_coeff : ndarray of shape (nao,nmo)
+        e0 : float
+            Constant part of the Hamiltonian
+        h1 : ndarray of shape (ncas,ncas)
+        h2 : ndarray of shape (ncas,ncas,ncas,ncas)
+        blocks : dict
+            Cached data of each symmetry block, keyed by its symmetry tuple
+    '''
+    def __init__(self, las, mo_coeff=None, veff_c=None, h2eff_sub=None):
+        if mo_coeff is None: mo_coeff = las.mo_coeff
+        self.mo_coeff = mo_coeff
+        self.e0, self.h1, self.h2 = ham_2q (las, mo_coeff, veff_c=veff_c, h2eff_sub=h2eff_sub)
+        self.nlas = las.ncas_sub
+        self.blocks = {}
+
+    def get_ints (self, las, ci_blk, idx_root, rootsym):
+        ''' Fragment-local intermediates for the states of one symmetry block, reusing those of
+        the previous call for the same block
+
+        Args:
+            las : instance of :class:`LASCINoSymm`
+            ci_blk : list of length nfrags of list of ndarrays
+                CI vectors of the states in the block
+            idx_root : ndarray of bools of shape (las.nroots)
+                Which states of las are in the block
+            rootsym : tuple
+                Symmetry label of the block
+
+        Returns:
+            hopping_index : ndarray of ints of shape (nfrags, 2, nroots, nroots)
+            ints : list of length nfrags of instances of :class:`LSTDMint1`
+        '''
+        keys = _get_state_keys (ci_blk)
+        blk = self.blocks.setdefault (rootsym, {'keys': None, 'ham_keys': None})
+        if blk['keys'] == keys:
+            return blk['hopping_index'], blk['ints']
+        ints0 = idx0 = None
+        if blk['keys'] is not None:
+            idx0 = _get_state_positions (blk['keys'], keys)
+            ints0 = blk['ints']
+            lib.logger.debug (las, 'LASSI rootsym {}: reusing {} of {} states'.format (
+                rootsym, np.count_nonzero (idx0>=0), len (keys)))
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        hopping_index, ints = op_o1.make_ints (las, ci_blk, np.where (idx_root)[0], ints0=ints0,
+                                               idx0=idx0)
+        lib.logger.timer (las, 'LASSI rootsym {} fragment intermediates'.format (rootsym), *t0)
+        # Keep references to the CI vectors so that their ids are not recycled
+        blk.update (keys=keys, ci=ci_blk, ints=ints, hopping_index=hopping_index)
+        return hopping_index, ints
+
+    def ham (self, las, ci_blk, idx_root, rootsym):
+        ''' Hamiltonian, spin-squared, and overlap matrices of one symmetry block, computing
+        only those elements which were not computed in the previous call for the same block
+
+        Args:
+            las : instance of :class:`LASCINoSymm`
+            ci_blk : list of length nfrags of list of ndarrays
+                CI vectors of the states in the block
+            idx_root : ndarray of bools of shape (las.nroots)
+                Which states of las are in the block
+            rootsym : tuple
+                Symmetry label of the block
+
+        Returns:
+            ham : ndarray of shape (nroots,nroots)
+            s2 : ndarray of shape (nroots,nroots)
+            ovlp : ndarray of shape (nroots,nroots)
+        '''
+        hopping_index, ints = self.get_ints (las, ci_blk, idx_root, rootsym)
+        blk = self.blocks[rootsym]
+        nroots = hopping_index.shape[-1]
+        done_index = np.zeros ((nroots, nroots), dtype=bool)
+        if blk['ham_keys'] is not None:
+            idx0 = _get_state_positions (blk['ham_keys'], blk['keys'])
+            old = np.where (idx0 >= 0)[0]
+            new = idx0[old]
+            done_index[np.ix_(new,new)] = True
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        outerprod = op_o1.HamS2ovlpint (ints, self.nlas, hopping_index, self.h1, self.h2,
+                                        dtype=ci_blk[0][0].dtype)
+        outerprod.skip_done_(done_index)
+        ham, s2, ovlp, t0 = outerprod.kernel ()
+        if np.any (done_index):
+            ham[np.ix_(new,new)] = blk['ham'][np.ix_(old,old)]
+            s2[np.ix_(new,new)] = blk['s2'][np.ix_(old,old)]
+        lib.logger.timer (las, 'LASSI rootsym {} Hamiltonian ({} new elements)'.format (
+            rootsym, nroots*nroots - np.count_nonzero (done_index)), *t0)
+        blk.update (ham_keys=blk['keys'], ham_ci=blk['ci'], ham=ham, s2=s2)
+        return ham.copy (), s2.copy (), ovlp
+
+    def roots_make_rdm12s (self, las, ci_blk, idx_root, si_blk, rootsym):
+        ''' Spin-separated 1- and 2-body reduced density matrices of linear combinations of the
+        states of one symmetry block, from cached fragment-local intermediates
+
+        Args:
+            las : instance of :class:`LASCINoSymm`
+            ci_blk : list of length nfrags of list of ndarrays
+                CI vectors of the states in the block
+            idx_root : ndarray of bools of shape (las.nroots)
+                Which states of las are in the block
+            si_blk : ndarray of shape (nroots,nroots_si)
+                Linear combination vectors
+            rootsym : tuple
+                Symmetry label of the block
+
+        Returns:
+            rdm1s : ndarray of shape (nroots_si,2,ncas,ncas)
+            rdm2s : ndarray of shape (nroots_si,2,ncas,ncas,2,ncas,ncas)
+        '''
+        hopping_index, ints = self.get_ints (las, ci_blk, idx_root, rootsym)
+        ncas = sum (self.nlas)
+        nroots_si = si_blk.shape[-1]
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        outerprod = op_o1.LRRDMint (ints, self.nlas, hopping_index, si_blk,
+                                    dtype=ci_blk[0][0].dtype)
+        rdm1s, rdm2s, t0 = outerprod.kernel ()
+        lib.logger.timer (las, 'LASSI rootsym {} root RDM12s'.format (rootsym), *t0)
+        return rdm1s, rdm2s.reshape (nroots_si, 2, 2, ncas, ncas, ncas, ncas).transpose (
+            0,1,3,4,2,5,6)
+
+def _get_state_keys (ci_blk):
+    return [tuple (id (c) for c in ci_r) for ci_r in zip (*ci_blk)]
+
+def _get_state_positions (keys0, keys1):
+    pos = {key: ix for ix, key in enumerate (keys1)}
+    return np.array ([pos.get (key, -1) for key in keys0], dtype=int)
+
 def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, soc=False,
-           break_symmetry=False, opt=1):
-    ''' Diagonalize the state-interaction matrix of LASSCF '''
+           break_symmetry=False, opt=1, hamobj=None, keep_hamobj=False):
+    ''' Diagonalize the state-interaction matrix of LASSCF
+
+    Kwargs:
+        hamobj : instance of :class:`LASSIHamiltonian`
+            Cache of the Hamiltonian matrix elements and fragment intermediates to reuse and
+            update. Only for opt == 1 and soc == False. The Hamiltonian is that of hamobj, so
+            veff_c and h2eff_sub must not be given, and mo_coeff, if given, must be that of
+            hamobj. If omitted, a new one is built.
+        keep_hamobj : logical
+            If True, hamobj is attached to the returned si array as si.hamobj, so that
+            roots_make_rdm12s can reuse it. This keeps all of its intermediates in memory for
+            as long as si is.
+    '''
+    if hamobj is not None:
+        if opt != 1 or soc:
+            raise ValueError ("hamobj requires opt=1 and soc=False")
+        if veff_c is not None or h2eff_sub is not None:
+            raise ValueError ("veff_c and h2eff_sub are those of hamobj; pass them to LASSIHamiltonian")
+        if mo_coeff is not None and not (mo_coeff.shape == hamobj.mo_coeff.shape
+                                         and np.allclose (mo_coeff, hamobj.mo_coeff)):
+            raise ValueError ("mo_coeff differs from that of hamobj")
+        mo_coeff = hamobj.mo_coeff
     if mo_coeff is None: mo_coeff = las.mo_coeff
     if ci is None: ci = las.ci
+    ci = las.ci_to_det (ci)
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
@@ -189,7 +362,14 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
 
     # Construct second-quantization Hamiltonian
-    e0, h1, h2 = ham_2q (las, mo_coeff, veff_c=veff_c, h2eff_sub=h2eff_sub, soc=soc)
+    if opt == 1 and not soc:
+        if hamobj is None:
+            hamobj = LASSIHamiltonian (las, mo_coeff=mo_coeff, veff_c=veff_c,
+                                       h2eff_sub=h2eff_sub)
+        e0, h1, h2 = hamobj.e0, hamobj.h1, hamobj.h2
+    else:
+        hamobj = None
+        e0, h1, h2 = ham_2q (las, mo_coeff, veff_c=veff_c, h2eff_sub=h2eff_sub, soc=soc)
 
     # Symmetry tuple: neleca, nelecb, irrep
     statesym, s2_states = las_symm_tuple (las, break_spin=soc, break_symmetry=break_symmetry)
@@ -231,8 +411,11 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
             if soc:
                 h1_sf = (h1[0:las.ncas,0:las.ncas]
                          - h1[las.ncas:2*las.ncas,las.ncas:2*las.ncas]).real/2
-            ham_blk, s2_blk, ovlp_blk = op_o1.ham (las, h1_sf, h2, ci_blk, idx, orbsym=orbsym,
-                                                   wfnsym=wfnsym)
+            if hamobj is not None:
+                ham_blk, s2_blk, ovlp_blk = hamobj.ham (las, ci_blk, idx, rootsym)
+            else:
+                ham_blk, s2_blk, ovlp_blk = op_o1.ham (las, h1_sf, h2, ci_blk, idx,
+                                                       orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} TDM algorithm'.format (
                 rootsym), *t0)
             lib.logger.debug (las,
@@ -255,8 +438,11 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         else:
             if (las.verbose > lib.logger.INFO): lib.logger.debug (
                 las, 'Insufficient memory to test against o0 LASSI algorithm')
-            ham_blk, s2_blk, ovlp_blk = op[opt].ham (las, h1, h2, ci_blk, idx, soc=soc,
-                                                     orbsym=orbsym, wfnsym=wfnsym)
+            if hamobj is not None:
+                ham_blk, s2_blk, ovlp_blk = hamobj.ham (las, ci_blk, idx, rootsym)
+            else:
+                ham_blk, s2_blk, ovlp_blk = op[opt].ham (las, h1, h2, ci_blk, idx, soc=soc,
+                                                         orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI H build rootsym {}'.format (rootsym), *t0)
         log_debug = lib.logger.debug2 if las.nroots>10 else lib.logger.debug
         if np.iscomplexobj (ham_blk):
@@ -315,7 +501,8 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         wfnsym_roots = [statesym[ix][-1] for ix in idx]
     si = si[:,idx]
     si = tag_array (si, s2=s2_roots, s2_mat=s2_mat, nelec=nelec_roots, wfnsym=wfnsym_roots,
-                    rootsym=rootsym, break_symmetry=break_symmetry, soc=soc)
+                    rootsym=rootsym, break_symmetry=break_symmetry, soc=soc,
+                    hamobj=(hamobj if keep_hamobj else None))
     lib.logger.info (las, 'LASSI eigenvalues:')
     fmt_str = ' {:2s}  {:>16s}  {:6s}  '
     col_lbls = ['Nelec'] if soc else ['Neleca','Nelecb']
@@ -378,6 +565,7 @@ def make_stdm12s (las, ci=None, orbsym=None, soc=False, break_symmetry=False, op
     # -------------
 
     if ci is None: ci = las.ci
+    ci = las.ci_to_det (ci)
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
@@ -437,7 +625,8 @@ def make_stdm12s (las, ci=None, orbsym=None, soc=False, break_symmetry=False, op
             stdm2s[a,...,b] = d2s[i,...,j]
     return stdm1s, stdm2s
 
-def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None, opt=1):
+def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None, opt=1,
+                       hamobj=None):
     '''Evaluate 1- and 2-electron reduced density matrices of LASSI states
 
         Args:
@@ -460,12 +649,16 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None,
             opt: Optimization level, i.e.,  take outer product of
                 0: CI vectors
                 1: TDMs
+            hamobj: instance of :class:`LASSIHamiltonian`
+                Whose cached fragment intermediates are reused if opt == 1 and soc == False.
+                Defaults to the tag "hamobj" of si, if any (see keep_hamobj in lassi).
 
         Returns:
             rdm1s: ndarray of shape (nroots,2,ncas,ncas) if soc==False;
                 or of shape (nroots,2*ncas,2*ncas) if soc==True.
             rdm2s: ndarray of shape (nroots,2,ncas,ncas,2,ncas,ncas)
     '''
+    ci = las.ci_to_det (ci)
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
@@ -474,6 +667,8 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None,
             orbsym = orbsym[las.ncore:las.ncore+las.ncas]
     if soc is None: soc = si.soc
     if break_symmetry is None: break_symmetry = si.break_symmetry
+    if hamobj is None: hamobj = getattr (si, 'hamobj', None)
+    if opt != 1 or soc: hamobj = None
     o0_memcheck = op_o0.memcheck (las, ci, soc=soc)
     if opt == 0 and o0_memcheck == False:
         raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
@@ -504,7 +699,10 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None,
                                                 wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} CI algorithm'.format (sym),
                                    *t0)
-            d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk)
+            if hamobj is not None:
+                d1s_test, d2s_test = hamobj.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, sym)
+            else:
+                d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} TDM algorithm'.format (sym),
                                    *t0)
             lib.logger.debug (las,
@@ -522,8 +720,11 @@ def roots_make_rdm12s (las, ci, si, orbsym=None, soc=None, break_symmetry=None,
         else:
             if not o0_memcheck: lib.logger.debug (las,
                 'Insufficient memory to test against o0 LASSI algorithm')
-            d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym,
-                                                  wfnsym=wfnsym)
+            if hamobj is not None:
+                d1s, d2s = hamobj.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, sym)
+            else:
+                d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk,
+                                                      orbsym=orbsym, wfnsym=wfnsym)
             t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {}'.format (sym), *t0)
         idx_int = np.where (idx_si)[0]
         for (i,a) in enumerate (idx_int):
@@ -308,7 +308,38 @@ class LSTDMint1 (object):
         else:
             self.dm2[i][j] = x
 
-    def kernel (self, ci, hopping_index, zerop_index, onep_index):
+    def inherit_(self, other, idx):
+        ''' Copy the already-computed intermediates of another instance describing the same
+        fragment, for example from a previous calculation with fewer states.
+
+        Args:
+            other : instance of :class:`LSTDMint1`
+            idx : ndarray of ints of shape (other.nroots)
+                Position of each of other's states among the states of self, or -1 if it is
+                not among them
+
+        Returns:
+            done_index : ndarray of bools of shape (nroots, nroots)
+                element [i,j] is true where the intermediates between the ith and jth states
+                were copied from other. Pass this to `kernel` to avoid recomputing them.
+        '''
+        old = np.where (np.asarray (idx) >= 0)[0]
+        new = np.asarray (idx)[old]
+        done_index = np.zeros ((self.nroots, self.nroots), dtype=bool)
+        done_index[np.ix_(new,new)] = True
+        self.ovlp[np.ix_(new,new)] = other.ovlp[np.ix_(old,old)]
+        for (i0, i1), (j0, j1) in product (zip (old, new), repeat=2):
+            for tab, tab0 in ((self._h, other._h), (self._hh, other._hh),
+                              (self._phh, other._phh)):
+                for s in range (len (tab)):
+                    tab[s][i1][j1] = tab0[s][i0][j0]
+            self._sm[i1][j1] = other._sm[i0][j0]
+            if i0 >= j0:
+                if other.dm1[i0][j0] is not None: self.set_dm1 (i1, j1, other.dm1[i0][j0])
+                if other.dm2[i0][j0] is not None: self.set_dm2 (i1, j1, other.dm2[i0][j0])
+        return done_index
+
+    def kernel (self, ci, hopping_index, zerop_index, onep_index, done_index=None):
         ''' Compute the transition density matrix factors.
 
         Args:
@@ -330,6 +361,12 @@ class LSTDMint1 (object):
                 within spectator fragments and phh/pph modes within
                 source/dest fragments.
 
+        Kwargs:
+            done_index : ndarray of bools of shape (nroots, nroots)
+                element [i,j] is true where the intermediates between the ith and jth states
+                are already available (see `inherit_`) and are not to be computed. Must be
+                symmetric.
+
         Returns:
             t0 : tuple of length 2
                 timestamp of entry into this function, for profiling by caller
@@ -337,17 +374,19 @@ class LSTDMint1 (object):
 
         nroots, norb = self.nroots, self.norb
         t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        if done_index is None: done_index = np.zeros ((nroots, nroots), dtype=bool)
+        hopping_index = np.where (done_index[None,:,:], 0, hopping_index)
+        todo_index = ~done_index
 
         # Overlap matrix
         for i, j in combinations (range (self.nroots), 2):
-            if self.nelec_r[i] == self.nelec_r[j]:
-                self.ovlp[i,j] = ci[i].conj ().ravel ().dot (ci[j].ravel ())
-        self.ovlp += self.ovlp.T
+            if self.nelec_r[i] == self.nelec_r[j] and todo_index[i,j]:
+                self.ovlp[i,j] = self.ovlp[j,i] = ci[i].conj ().ravel ().dot (ci[j].ravel ())
         for i in range (self.nroots):
-            self.ovlp[i,i] = ci[i].conj ().ravel ().dot (ci[i].ravel ())
+            if todo_index[i,i]: self.ovlp[i,i] = ci[i].conj ().ravel ().dot (ci[i].ravel ())
 
         # Spectator fragment contribution
-        spectator_index = np.all (hopping_index == 0, axis=0)
+        spectator_index = np.all (hopping_index == 0, axis=0) & todo_index
         spectator_index[np.triu_indices (self.nroots, k=1)] = False
         spectator_index = np.stack (np.where (spectator_index), axis=1)
         for i, j in spectator_index:
@@ -501,6 +540,7 @@ class LSTDMint2 (object):
         # member function below. The first two columns are always the bra and the ket. Further
         # columns identify fragments whose quantum numbers are changed by the interaction. If
         # necessary (i.e., for 1c and 2c), the last column identifies spin case.
+        self.exc_diag = np.arange (nroots)[:,None]
         self.exc_null = np.empty ((0,2), dtype=int)
         self.exc_1c = np.empty ((0,5), dtype=int)
         self.exc_1s = np.empty ((0,4), dtype=int)
@@ -612,6 +652,23 @@ class LSTDMint2 (object):
                              for nelec_sf in self.nelec_rf]
         self.nelec_rf = self.nelec_rf.sum (1)
 
+    def skip_done_(self, done_index):
+        ''' Drop all interactions between pairs of states for which the caller already has
+        the result
+
+        Args:
+            done_index : ndarray of bools of shape (nroots, nroots)
+                element [i,j] is true where the interaction between the ith and jth LAS states
+                is to be skipped. Must be symmetric.
+        '''
+        done_index = np.asarray (done_index)
+        for lbl in ('diag', 'null', '1c', '1s', '1s1c', '2c'):
+            exc = getattr (self, 'exc_' + lbl)
+            bra = exc[:,0]
+            ket = exc[:,1] if exc.shape[1] > 1 else bra
+            setattr (self, 'exc_' + lbl, exc[~done_index[bra,ket]])
+        return self
+
     def get_range (self, i):
         p = sum (self.nlas[:i])
         q = p + self.nlas[i]
@@ -846,7 +903,7 @@ class LSTDMint2 (object):
         for row in self.exc_1s1c: self._crunch_1s1c_(*row)
         for row in self.exc_2c: self._crunch_2c_(*row)
         self._add_transpose_()
-        for state in range (self.nroots): self._crunch_null_(state, state)
+        for state in self.exc_diag[:,0]: self._crunch_null_(state, state)
 
     def _add_transpose_(self):
         self.tdm1s += self.tdm1s.conj ().transpose (1,0,2,4,3)
@@ -994,7 +1051,7 @@ class LRRDMint (LSTDMint2):
         self._crunch_all_()
         return self.rdm1s, self.rdm2s, t0
 
-def make_ints (las, ci, idx_root):
+def make_ints (las, ci, idx_root, ints0=None, idx0=None):
     ''' Build fragment-local intermediates (`LSTDMint1`) for LASSI o1
 
     Args:
@@ -1004,6 +1061,14 @@ def make_ints (las, ci, idx_root):
         idx_root : list of length (nroots)
             list of specific LAS states considered in the current calculation
 
+    Kwargs:
+        ints0 : list of length nfrags of instances of :class:`LSTDMint1`
+            Intermediates from a previous call, whose elements between states that are also
+            among the current ones are copied rather than recomputed
+        idx0 : ndarray of ints of shape (ints0[0].nroots)
+            Position of each of the states of ints0 among the current ones, or -1 if it is not
+            among them
+
     Returns:
         hopping_index : ndarray of ints of shape (nfrags, 2, nroots, nroots)
             element [i,j,k,l] reports the change of number of electrons of
@@ -1020,7 +1085,10 @@ def make_ints (las, ci, idx_root):
     for ifrag in range (nfrags):
         tdmint = LSTDMint1 (fciboxes[ifrag], nlas[ifrag], nelelas[ifrag], nroots, idx_root,
                             hopping_index[ifrag], ifrag)
-        t0 = tdmint.kernel (ci[ifrag], hopping_index[ifrag], zerop_index, onep_index)
+        done_index = None
+        if ints0 is not None: done_index = tdmint.inherit_(ints0[ifrag], idx0)
+        t0 = tdmint.kernel (ci[ifrag], hopping_index[ifrag], zerop_index, onep_index,
+                            done_index=done_index)
         lib.logger.timer (las, 'LAS-state TDM12s fragment {} intermediate crunching'.format (
             ifrag), *t0)
         ints.append (tdmint)
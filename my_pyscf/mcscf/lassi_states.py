@@ -104,33 +104,105 @@ class SingleLASState (object):
         
 
     def get_singles (self):
-        log = logger.new_logger (self, self.verbose)
-        # move 1 alpha electron
-        has_ea = np.where (self.neleca > 0)[0]
-        has_ha = np.where (self.nholea > 0)[0]
-        singles = []
-        for i, a in itertools.product (has_ea, has_ha):
-            if i==a: continue
-            si_range = self.get_valid_smult_change (i, -1, 0)
-            sa_range = self.get_valid_smult_change (a,  1, 0)
-            for si, sa in itertools.product (si_range, sa_range):
-                try:
-                    singles.append (self.get_single (i,a,0,si,sa))
-                except ImpossibleSpinError as e:
-                    log.debug ('Caught ImpossibleSpinError: {}'.format (e.__dict__))
-        # move 1 beta electron
-        has_eb = np.where (self.nelecb > 0)[0]
-        has_hb = np.where (self.nholeb > 0)[0]
-        for i, a in itertools.product (has_eb, has_hb):
-            if i==a: continue
-            si_range = self.get_valid_smult_change (i, 0, -1)
-            sa_range = self.get_valid_smult_change (a, 0,  1)
-            for si, sa in itertools.product (si_range, sa_range):
-                try:
-                    singles.append (self.get_single (i,a,1,si,sa))
-                except ImpossibleSpinError as e:
-                    log.debug ('Caught ImpossibleSpinError: {}'.format (e.__dict__))
-        return singles
+        charges, spins, smults = get_single_excitations (self.nlas, self.nelelas,
+            self.charges[None,:], self.spins[None,:], self.smults[None,:])[:3]
+        return [SingleLASState (self.las, m, s, c, 0, nlas=self.nlas, nelelas=self.nelelas,
+                                stdout=self.stdout, verbose=self.verbose)
+                for c, m, s in zip (charges, spins, smults)]
+
+def _smult_range (nlas, neleca, nelecb):
+    ''' Smallest and largest spin multiplicities of neleca alpha and nelecb beta electrons in
+    nlas orbitals. Arguments and returns broadcast. '''
+    min_smult = np.abs (neleca - nelecb) + 1
+    min_npair = np.maximum (0, neleca + nelecb - nlas)
+    max_smult = 1 + neleca + nelecb - 2*min_npair
+    return min_smult, max_smult
+
+def get_single_excitations (nlas, nelelas, charges, spins, smults):
+    ''' All LAS states that differ from a set of parent LAS states by moving one electron
+    from one fragment to another, including every possible change of the spin multiplicities
+    of the two fragments involved.
+
+    Args:
+        nlas : ndarray of shape (nfrags)
+            Number of active orbitals in each fragment
+        nelelas : ndarray of shape (nfrags)
+            Number of active electrons in each fragment in the neutral state
+        charges : ndarray of shape (nparents,nfrags)
+        spins : ndarray of shape (nparents,nfrags)
+            2*Ms of each fragment
+        smults : ndarray of shape (nparents,nfrags)
+            2*S+1 of each fragment
+
+    Returns:
+        charges : ndarray of shape (nsingles,nfrags)
+        spins : ndarray of shape (nsingles,nfrags)
+        smults : ndarray of shape (nsingles,nfrags)
+        parent : ndarray of shape (nsingles)
+            Index of the parent state of each single excitation
+        i : ndarray of shape (nsingles)
+            Fragment from which an electron was removed
+        a : ndarray of shape (nsingles)
+            Fragment to which an electron was added
+        s : ndarray of shape (nsingles)
+            Spin of the moved electron (0 = alpha, 1 = beta)
+    '''
+    nlas, nelelas = np.asarray (nlas), np.asarray (nelelas)
+    charges, spins, smults = [np.atleast_2d (x) for x in (charges, spins, smults)]
+    nelec = nelelas[None,:] - charges
+    nelec_s = np.stack ([(nelec + spins) // 2, (nelec - spins) // 2], axis=1)
+    dsmult = np.array ([-1,1])
+    # Index order of ok_i, ok_a: (parent, spin of electron, fragment, change of smult)
+    ok_i = _fragment_ok (nlas, nelec_s, smults, -1)
+    ok_a = _fragment_ok (nlas, nelec_s, smults, +1)
+    nfrag = len (nlas)
+    mask = (ok_i[:,:,:,None,:,None] & ok_a[:,:,None,:,None,:]
+            & ~np.eye (nfrag, dtype=bool)[None,None,:,:,None,None])
+    parent, s, i, a, si, sa = np.nonzero (mask)
+    idx = np.arange (len (parent))
+    dm = 1 - 2*s
+    charges1, spins1, smults1 = charges[parent], spins[parent], smults[parent]
+    charges1[idx,i] += 1
+    charges1[idx,a] -= 1
+    spins1[idx,i] -= dm
+    spins1[idx,a] += dm
+    smults1[idx,i] += dsmult[si]
+    smults1[idx,a] += dsmult[sa]
+    return charges1, spins1, smults1, parent, i, a, s
+
+def _fragment_ok (nlas, nelec_s, smults, sgn):
+    ''' Whether adding (sgn=+1) or removing (sgn=-1) an electron of spin s to fragment i and
+    changing its spin multiplicity by dsmult[k] = (-1,1)[k] leads to a possible fragment state.
+
+    Returns:
+        ok : ndarray of shape (nparents,2,nfrags,2) and dtype bool
+            Indices are (parent, s, i, k)
+    '''
+    # n[p,s,t,i] = number of electrons of spin t in fragment i after the change
+    n = nelec_s[:,None,:,:] + sgn*np.eye (2, dtype=int)[None,:,:,None]
+    ok = np.all ((n >= 0) & (n <= nlas[None,None,None,:]), axis=2)
+    min_smult, max_smult = _smult_range (nlas[None,None,:], n[:,:,0,:], n[:,:,1,:])
+    smults1 = smults[:,None,:,None] + np.array ([-1,1])[None,None,None,:]
+    return (ok[:,:,:,None] & (smults1 >= min_smult[:,:,:,None])
+            & (smults1 <= max_smult[:,:,:,None]))
+
+def _pack_states (charges, spins, smults):
+    ''' Pack each row of (charges, spins, smults) into one opaque item, so that LAS states can
+    be compared, sorted and deduplicated with numpy set routines. '''
+    rows = np.ascontiguousarray (np.concatenate ([charges, spins, smults], axis=1),
+                                 dtype=np.int32)
+    return rows.view (np.dtype ((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel ()
+
+def _unique_states (charges, spins, smults, nkeep=0):
+    ''' Indices of the first occurrence of each distinct row of (charges, spins, smults), in
+    order of first occurrence. The first nkeep rows are always kept, even if they repeat, and
+    rows identical to one of them are dropped. '''
+    rows = _pack_states (charges, spins, smults)
+    first, inv = np.unique (rows, return_index=True, return_inverse=True)[1:]
+    first = first[inv]
+    keep = np.arange (len (rows))
+    keep = (keep < nkeep) | ((first == keep) & (first >= nkeep))
+    return np.where (keep)[0]
 
 def all_single_excitations (las):
     from mrh.my_pyscf.mcscf.lasci import get_state_info
@@ -138,22 +210,255 @@ def all_single_excitations (las):
     log = logger.new_logger (las, las.verbose)
     if isinstance (las, LASCISymm):
         raise NotImplementedError ("Point-group symmetry for LASSI state generator")
-    ref_states = [SingleLASState (las, m, s, c, 0) for c,m,s,w in zip (*get_state_info (las))]
-    for weight, state in zip (las.weights, ref_states): state.weight = weight
-    new_states = []
-    for ref_state in ref_states:
-        new_states.extend (ref_state.get_singles ())
-    seen = set (ref_states)
-    all_states = ref_states + [state for state in new_states if not ((state in seen) or seen.add (state))]
-    weights = [state.weight for state in all_states]
-    charges = [state.charges for state in all_states]
-    spins = [state.spins for state in all_states]
-    smults = [state.smults for state in all_states]
-    #wfnsyms = [state.wfnsyms for state in all_states]
+    ref_charges, ref_spins, ref_smults = [np.asarray (x) for x in get_state_info (las)[:3]]
+    nelelas = [sum (_unpack_nelec (x)) for x in las.nelecas_sub]
+    charges, spins, smults = get_single_excitations (las.ncas_sub, nelelas, ref_charges,
+                                                     ref_spins, ref_smults)[:3]
+    nref = len (ref_charges)
+    charges = np.append (ref_charges, charges, axis=0)
+    spins = np.append (ref_spins, spins, axis=0)
+    smults = np.append (ref_smults, smults, axis=0)
+    idx = _unique_states (charges, spins, smults, nkeep=nref)
+    weights = np.zeros (len (idx))
+    weights[:nref] = las.weights
     log.info ('Built {} singly-excited LAS states from {} reference LAS states'.format (
-        len (all_states) - len (ref_states), len (ref_states)))
-    return las.state_average (weights=weights, charges=charges, spins=spins, smults=smults)
+        len (idx) - nref, nref))
+    return las.state_average (weights=list (weights), charges=charges[idx], spins=spins[idx],
+                              smults=smults[idx])
+
+def get_frag_ip_ea (las, h1e_fs, eri_cas, ci_f, nroots=4, window=0.05, state=0):
+    ''' Ionization potentials, electron affinities, and Dyson orbitals of each fragment with
+    respect to each spin, from the lowest nroots states of the fragment's active space with one
+    electron more or less than in the reference state, obtained by FCI with the reference
+    state's effective Hamiltonian. More than one state is needed because the ground state of
+    the ionized fragment is often nearly degenerate, and which of the nearly-degenerate states
+    is lowest in the embedding of a particular model state is hard to predict; states more than
+    window above the lowest one are discarded, however.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        h1e_fs : list of length nfrags of ndarrays of shape (2,ncas_sub[i],ncas_sub[i])
+            Spin-separated effective 1-electron Hamiltonian of the reference state
+        eri_cas : ndarray of shape [ncas,]*4
+        ci_f : list of length nfrags of ndarrays
+            CI vectors of the reference state, in the determinant basis (see las.ci_to_det)
+
+    Kwargs:
+        nroots : integer
+            Maximum number of states of each ionized fragment
+        window : float
+            Energy window above the lowest state of each ionized fragment
+        state : integer
+            Index of the reference state among the states of las, for its charges and spins
+
+    Returns:
+        ip : list of length 2 of lists of length nfrags of ndarrays of shape (nroots)
+            E(N-1) - E(N), with the electron removed from spin s. Empty where impossible.
+        ea : list of length 2 of lists of length nfrags of ndarrays of shape (nroots)
+            E(N) - E(N+1), with the electron added to spin s. Empty where impossible.
+        dys_ip : list of length 2 of lists of length nfrags of ndarrays of shape (nroots,norb)
+            <N-1|a_ps|N> for the orbitals p of the fragment.
+        dys_ea : list of length 2 of lists of length nfrags of ndarrays of shape (nroots,norb)
+            <N+1|a_ps^+|N> for the orbitals p of the fragment.
+    '''
+    from mrh.my_pyscf.mcscf.lasci import get_state_info
+    from pyscf.fci import direct_uhf, addons
+    ip, ea = [[],[]], [[],[]]
+    dys_ip, dys_ea = [[],[]], [[],[]]
+    charges, spins = get_state_info (las)[:2]
+    for ifrag, (h1e, norb, ci0) in enumerate (zip (h1e_fs, las.ncas_sub, ci_f)):
+        nelec = sum (las.nelecas_sub[ifrag]) - charges[state][ifrag]
+        nelec = ((nelec + spins[state][ifrag]) // 2, (nelec - spins[state][ifrag]) // 2)
+        i = sum (las.ncas_sub[:ifrag])
+        j = i + norb
+        h1e = (h1e[0], h1e[1])
+        eri = (eri_cas[i:j,i:j,i:j,i:j],)*3
+        solver = direct_uhf.FCISolver (las.mol)
+        ci0 = ci0.reshape (-1, addons.cistring.num_strings (norb, nelec[1]))
+        e0 = solver.energy (h1e, eri, ci0, norb, nelec)
+        for s, (da, db) in enumerate (((1,0),(0,1))):
+            des = (addons.des_a, addons.des_b)[s]
+            cre = (addons.cre_a, addons.cre_b)[s]
+            for sgn, op, out_e, out_dys in ((-1, des, ip, dys_ip), (1, cre, ea, dys_ea)):
+                nelec1 = (nelec[0] + sgn*da, nelec[1] + sgn*db)
+                if not ((0 <= nelec1[0] <= norb) and (0 <= nelec1[1] <= norb)):
+                    out_e[s].append (np.zeros (0))
+                    out_dys[s].append (np.zeros ((0, norb)))
+                    continue
+                ndet = (addons.cistring.num_strings (norb, nelec1[0])
+                        * addons.cistring.num_strings (norb, nelec1[1]))
+                e1, ci1 = solver.kernel (h1e, eri, norb, nelec1, nroots=min (nroots, ndet))
+                e1 = np.atleast_1d (e1)
+                ci1 = ci1 if isinstance (ci1, (list, tuple)) else [ci1,]
+                idx = (e1 - e1[0]) < window
+                e1, ci1 = e1[idx], [c for c, i in zip (ci1, idx) if i]
+                out_e[s].append (-sgn * (e1 - e0))
+                opci0 = np.stack ([op (ci0, norb, nelec, p).ravel () for p in range (norb)],
+                                  axis=1)
+                out_dys[s].append (np.stack ([c.ravel () for c in ci1], axis=0) @ opci0)
+    return ip, ea, dys_ip, dys_ea
+
+def get_single_excitation_estimates (las, mo_coeff=None, ci=None, nroots=4, window=0.05,
+                                     state=0):
+    ''' Cheap estimates of the coupling to, and the energy gap of, the moving of one electron
+    of spin s from fragment i to fragment a in one reference state. For each pair of
+    states k, l of the ionized fragments (see get_frag_ip_ea),
 
+        v[k,l] = sum_{p in i, q in a} d_ea[l,q]* F[s]_qp d_ip[k,p]
+        de[k,l] = IP[k] - EA[l] - J
+
+    where d are the Dyson orbitals, F[s] is the state-averaged spin-separated Fock matrix of the
+    active orbitals, and J is the average of (pp|qq) weighted by the squared Dyson orbitals,
+    i.e., the attraction between the hole and the electron. These are combined into the total
+    squared coupling v2 = sum_kl |v[k,l]|**2 and an effective gap de such that v2/de =
+    sum_kl |v[k,l]|**2/|de[k,l]|. Only the fragment CI problems with one electron more or less
+    have to be solved, so the cost is linear in the number of fragments.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+
+    Kwargs:
+        mo_coeff : ndarray of shape (nao,nmo)
+        ci : list of list of ndarrays
+        nroots : integer
+            Maximum number of states of each ionized fragment
+        window : float
+            Energy window above the lowest state of each ionized fragment
+        state : integer
+            Index of the reference state among the states of las
+
+    Returns:
+        v2 : ndarray of shape (2,nfrags,nfrags)
+            Squared couplings
+        de : ndarray of shape (2,nfrags,nfrags)
+            Effective energy gaps (positive)
+    '''
+    from pyscf.lib import unpack_tril
+    from mrh.my_pyscf.mcscf.lasci import _DFLASCI
+    if mo_coeff is None: mo_coeff = las.mo_coeff
+    if ci is None: ci = las.ci
+    ci = las.ci_to_det (ci)
+    ncore, ncas, nfrags = las.ncore, las.ncas, las.nfrags
+    nocc = ncore + ncas
+    mo_cas = mo_coeff[:,ncore:nocc]
+    dm1s = las.make_rdm1s (mo_coeff=mo_coeff, ci=ci)
+    if isinstance (las, _DFLASCI):
+        vj, vk = las.with_df.get_jk (dm1s, hermi=1)
+    else:
+        vj, vk = las._scf.get_jk (las.mol, dm1s, hermi=1)
+    fock = las.get_hcore ()[None,:,:] + vj.sum (0)[None,:,:] - vk
+    fock = np.dot (mo_cas.conj ().T, np.dot (fock, mo_cas)).transpose (1,0,2)
+    h2eff_sub = las.get_h2eff (mo_coeff)
+    eri_cas = unpack_tril (h2eff_sub[ncore:nocc].reshape (ncas*ncas, -1)).reshape ([ncas,]*4)
+    h1e_frs = las.h1e_for_cas (mo_coeff=mo_coeff, ci=ci, h2eff_sub=h2eff_sub)
+    ip, ea, dys_ip, dys_ea = get_frag_ip_ea (las, [h1e_rs[state] for h1e_rs in h1e_frs],
+                                             eri_cas, [ci_r[state] for ci_r in ci],
+                                             nroots=nroots, window=window, state=state)
+    jdiag = np.einsum ('ppqq->pq', eri_cas)
+    offs = np.cumsum ([0,] + list (las.ncas_sub))
+    v2 = np.zeros ((2, nfrags, nfrags))
+    de = np.ones ((2, nfrags, nfrags))
+    for s, i, a in itertools.product (range (2), range (nfrags), range (nfrags)):
+        if (i == a) or (not len (ip[s][i])) or (not len (ea[s][a])): continue
+        p, q = slice (offs[i], offs[i+1]), slice (offs[a], offs[a+1])
+        v = dys_ea[s][a].conj () @ fock[s][q,p] @ dys_ip[s][i].T
+        wgt_i = (np.abs (dys_ip[s][i])**2).sum (0)
+        wgt_a = (np.abs (dys_ea[s][a])**2).sum (0)
+        jpq = (wgt_i @ jdiag[p,q] @ wgt_a) / max (wgt_i.sum () * wgt_a.sum (), 1e-8)
+        de_kl = np.abs (ip[s][i][None,:] - ea[s][a][:,None] - jpq)
+        de_kl = np.maximum (de_kl, 1e-8)
+        v2[s,i,a] = (np.abs (v)**2).sum ()
+        if v2[s,i,a] > 0: de[s,i,a] = v2[s,i,a] / (np.abs (v)**2 / de_kl).sum ()
+    return v2, de
+
+def screened_single_excitations (las, conv_tol=1e-5, max_states=None, max_cycle=1,
+                                 mo_coeff=None, ci=None):
+    ''' Like all_single_excitations, but instead of every single excitation, keep only those
+    which are estimated to be important to the reference states. The importance of a candidate
+    state generated from a parent state by moving one electron (spin s) from fragment i to
+    fragment a is its second-order energy estimate
+
+        e2 = t2 * v2[s,i,a] / |de[s,i,a]|
+
+    where v2 and de come from get_single_excitation_estimates for the reference state from which
+    the parent descends (each reference state has its own fragment charges, spins and CI
+    vectors, so the ionized fragments differ between them) and t2 is the estimated squared
+    amplitude of the parent (1 for the reference states; t2 * v2 / de**2 for selected
+    candidates). Candidates reached from several parents accumulate e2. The candidates with e2
+    >= conv_tol are kept, at most max_states of them altogether, most important first. If
+    max_cycle > 1, the selected states become the parents of another round of selection, which
+    reaches states doubly-, triply-, etc. excited relative to the reference states.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+
+    Kwargs:
+        conv_tol : float
+            Minimum e2 of a kept candidate
+        max_states : int or None
+            Maximum number of states added to the reference states
+        max_cycle : int
+            Number of rounds of selection
+        mo_coeff, ci :
+            Wave function of the reference states; default las.mo_coeff and las.ci
+
+    Returns:
+        las : instance of :class:`LASCINoSymm`
+            State-averaged copy of las with the reference and kept states, the latter with zero
+            weight
+    '''
+    from mrh.my_pyscf.mcscf.lasci import get_state_info
+    from mrh.my_pyscf.mcscf.lasci import LASCISymm
+    log = logger.new_logger (las, las.verbose)
+    if isinstance (las, LASCISymm):
+        raise NotImplementedError ("Point-group symmetry for LASSI state generator")
+    charges, spins, smults = [np.asarray (x) for x in get_state_info (las)[:3]]
+    nelelas = [sum (_unpack_nelec (x)) for x in las.nelecas_sub]
+    nref = len (charges)
+    v2, de = [np.stack (x, axis=0) for x in zip (*[get_single_excitation_estimates (
+        las, mo_coeff=mo_coeff, ci=ci, state=iref) for iref in range (nref)])]
+    de = np.maximum (np.abs (de), 1e-8)
+    seen = _pack_states (charges, spins, smults)
+    t2 = np.ones (nref)
+    root = np.arange (nref)
+    parents = (charges, spins, smults)
+    for it in range (max_cycle):
+        c1, m1, s1, parent, i, a, s = get_single_excitations (las.ncas_sub, nelelas, *parents)
+        rows = _pack_states (c1, m1, s1)
+        idx = ~np.isin (rows, seen)
+        c1, m1, s1, rows = c1[idx], m1[idx], s1[idx], rows[idx]
+        parent, i, a, s = parent[idx], i[idx], a[idx], s[idx]
+        r = root[parent]
+        # Candidates reached from several parents accumulate, in order of first occurrence, and
+        # descend from the reference state of the first parent
+        uniq, first, inv = np.unique (rows, return_index=True, return_inverse=True)
+        order = np.argsort (first)
+        inv = np.argsort (order)[inv]
+        first = first[order]
+        e2 = np.bincount (inv, weights=t2[parent]*v2[r,s,i,a]/de[r,s,i,a],
+                          minlength=len (first))
+        t2_new = np.bincount (inv, weights=t2[parent]*v2[r,s,i,a]/de[r,s,i,a]**2,
+                              minlength=len (first))
+        kept = np.argsort (-e2, kind='stable')
+        kept = kept[e2[kept] >= conv_tol]
+        if max_states is not None:
+            kept = kept[:max (0, max_states + nref - len (charges))]
+        log.info ('LAS state selection cycle %d: kept %d of %d candidate states', it, len (kept),
+                  len (e2))
+        if len (kept): log.debug ('Smallest kept e2 = %.3g', e2[kept[-1]])
+        if not len (kept): break
+        parents = tuple (x[first[kept]] for x in (c1, m1, s1))
+        t2 = t2_new[kept]
+        root = r[first[kept]]
+        charges, spins, smults = [np.append (x, y, axis=0)
+                                  for x, y in zip ((charges, spins, smults), parents)]
+        seen = np.append (seen, rows[first[kept]])
+    weights = np.zeros (len (charges))
+    weights[:nref] = las.weights
+    log.info ('Built {} excited LAS states from {} reference LAS states'.format (
+        len (charges) - nref, nref))
+    return las.state_average (weights=list (weights), charges=charges, spins=spins,
+                              smults=smults)
 
 if __name__=='__main__':
     from mrh.tests.lasscf.c2h4n4_struct import structure as struct
@@ -57,6 +57,7 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
         log.info ('Debugging CI and gradient vectors...')
         for ix, (grad, ci, s, t) in enumerate (zip (grad_f, ci1, self.fcisolvers, transformers)):
             log.info ('Fragment %d', ix)
+            ci = s.ci_to_det (ci, t.norb, (t.neleca, t.nelecb))
             ci_csf, ci_norm = t.vec_det2csf (ci, normalize=True, return_norm=True)
             log.info ('CI vector norm = %e', ci_norm)
             grad_norm = linalg.norm (grad)
@@ -102,7 +103,9 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
             hc = solver.contract_2e (h2e, c, no, nelec)
             chc = c.ravel ().dot (hc.ravel ())
             hc -= c * chc
-            if isinstance (solver, CSFFCISolver):
+            if isinstance (solver, CSFFCISolver) and solver._is_csf_vec (hc, no, nelec):
+                hc = solver.transformer.pack_csf (hc)
+            elif isinstance (solver, CSFFCISolver):
                 hc = solver.transformer.vec_det2csf (hc, normalize=False)
             grad.append (hc.ravel ())
         return np.concatenate (grad)
@@ -0,0 +1,102 @@
+import numpy as np
+import unittest
+from pyscf import gto, lib, ao2mo
+from pyscf.fci import direct_spin1
+from mrh.my_pyscf.fci import csf_solver
+from mrh.my_pyscf.fci.csf import pspace, make_hcsf_conf, make_hdiag_csf, make_hdiag_csf_slower
+
+def random_ham (norb, seed=0):
+    rng = np.random.default_rng (seed)
+    h1 = rng.random ((norb,norb))
+    h1 = h1 + h1.T + np.diag (np.arange (norb))
+    eri = rng.random ((norb,)*4) * 0.1
+    eri = eri + eri.transpose (1,0,2,3)
+    eri = eri + eri.transpose (0,1,3,2)
+    eri = eri + eri.transpose (2,3,0,1)
+    return h1, eri
+
+def full_csf_ham (fs, h1, eri, norb, nelec):
+    h2e = direct_spin1.absorb_h1e (h1, eri, norb, nelec, .5)
+    na, nb = fs.transformer.ndeta, fs.transformer.ndetb
+    ham = np.stack ([direct_spin1.contract_2e (h2e, c.reshape (na,nb), norb, nelec).ravel ()
+                     for c in np.eye (na*nb)], axis=0)
+    ham = fs.transformer.vec_det2csf (ham, normalize=False)
+    return fs.transformer.vec_det2csf (ham.T, normalize=False)
+
+class KnownValues(unittest.TestCase):
+
+    def test_pspace (self):
+        norb = 6
+        h1, eri = random_ham (norb)
+        for nelec, smult in (((3,3),1), ((3,3),3), ((4,2),3), ((4,3),2)):
+            fs = csf_solver (gto.M (verbose=0), smult=smult)
+            fs.norb, fs.nelec = norb, nelec
+            fs.check_transformer_cache ()
+            ham = full_csf_ham (fs, h1, eri, norb, nelec)
+            for npsp in (20, 10000):
+                with self.subTest (nelec=nelec, smult=smult, npsp=npsp):
+                    addr, h0 = fs.pspace (h1, eri, norb, nelec, npsp=npsp)
+                    self.assertEqual (len (addr), min (npsp, ham.shape[0]))
+                    self.assertAlmostEqual (lib.fp (h0), lib.fp (ham[np.ix_(addr,addr)]), 9)
+
+    def test_hcsf_conf (self):
+        norb = 6
+        h1, eri = random_ham (norb)
+        for nelec, smult in (((3,3),1), ((3,3),3), ((4,2),3), ((4,3),2)):
+            fs = csf_solver (gto.M (verbose=0), smult=smult)
+            fs.norb, fs.nelec = norb, nelec
+            fs.check_transformer_cache ()
+            ham = full_csf_ham (fs, h1, eri, norb, nelec)
+            h2e = fs.absorb_h1e (h1, eri, norb, nelec, .5)
+            with self.subTest (nelec=nelec, smult=smult):
+                hcsf = make_hcsf_conf (fs, h2e, norb, nelec, fs.transformer)
+                hcsf = (hcsf + hcsf.T).toarray ()
+                self.assertAlmostEqual (lib.fp (hcsf), lib.fp (ham), 9)
+
+    def test_hdiag_chunks (self):
+        norb = 8
+        h1, eri = random_ham (norb)
+        for nelec, smult in (((4,4),1), ((4,4),3), ((5,3),3)):
+            fs = csf_solver (gto.M (verbose=0), smult=smult)
+            fs.norb, fs.nelec = norb, nelec
+            fs.check_transformer_cache ()
+            hdiag_ref = make_hdiag_csf_slower (h1, eri, norb, nelec, fs.transformer)
+            # Without the process's own footprint, max_memory alone sets the number of
+            # configurations per chunk: one, a few, or all of them
+            with lib.temporary_env (lib, current_memory=lambda: (0, 0)):
+                for max_memory in (0, 0.2, 1e6):
+                    with self.subTest (nelec=nelec, smult=smult, max_memory=max_memory):
+                        hdiag = make_hdiag_csf (h1, eri, norb, nelec, fs.transformer,
+                                                max_memory=max_memory)
+                        self.assertAlmostEqual (lib.fp (hdiag), lib.fp (hdiag_ref), 9)
+
+    def test_sigma_backend (self):
+        norb = 6
+        h1, eri = random_ham (norb)
+        for nelec, smult in (((3,3),1), ((4,2),3)):
+            fs_det = csf_solver (gto.M (verbose=0), smult=smult)
+            fs_conf = csf_solver (gto.M (verbose=0), smult=smult)
+            fs_conf.sigma_backend = 'conf'
+            for fs in (fs_det, fs_conf):
+                fs.nroots, fs.davidson_only, fs.pspace_size = 3, True, 10
+            with self.subTest (nelec=nelec, smult=smult):
+                e_det, ci_det = fs_det.kernel (h1, eri, norb, nelec)
+                e_conf, ci_conf = fs_conf.kernel (h1, eri, norb, nelec)
+                self.assertAlmostEqual (lib.fp (e_conf), lib.fp (e_det), 8)
+                ovlp = np.array ([[c0.ravel ().dot (c1.ravel ()) for c1 in ci_conf]
+                                  for c0 in ci_det])
+                self.assertAlmostEqual (lib.fp (np.abs (ovlp)), lib.fp (np.eye (3)), 6)
+            # A subclass's contract_2e is honored by the 'conf' backend too
+            class ShiftedSolver (type (fs_conf)):
+                def contract_2e (self, eri, fcivec, norb, nelec, link_index=None, **kwargs):
+                    hc = super().contract_2e (eri, fcivec, norb, nelec, link_index, **kwargs)
+                    return hc + 0.5 * fcivec
+            fs_shift = ShiftedSolver (gto.M (verbose=0))
+            fs_shift.__dict__.update (fs_conf.__dict__)
+            with self.subTest ('contract_2e override', nelec=nelec, smult=smult):
+                e_shift = fs_shift.kernel (h1, eri, norb, nelec)[0]
+                self.assertAlmostEqual (lib.fp (e_shift), lib.fp (np.asarray (e_det) + 0.5), 8)
+
+if __name__ == "__main__":
+    print("Full Tests for CSF pspace Hamiltonian")
+    unittest.main()
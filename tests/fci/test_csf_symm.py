@@ -0,0 +1,77 @@
+import numpy as np
+import unittest
+from pyscf import gto, lib
+from mrh.my_pyscf.fci import csf_symm
+from mrh.my_pyscf.fci.csf import CSFFCISolver
+
+def random_ham (norb, orbsym, seed=0):
+    rng = np.random.default_rng (seed)
+    h1 = rng.random ((norb,norb))
+    h1 = h1 + h1.T + np.diag (np.arange (norb)) * 4
+    eri = rng.random ((norb,)*4) * 0.1
+    eri = eri + eri.transpose (1,0,2,3)
+    eri = eri + eri.transpose (0,1,3,2)
+    eri = eri + eri.transpose (2,3,0,1)
+    h1[(orbsym[:,None] ^ orbsym[None,:]) != 0] = 0
+    eri[(orbsym[:,None,None,None] ^ orbsym[None,:,None,None]
+         ^ orbsym[None,None,:,None] ^ orbsym[None,None,None,:]) != 0] = 0
+    return h1, eri
+
+class FullSpaceSolver (csf_symm.FCISolver):
+    # Overriding contract_2e makes the kernel expand trial vectors into all determinants
+    def contract_2e (self, eri, fcivec, norb, nelec, link_index=None, **kwargs):
+        return super().contract_2e (eri, fcivec, norb, nelec, link_index=link_index, **kwargs)
+
+norb = 8
+orbsym = np.array ([0,1,2,3,0,1,2,3])
+h1, eri = random_ham (norb, orbsym)
+h1s = np.random.default_rng (1).random ((norb,norb))
+h1s = h1s + h1s.T
+h1s[(orbsym[:,None] ^ orbsym[None,:]) != 0] = 0
+
+class KnownValues(unittest.TestCase):
+
+    def test_hop (self):
+        for nelec, smult in (((4,4),1), ((4,4),3), ((4,3),2), ((6,2),5)):
+            for wfnsym in range (4):
+                fs = csf_symm.FCISolver (gto.M (verbose=0), smult=smult)
+                fs.orbsym, fs.wfnsym, fs.norb, fs.nelec = orbsym, wfnsym, norb, nelec
+                fs.check_transformer_cache ()
+                x = np.random.default_rng (2).random (fs.transformer.ncsf)
+                x /= np.linalg.norm (x)
+                for h1e in (h1, np.stack ([h1, h1s])):
+                    with self.subTest (nelec=nelec, smult=smult, wfnsym=wfnsym, h1s=h1e.ndim>2):
+                        h2e = fs.absorb_h1e (h1e, eri, norb, nelec, .5)
+                        hx_ref = CSFFCISolver.gen_hop_csf (fs, h2e, norb, nelec, fs.transformer) (x)
+                        hx = fs.gen_hop_csf (h2e, norb, nelec, fs.transformer) (x)
+                        self.assertAlmostEqual (lib.fp (hx), lib.fp (hx_ref), 10)
+
+    def test_kernel (self):
+        for nelec, smult, wfnsym in (((4,4),1,1), ((4,3),2,2)):
+            fs_ref = FullSpaceSolver (gto.M (verbose=0), smult=smult)
+            fs = csf_symm.FCISolver (gto.M (verbose=0), smult=smult)
+            for s in (fs, fs_ref):
+                s.orbsym, s.wfnsym, s.nroots = orbsym, wfnsym, 2
+            with self.subTest (nelec=nelec, smult=smult, wfnsym=wfnsym):
+                e_ref, ci_ref = fs_ref.kernel (h1, eri, norb, nelec)
+                e, ci = fs.kernel (h1, eri, norb, nelec)
+                self.assertAlmostEqual (lib.fp (e), lib.fp (e_ref), 9)
+                for c, c_ref in zip (ci, ci_ref):
+                    self.assertAlmostEqual (abs (c.ravel ().dot (c_ref.ravel ())), 1, 6)
+
+    def test_shared_prep (self):
+        # One prep dict shared by solvers of different irreps, as in H1EZipFCISolver.kernel
+        nelec, smult = (4,4), 1
+        for sigma_backend in ('det', 'conf'):
+            prep = {}
+            for wfnsym in (0, 1, 0):
+                fs = csf_symm.FCISolver (gto.M (verbose=0), smult=smult)
+                fs.orbsym, fs.wfnsym, fs.sigma_backend = orbsym, wfnsym, sigma_backend
+                with self.subTest (sigma_backend=sigma_backend, wfnsym=wfnsym):
+                    e_ref = fs.kernel (h1, eri, norb, nelec)[0]
+                    e = fs.kernel (h1, eri, norb, nelec, prep=prep)[0]
+                    self.assertAlmostEqual (e, e_ref, 9)
+
+if __name__ == "__main__":
+    print("Full Tests for symmetry-blocked CSF solver")
+    unittest.main()
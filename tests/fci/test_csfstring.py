@@ -0,0 +1,119 @@
+import numpy as np
+import unittest
+from pyscf import lib
+from pyscf.fci import cistring
+from mrh.my_pyscf.fci import csdstring
+from mrh.my_pyscf.fci.csfstring import CSFTransformer, get_csf_tables, get_csfvec_shape
+from mrh.my_pyscf.fci.csfstring import get_spin_evecs, transform_civec_det2csf
+
+def make_csd_mask_slow (norb, neleca, nelecb):
+    ndetb = cistring.num_strings (norb, nelecb)
+    ndet = cistring.num_strings (norb, neleca) * ndetb
+    ddaddrs = csdstring.csdaddrs2ddaddrs (norb, neleca, nelecb, np.arange (ndet))
+    return ddaddrs[0].astype (np.int64) * ndetb + ddaddrs[1]
+
+class KnownValues(unittest.TestCase):
+
+    def test_csd_mask (self):
+        for norb, neleca, nelecb in ((1,1,0), (4,2,2), (4,4,0), (6,4,1), (8,3,3), (8,5,4)):
+            with self.subTest (norb=norb, neleca=neleca, nelecb=nelecb):
+                csd_mask = csdstring.make_csd_mask (norb, neleca, nelecb)
+                self.assertTrue (np.all (csd_mask == make_csd_mask_slow (norb, neleca, nelecb)))
+                econf_det_mask = csdstring.make_econf_det_mask (norb, neleca, nelecb, csd_mask)
+                min_npair, _, dconf_size, sconf_size, spins_size = csdstring.get_csdaddrs_shape (
+                    norb, neleca, nelecb)
+                econf_csd = np.repeat (np.arange (np.dot (dconf_size, sconf_size)),
+                                       np.repeat (spins_size, dconf_size * sconf_size))
+                self.assertTrue (np.all (econf_det_mask == econf_csd[np.argsort (csd_mask)]))
+
+    def test_shared_tables (self):
+        t1 = CSFTransformer (6, 3, 3, 1)
+        t2 = CSFTransformer (6, 3, 3, 3)
+        t2._update_spin_cache (6, 3, 3, 1)
+        self.assertIs (t1.csd_mask, t2.csd_mask)
+        self.assertIs (get_csf_tables (6, 3, 3, 1).econf_csf_mask, t1.econf_csf_mask)
+        self.assertFalse (t1.csd_mask.flags.writeable)
+
+    def test_large_shape (self):
+        # More than 2**32 determinants: only the shapes, not the tables, are built
+        norb, neleca, nelecb = 24, 12, 12
+        ndet = cistring.num_strings (norb, neleca) * cistring.num_strings (norb, nelecb)
+        self.assertEqual (csdstring.check_csd_mask_size (norb, neleca, nelecb), ndet)
+        self.assertEqual (csdstring.get_mask_dtype (ndet), np.uint64)
+        self.assertEqual (csdstring.get_mask_dtype (2**32), np.uint32)
+        _, offset, dconf_size, sconf_size, spins_size = csdstring.get_csdaddrs_shape (
+            norb, neleca, nelecb)
+        self.assertEqual (offset.dtype, np.int64)
+        self.assertEqual (offset[-1] + dconf_size[-1] * sconf_size[-1] * spins_size[-1], ndet)
+        _, offset, dconf_size, sconf_size, csf_size = get_csfvec_shape (norb, neleca, nelecb, 1)
+        self.assertTrue (np.all (np.diff (offset) >= 0))
+        self.assertEqual (offset[-1] + dconf_size[-1] * sconf_size[-1] * csf_size[-1],
+                          np.sum (dconf_size * sconf_size * csf_size))
+
+    def test_transform (self):
+        rng = np.random.default_rng (0)
+        for norb, nelec, smult in ((6,(3,3),1), (8,(4,3),2), (8,(5,3),3)):
+            t = CSFTransformer (norb, *nelec, smult)
+            # Reference: gather, multiply, and scatter each npair block with numpy
+            min_npair, csd_offset, dconf_size, sconf_size, sdet_size = csdstring.get_csdaddrs_shape (
+                norb, *nelec)
+            _, csf_offset, _, _, csf_size = get_csfvec_shape (norb, *nelec, smult)
+            det = rng.random ((3, t.ndet))
+            csf_ref = np.zeros ((3, t.ncsf))
+            det_ref = np.zeros ((3, t.ndet))
+            csf = rng.random ((3, t.ncsf))
+            for ipair, ncsf in enumerate (csf_size):
+                if ncsf == 0: continue
+                nconf = dconf_size[ipair] * sconf_size[ipair]
+                nspin = sum (nelec) - 2*(min_npair + ipair)
+                det_addrs = t.csd_mask[csd_offset[ipair]:][:nconf*sdet_size[ipair]]
+                det_addrs = det_addrs.reshape (nconf, -1)
+                csf_addrs = slice (csf_offset[ipair], csf_offset[ipair] + nconf*ncsf)
+                umat = get_spin_evecs (nspin, *nelec, smult)
+                csf_ref[:,csf_addrs] = np.dot (det[:,det_addrs], umat).reshape (3, -1)
+                det_ref[:,det_addrs] = np.dot (csf[:,csf_addrs].reshape (3, nconf, ncsf), umat.T)
+            with self.subTest (norb=norb, nelec=nelec, smult=smult):
+                csf_test = t.vec_det2csf (det, normalize=False)
+                self.assertAlmostEqual (lib.fp (csf_test), lib.fp (csf_ref), 12)
+                csf_test = t.vec_det2csf (det.T, order='F', normalize=False)
+                self.assertAlmostEqual (lib.fp (csf_test), lib.fp (csf_ref.T), 12)
+                det_test = t.vec_csf2det (csf, normalize=False)
+                self.assertAlmostEqual (lib.fp (det_test), lib.fp (det_ref), 12)
+                # 64-bit addresses (csd_mask built on the fly)
+                csf_test = transform_civec_det2csf (det, norb, *nelec, smult, do_normalize=False)[0]
+                self.assertAlmostEqual (lib.fp (csf_test), lib.fp (csf_ref), 12)
+
+    def test_econf_index (self):
+        for norb, nelec, smult in ((6,(3,3),1), (8,(4,3),2), (8,(5,3),3)):
+            t = CSFTransformer (norb, *nelec, smult)
+            rng = np.random.default_rng (0)
+            econfs = rng.choice (t.nconf, size=min (t.nconf, 20), replace=False)
+            with self.subTest (norb=norb, nelec=nelec, smult=smult):
+                det_addrs = np.concatenate ([np.nonzero (t.econf_det_mask == conf)[0]
+                                             for conf in econfs])
+                csf_addrs = np.concatenate ([np.nonzero (t.econf_csf_mask == conf)[0]
+                                             for conf in econfs])
+                self.assertTrue (np.all (t.get_econf_det_addrs (econfs) == det_addrs))
+                self.assertTrue (np.all (t.get_econf_csf_addrs (econfs) == csf_addrs))
+
+    def test_mat_det2csf_confspace (self):
+        norb, nelec, smult = 8, (4,4), 3
+        t = CSFTransformer (norb, *nelec, smult)
+        rng = np.random.default_rng (0)
+        econfs = rng.choice (t.nconf, size=20, replace=False)
+        det_addrs = t.get_econf_det_addrs (econfs)
+        op = rng.random ((det_addrs.size, det_addrs.size))
+        op += op.T
+        op_csf, csf_addrs = t.mat_det2csf_confspace (op, econfs)
+        self.assertTrue (np.all (csf_addrs == np.sort (t.get_econf_csf_addrs (econfs))))
+        # Reference: transform within the full determinant space
+        op_full = np.zeros ((t.ndet, t.ndet))
+        op_full[np.ix_(det_addrs,det_addrs)] = op
+        op_full = t.vec_det2csf (op_full, normalize=False)
+        op_full = t.vec_det2csf (op_full.T, normalize=False)
+        self.assertAlmostEqual (np.abs (op_csf - op_full[np.ix_(csf_addrs,csf_addrs)]).max (),
+                                0, 12)
+
+if __name__ == "__main__":
+    print("Full Tests for CSF string tables")
+    unittest.main()
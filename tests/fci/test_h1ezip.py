@@ -1,10 +1,11 @@
 import numpy as np
 import unittest
-from pyscf import gto, scf, mcscf, lib
+from pyscf import gto, scf, mcscf, lib, symm
 from pyscf.lib import logger
 from pyscf.qmmm import add_mm_charges
 from mrh.my_pyscf.fci import csf_solver
 from mrh.my_pyscf.mcscf.addons import state_average_n_mix, get_h1e_zipped_fcisolver
+from mrh.my_pyscf.mcscf.addons import _get_shared_prep
 import time
 
 mol = gto.M (atom = 'O 0 0 0; H 1.145 0 0', basis='6-31g', symmetry=True, charge=-1, spin=0, verbose=0, output='/dev/null')
@@ -93,6 +94,47 @@ class KnownValues(unittest.TestCase):
         self.assertAlmostEqual (np.trace (dm1_states[1]), 7.0, 9)
         self.assertAlmostEqual (np.trace (dm1_states[2]), 7.0, 9)
 
+    def test_shared_prep (self):
+        h1eff = mc.get_h1eff ()[0]
+        h1eff_hp = mc_hp.get_h1eff ()[0]
+        prep_cache = []
+        preps = [_get_shared_prep (solver, h1e, mc.ncas, mc.fcisolver._get_nelec (solver, mc.nelecas),
+                                   prep_cache)
+                 for solver, h1e in zip (mc.fcisolver.fcisolvers, [h1eff_hp, h1eff, h1eff])]
+        self.assertEqual (len (prep_cache), 2)
+        self.assertIsNot (preps[0], preps[1])
+        self.assertIs (preps[1], preps[2])
+
+    def test_shared_prep_irreps (self):
+        # States of different irreps share one prep dict; energies must match unshared solves
+        mol_n2 = gto.M (atom='N 0 0 0; N 0 0 1.1', basis='6-31g', symmetry='D2h', verbose=0,
+                        output='/dev/null')
+        mf_n2 = scf.RHF (mol_n2).run ()
+        mc_n2 = mcscf.CASCI (mf_n2, 6, 6)
+        h1, ecore = mc_n2.get_h1eff ()
+        h2 = mc_n2.get_h2eff ()
+        orbsym = symm.label_orb_symm (mol_n2, mol_n2.irrep_id, mol_n2.symm_orb,
+                                      mf_n2.mo_coeff[:,4:10])
+        def get_solvers (sigma_backend):
+            solvers = []
+            for wfnsym in ('Ag', 'B1u', 'B2u'):
+                solver = csf_solver (mol_n2, smult=1)
+                solver.wfnsym, solver.sigma_backend = wfnsym, sigma_backend
+                solvers.append (solver)
+            return solvers
+        for sigma_backend in ('det', 'conf'):
+            with self.subTest (sigma_backend=sigma_backend):
+                mc_sa = state_average_n_mix (mcscf.CASCI (mf_n2, 6, 6),
+                                             get_solvers (sigma_backend), [1.0/3.0,]*3)
+                fcisolver = get_h1e_zipped_fcisolver (mc_sa.fcisolver)
+                fcisolver.kernel ([h1,]*3, h2, 6, (3,3), orbsym=orbsym, ecore=ecore)
+                e_ref = [solver.kernel (h1, h2, 6, (3,3), orbsym=orbsym, ecore=ecore)[0]
+                         for solver in get_solvers (sigma_backend)]
+                self.assertEqual (len (set (e_ref)), 3)
+                for e, e1 in zip (fcisolver.e_states, e_ref):
+                    self.assertAlmostEqual (e, e1, 9)
+        mol_n2.stdout.close ()
+
 if __name__ == "__main__":
     print("Full Tests for h1ezip")
     unittest.main()
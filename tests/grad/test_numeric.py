@@ -0,0 +1,41 @@
+import numpy as np
+from pyscf import gto, scf, mcscf, lib
+from mrh.my_pyscf.grad import numeric
+import unittest
+
+mol = mf = mc = de_ref = None
+def setUpModule():
+    global mol, mf, mc, de_ref
+    mol = gto.M (atom = 'Li 0 0 0\nH 1.5 0 0', basis = 'sto3g',
+                 output = '/dev/null', verbose = 0)
+    mf = scf.RHF (mol).run ()
+    mc = mcscf.CASSCF (mf, 2, 2).set (conv_tol=1e-10).run ()
+    de_ref = mc.nuc_grad_method ().kernel ()
+
+def tearDownModule():
+    global mol, mf, mc, de_ref
+    mol.stdout.close ()
+    del mol, mf, mc, de_ref
+
+class KnownValues(unittest.TestCase):
+
+    def test_schemes (self):
+        for scheme, tol in (('central',6), ('richardson',6), ('forward',3), ('backward',3)):
+            for max_workers in (1, 2):
+                with self.subTest (scheme=scheme, max_workers=max_workers):
+                    mc_grad = numeric.Gradients (mc, scheme=scheme, max_workers=max_workers,
+                                                 scanner_verbose=0)
+                    de = mc_grad.kernel ()
+                    self.assertAlmostEqual (lib.fp (de), lib.fp (de_ref), tol)
+
+    def test_tasks (self):
+        mc_grad = numeric.Gradients (mc, max_workers=4)
+        tasks = mc_grad.get_tasks ([0,1], 0.001)
+        self.assertEqual (len (tasks), 4)
+        self.assertEqual (sum ([len (t) for t in tasks]), 12)
+        tasks = mc_grad.get_tasks ([0,1], 0.001, scheme='forward', max_workers=1)
+        self.assertEqual (len (tasks), 6)
+
+if __name__ == "__main__":
+    print("Full Tests for numeric gradients")
+    unittest.main()
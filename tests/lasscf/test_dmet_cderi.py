@@ -0,0 +1,73 @@
+import unittest
+import numpy as np
+from pyscf import gto, scf
+from mrh.my_dmet import localintegrals, dmet
+from mrh.my_dmet.fragments import make_fragment_atom_list
+
+def setUpModule ():
+    global mol, mf, ints, bases
+    mol = gto.M (atom='H 0 0 0; H 1 0 0; H 2 0 0; H 3 0 0', basis='6-31g', verbose=0, output='/dev/null')
+    mf = scf.RHF (mol).density_fit ().run ()
+    ints = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin')
+    rng = np.random.default_rng (0)
+    bases = [np.linalg.qr (rng.random ((ints.norbs_tot, nimp)))[0] for nimp in (3, 5, 4)]
+
+def tearDownModule ():
+    global mol, mf, ints, bases
+    mol.stdout.close ()
+    del mol, mf, ints, bases
+
+def _set_impham (frag, bases):
+    # Stand-in for _frag_schmidt_impham: one impurity basis per fragment
+    frag.loc2emb = bases[int (frag.frag_name)]
+    frag.norbs_imp = frag.loc2emb.shape[1]
+    frag.impham_CDERI = frag.ints.dmet_cderi (frag.loc2emb, frag.norbs_imp)
+    frag.impham_built = True
+
+class KnownValues (unittest.TestCase):
+
+    def setUp (self):
+        ints.project_loc_cderi = False
+        ints.imp_cderi_max_memory = ints.max_memory / 4
+        ints._imp_cderi_cache = []
+
+    def test_project (self):
+        for loc2imp in bases:
+            ints.project_loc_cderi = False
+            ref = ints.dmet_cderi (loc2imp)
+            ints.project_loc_cderi = True
+            cderi = ints.dmet_cderi (loc2imp)
+            self.assertAlmostEqual (np.abs (cderi - ref).max (), 0, 12)
+            self.assertIs (ints.dmet_cderi (loc2imp + 1e-12), cderi)
+        self.assertEqual (len (ints._imp_cderi_cache), len (bases))
+        # The localized-basis tensor is stored packed
+        nloc = ints.norbs_tot
+        self.assertEqual (ints.get_loc_cderi ().shape, (mf.with_df.get_naoaux (), nloc*(nloc+1)//2))
+
+    def test_cache_memory (self):
+        ints.project_loc_cderi = True
+        cderi = [ints.dmet_cderi (loc2imp) for loc2imp in bases]
+        # Room for the two most recent arrays only
+        ints._imp_cderi_cache = []
+        ints.imp_cderi_max_memory = (cderi[1].nbytes + cderi[2].nbytes) / 1e6
+        for loc2imp, c in zip (bases, cderi): ints.cache_imp_cderi (loc2imp, c)
+        self.assertEqual ([c for l, c in ints._imp_cderi_cache], [cderi[2], cderi[1]])
+        # An array larger than the bound does not evict anything
+        ints.imp_cderi_max_memory = cderi[2].nbytes / 1e6
+        ints.cache_imp_cderi (bases[1], cderi[1])
+        self.assertEqual ([c for l, c in ints._imp_cderi_cache], [cderi[2], cderi[1]])
+
+    def test_parent_cache (self):
+        # Arrays projected in worker processes end up in the parent's cache
+        frags = [make_fragment_atom_list (ints, [2*i, 2*i+1], 'RHF', name=str (i), project_cderi=True)
+                 for i in range (2)]
+        ds = dmet (ints, frags, doLASSCF=True, max_workers=2, project_loc_cderi=True)
+        self.assertTrue (ints.project_loc_cderi)
+        ds.run_fragments (_set_impham, bases)
+        self.assertEqual (len (ints._imp_cderi_cache), 2)
+        for frag in frags:
+            self.assertIs (ints._get_cached_imp_cderi (frag.loc2emb), frag.impham_CDERI)
+
+if __name__ == "__main__":
+    print("Full Tests for DMET impurity cderi projection")
+    unittest.main()
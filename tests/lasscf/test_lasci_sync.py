@@ -0,0 +1,168 @@
+import unittest
+import numpy as np
+from pyscf import lib, gto, scf, ao2mo
+from mrh.my_pyscf.mcscf.lasscf_o0 import LASSCF
+from mrh.my_pyscf.mcscf import lasci_sync
+
+def setUpModule ():
+    global mol, mf, las, mo0
+    xyz = 'H 0 0 0; H 0.8 0 0; H 2.6 0 0; H 3.4 0 0; H 5.2 0 0; H 6.0 0 0'
+    mol = gto.M (atom=xyz, basis='6-31g', verbose=0, output='/dev/null')
+    mf = scf.RHF (mol).run ()
+    las = LASSCF (mf, (2,2,2), (2,2,2))
+    mo0 = las.localize_init_guess (([0,1],[2,3],[4,5]))
+    las.kernel (mo0)
+
+def tearDownModule ():
+    global mol, mf, las, mo0
+    mol.stdout.close ()
+    del mol, mf, las, mo0
+
+def record_ci_tol (las):
+    # Davidson thresholds passed to each fragment's CI solver, in call order
+    calls = []
+    for isub, fcibox in enumerate (las.fciboxes):
+        def kernel (*args, _kernel=fcibox.kernel, _isub=isub, **kwargs):
+            calls.append ((_isub, kwargs.get ('tol', None)))
+            return _kernel (*args, **kwargs)
+        fcibox.kernel = kernel
+    return calls
+
+class KnownValues (unittest.TestCase):
+
+    def test_ci_conv_tol_schedule (self):
+        las1 = LASSCF (mf, (2,2,2), (2,2,2)).set (ci_conv_tol_scale=0.1)
+        calls = record_ci_tol (las1)
+        las1.kernel (mo0)
+        tol_min = las1.fciboxes[0].fcisolvers[0].conv_tol
+        tol = np.array ([t for isub, t in calls]).reshape (-1, las1.nfrags)
+        # Loose in the first macrocycle, tight at convergence, and always within bounds
+        self.assertTrue (np.all (tol[0] == las1.ci_conv_tol_max))
+        self.assertLess (np.amax (tol[-1]), 1e-8)
+        self.assertTrue (np.all (tol >= tol_min))
+        self.assertTrue (np.all (tol <= las1.ci_conv_tol_max))
+        tol = lasci_sync.get_ci_conv_tol (las1, norm_gorb=1e-12, norm_gci_sub=[1e-12,]*3)
+        self.assertEqual (tol, [tol_min,]*3)
+        # Same answer as fixed thresholds, which are the default
+        las2 = LASSCF (mf, (2,2,2), (2,2,2))
+        calls = record_ci_tol (las2)
+        las2.kernel (mo0)
+        self.assertIsNone (lasci_sync.get_ci_conv_tol (las2))
+        self.assertTrue (all ([t is None for isub, t in calls]))
+        self.assertTrue (las1.converged and las2.converged)
+        self.assertAlmostEqual (las1.e_tot, las2.e_tot, 8)
+
+    def test_ci_skip (self):
+        las1 = LASSCF (mf, (2,2,2), (2,2,2)).set (ci_skip_tol=1e-6)
+        mo, ci0 = las.mo_coeff, las.ci
+        h2eff_sub = las1.get_h2eff (mo)
+        veff = las1.get_veff (dm1s=las1.make_rdm1 (mo_coeff=mo, ci=ci0))
+        veff = las1.split_veff (veff, h2eff_sub, mo_coeff=mo, ci=ci0)
+        casdm1frs = las1.states_make_casdm1s_sub (ci=ci0)
+        log = lib.logger.new_logger (las1, las1.verbose)
+        def ci_cycle (ci, norm_gci_sub):
+            calls.clear ()
+            return lasci_sync.ci_cycle (las1, mo, ci, veff, h2eff_sub, casdm1frs, log,
+                                        hprev=hprev, norm_gci_sub=norm_gci_sub)
+        calls = record_ci_tol (las1)
+        hprev = [None,]*3
+        e_ref, ci_ref = ci_cycle (ci0, None)
+        self.assertEqual ([isub for isub, t in calls], [0,1,2])
+        # Move fragment 0 away from its solution: with converged CI gradients and unchanged
+        # Hamiltonians, fragments 0 and 1 keep their CI vectors and only fragment 2 is solved
+        c = ci_ref[0][0] + 0.01 * np.random.default_rng (0).random (ci_ref[0][0].shape)
+        ci1 = [[c / np.linalg.norm (c)], ci_ref[1], ci_ref[2]]
+        e_cas, ci2 = ci_cycle (ci1, [0,0,1])
+        self.assertEqual ([isub for isub, t in calls], [2])
+        for isub in range (2):
+            self.assertTrue (np.array_equal (ci2[isub][0], ci1[isub][0]))
+        self.assertGreater (e_cas[0], e_ref[0] + 1e-6)
+        self.assertAlmostEqual (e_cas[1], e_ref[1], 10)
+        # A change in the Hamiltonian larger than ci_skip_tol makes fragment 0 solved again
+        hprev[0] = (hprev[0][0] + 2*las1.ci_skip_tol,) + hprev[0][1:]
+        e_cas, ci2 = ci_cycle (ci1, [0,0,0])
+        self.assertEqual ([isub for isub, t in calls], [0])
+        self.assertAlmostEqual (e_cas[0], e_ref[0], 8)
+
+    def test_trust_region_step (self):
+        las1 = LASSCF (mf, (2,2,2), (2,2,2))
+        h2eff_sub = las1.get_h2eff (mo0)
+        ci0 = las1.get_init_guess_ci (mo0, h2eff_sub)
+        veff = las1.get_veff (dm1s=las1.make_rdm1 (mo_coeff=mo0, ci=ci0))
+        veff = las1.split_veff (veff, h2eff_sub, mo_coeff=mo0, ci=ci0)
+        H_op = las1.get_hop (ugg=las1.get_ugg (mo0, ci0), mo_coeff=mo0, ci=ci0,
+                             h2eff_sub=h2eff_sub, veff=veff)
+        g_vec = H_op.get_grad ()
+        u = -g_vec / np.linalg.norm (g_vec)
+        log = lib.logger.new_logger (las1, las1.verbose)
+        def step (x, trust_radius):
+            mo2, ci2, h2eff_sub2, veff2, trust_radius, x_rem = lasci_sync.trust_region_step (
+                las1, H_op, x, h2eff_sub.copy (), trust_radius, log)
+            e2 = las1.energy_nuc () + las1.energy_elec (mo_coeff=mo2, ci=ci2, h2eff=h2eff_sub2,
+                                                        veff=veff2)
+            return e2 - H_op.e_tot, trust_radius, x_rem
+        de_ref = [step (s*u, 10.0)[0] for s in (0.1, 0.3)]
+        self.assertLess (max (de_ref), 0)
+        # A step longer than the trust radius is scaled down to it and the rest of it is kept
+        # for the next macrocycle; the model is good, so the radius grows
+        de, trust_radius, x_rem = step (u, 0.1)
+        self.assertAlmostEqual (de, de_ref[0], 10)
+        self.assertAlmostEqual (lib.fp (x_rem), lib.fp (0.9*u), 10)
+        self.assertAlmostEqual (trust_radius, 0.2, 10)
+        # With a Hessian too soft by a factor of 10, the model predicts an energy lowering
+        # where the energy goes up: those steps are rejected and halved, and the radius shrinks
+        matvec = H_op._matvec
+        with lib.temporary_env (H_op, _matvec=lambda x: 0.1 * matvec (x)):
+            de, trust_radius, x_rem = step (1.2*u, 10.0)
+            self.assertAlmostEqual (de, de_ref[1], 10)
+            self.assertAlmostEqual (lib.fp (x_rem), lib.fp (0.9*u), 10)
+            self.assertAlmostEqual (trust_radius, 0.3, 10)
+            # After three rejections, the last (shortest) trial step is taken anyway
+            de, trust_radius, x_rem = step (2.4*u, 10.0)
+            self.assertGreater (de, 0)
+            self.assertAlmostEqual (lib.fp (x_rem), lib.fp (1.8*u), 10)
+        # A step uphill in the model is replaced by the Cauchy point
+        de, trust_radius, x_rem = step (-u, 10.0)
+        self.assertLess (de, de_ref[0])
+        self.assertIsNone (x_rem)
+
+    def test_update_grad (self):
+        mf_df = scf.RHF (mol).density_fit ().run ()
+        las1 = LASSCF (mf_df, (2,2,2), (2,2,2))
+        h2eff_sub = las1.get_h2eff (mo0)
+        ci0 = las1.get_init_guess_ci (mo0, h2eff_sub)
+        ugg = las1.get_ugg (mo0, ci0)
+        H_op = las1.get_hop (ugg=ugg, mo_coeff=mo0, ci=ci0, h2eff_sub=h2eff_sub)
+        g_vec = H_op.get_grad ()
+        x = np.zeros_like (g_vec)
+        i = np.argmax (np.abs (g_vec[:ugg.nvar_orb]))
+        x[i] = -1e-3 * np.sign (g_vec[i])
+        mo1, ci1, h2eff_sub1 = H_op.update_mo_ci_eri (x, h2eff_sub.copy ())
+        # A small rotation of one orbital pair: bPpj is carried over, not rebuilt, but the
+        # gradient must be that of a new operator at the new keyframe all the same
+        H_op.update_(mo1, ci1, h2eff_sub1)
+        self.assertIsNotNone (H_op.bPpj)
+        H_ref = las1.get_hop (ugg=ugg, mo_coeff=mo1, ci=ci1, h2eff_sub=h2eff_sub1)
+        self.assertAlmostEqual (lib.fp (H_op.get_grad ()), lib.fp (H_ref.get_grad ()), 9)
+        self.assertAlmostEqual (H_op.e_tot, H_ref.e_tot, 9)
+
+    def test_eri_diag (self):
+        mf_df = scf.RHF (mol).density_fit ().run ()
+        las1 = LASSCF (mf_df, (2,2,2), (2,2,2))
+        H_op = las1.get_hop (ugg=las1.get_ugg (mo0, las.ci), mo_coeff=mo0, ci=las.ci)
+        jdiag, kdiag = H_op._get_eri_diag ()
+        nmo, nocc = H_op.nmo, H_op.nocc
+        eri = ao2mo.restore (1, mf_df.with_df.ao2mo (mo0), nmo)
+        # Every pair with at least one occupied orbital, including inactive-external pairs
+        idx = np.zeros ((nmo, nmo), dtype=bool)
+        idx[:nocc,:] = idx[:,:nocc] = True
+        self.assertFalse (np.any (np.isnan (jdiag[idx])))
+        self.assertFalse (np.any (np.isnan (kdiag[idx])))
+        jdiag_ref = np.einsum ('ppqq->pq', eri)
+        kdiag_ref = np.einsum ('pqpq->pq', eri)
+        self.assertAlmostEqual (np.amax (np.abs (jdiag[idx] - jdiag_ref[idx])), 0, 9)
+        self.assertAlmostEqual (np.amax (np.abs (kdiag[idx] - kdiag_ref[idx])), 0, 9)
+
+if __name__ == "__main__":
+    print("Full Tests for LASCI macrocycle controls")
+    unittest.main()
@@ -138,7 +138,20 @@ class KnownValues(unittest.TestCase):
     def test_prec (self):
         M_op = h_op.get_prec ()
         Mx = M_op._matvec (x)
-        self.assertAlmostEqual (lib.fp (Mx), 0.6376305050505824, 6)
+        self.assertAlmostEqual (lib.fp (Mx), 0.9798502937452396, 6)
+
+    def test_update (self):
+        h2eff_sub = las.get_h2eff (las.mo_coeff)
+        h_op1 = las.get_hop (ugg=ugg, h2eff_sub=h2eff_sub)
+        mo1, ci1, h2eff_sub1 = h_op1.update_mo_ci_eri (0.01*x, h2eff_sub)
+        h_op1.update_(mo1, ci1, h2eff_sub1)
+        h_op1._init_eri_()
+        h_op2 = las.get_hop (ugg=ugg, mo_coeff=mo1, ci=ci1, h2eff_sub=h2eff_sub1)
+        self.assertAlmostEqual (h_op1.e_tot, h_op2.e_tot, 9)
+        self.assertAlmostEqual (lib.fp (h_op1.get_grad ()), lib.fp (h_op2.get_grad ()), 9)
+        self.assertAlmostEqual (lib.fp (h_op1._matvec (x)), lib.fp (h_op2._matvec (x)), 7)
+        self.assertAlmostEqual (lib.fp (h_op1.get_prec ()._matvec (x)),
+                                lib.fp (h_op2.get_prec ()._matvec (x)), 6)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import unittest
+import h5py
+import numpy as np
+from pyscf import lib, gto, scf
+from mrh.my_pyscf.mcscf.lasscf_o0 import LASSCF
+from mrh.my_pyscf.mcscf.lasscf_async_crunch import make_impurity_cderi, update_impurity_heff_
+from mrh.my_pyscf.mcscf.lasscf_async_crunch import ImpurityMole, ImpurityHF
+
+def setUpModule ():
+    global mol, mf, las
+    mol = gto.M (atom='H 0 0 0; H 1 0 0; H 2 0 0; H 3 0 0; H 4 0 0; H 5 0 0', basis='6-31g',
+                 verbose=0, output='/dev/null')
+    mf = scf.RHF (mol).density_fit ().run ()
+    las = LASSCF (mf, (2,2), (2,2))
+
+def tearDownModule ():
+    global mol, mf, las
+    mol.stdout.close ()
+    del mol, mf, las
+
+class KnownValues (unittest.TestCase):
+
+    def test_impurity_cderi (self):
+        # Three impurities transformed in one pass, in several blocks of the parent tensor
+        rng = np.random.default_rng (0)
+        nao = mol.nao_nr ()
+        imporb_coeffs = [np.linalg.qr (rng.random ((nao, nimp)))[0] for nimp in (3, 5, 4)]
+        cderi = lib.unpack_tril (mf.with_df._cderi)
+        with lib.temporary_env (mf.with_df, blockdim=7):
+            erifile, datanames = make_impurity_cderi (las, imporb_coeffs)
+        self.assertEqual (len (datanames), len (imporb_coeffs))
+        with h5py.File (erifile.name, 'r') as f:
+            for imporb_coeff, dataname in zip (imporb_coeffs, datanames):
+                ref = np.einsum ('Pij,ip,jq->Ppq', cderi, imporb_coeff, imporb_coeff)
+                self.assertAlmostEqual (np.abs (f[dataname][()] - lib.pack_tril (ref)).max (),
+                                        0, 12)
+
+    def test_update_impurity_heff (self):
+        rng = np.random.default_rng (1)
+        nao = mol.nao_nr ()
+        imporb_coeffs = [np.linalg.qr (rng.random ((nao, nimp)))[0] for nimp in (3, 5, 4)]
+        mo = mf.mo_coeff
+        dm1s = np.stack ([mo[:,:3] @ mo[:,:3].T,]*2, axis=0)
+        veff = np.stack ([mf.get_veff (dm=dm1s.sum (0)),]*2, axis=0)
+        def get_imp_scfs ():
+            return [ImpurityHF (ImpurityMole (las, c, (1,1))).density_fit ()
+                    for c in imporb_coeffs]
+        imp_scfs = get_imp_scfs ()
+        update_impurity_heff_(imp_scfs, veff, dm1s)
+        # All impurity tensors are made in one pass into one file
+        erifile = imp_scfs[0]._imporb_erifile
+        self.assertTrue (all ([imp_scf._imporb_erifile is erifile for imp_scf in imp_scfs]))
+        self.assertEqual (len (set ([imp_scf.with_df._dataname for imp_scf in imp_scfs])),
+                          len (imp_scfs))
+        # Same Hamiltonians as those made fragment by fragment
+        for imp_scf, ref in zip (imp_scfs, get_imp_scfs ()):
+            ref._update_heff_(veff, dm1s)
+            self.assertAlmostEqual (lib.fp (imp_scf.get_hcore ()), lib.fp (ref.get_hcore ()), 10)
+            self.assertAlmostEqual (imp_scf.energy_nuc (), ref.energy_nuc (), 10)
+            dm = np.eye (imp_scf.mol.nao ())
+            vj, vk = imp_scf.get_jk (imp_scf.mol, dm)
+            vj_ref, vk_ref = ref.get_jk (ref.mol, dm)
+            self.assertAlmostEqual (lib.fp (vj), lib.fp (vj_ref), 10)
+            self.assertAlmostEqual (lib.fp (vk), lib.fp (vk_ref), 10)
+
+if __name__ == "__main__":
+    print("Full Tests for LASSCF async impurity DF tensors")
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import numpy as np
+from pyscf import lib, scf
+from c2h4n4_struct import structure as struct
+from mrh.my_pyscf.mcscf.lasscf_o0 import LASSCF
+from mrh.my_pyscf.mcscf.lassi_states import get_single_excitation_estimates
+
+def setUpModule ():
+    global mol, mf, las_det, las_csf
+    mol = struct (2.0, 2.0, '6-31g', symmetry=False)
+    mol.verbose = lib.logger.DEBUG
+    mol.output = '/dev/null'
+    mol.build ()
+    mf = scf.RHF (mol).run ()
+    las_det = LASSCF (mf, (4,4), ((3,1),(1,3)), spin_sub=(3,3))
+    mo = las_det.localize_init_guess ((list (range (3)), list (range (7,10))))
+    las_det.state_average_(weights=[0.5,0.5], spins=[[2,-2],[0,0]], smults=[[3,3],[1,1]])
+    las_csf = LASSCF (mf, (4,4), ((3,1),(1,3)), spin_sub=(3,3))
+    las_csf.ci_basis = 'csf'
+    las_csf.state_average_(weights=[0.5,0.5], spins=[[2,-2],[0,0]], smults=[[3,3],[1,1]])
+    las_det.kernel (mo)
+    las_csf.kernel (mo)
+
+def tearDownModule ():
+    global mol, mf, las_det, las_csf
+    mol.stdout.close ()
+    del mol, mf, las_det, las_csf
+
+class KnownValues (unittest.TestCase):
+
+    def test_ci_basis (self):
+        self.assertEqual (las_det.ci_basis, 'det')
+        self.assertEqual (las_csf.ci_basis, 'csf')
+        for ci_det_f, ci_csf_f, fcibox, nelecas in zip (las_det.ci, las_csf.ci, las_csf.fciboxes,
+                                                        las_csf.nelecas_sub):
+            for c_det, c_csf, solver in zip (ci_det_f, ci_csf_f, fcibox.fcisolvers):
+                self.assertEqual (c_csf.ndim, 1)
+                c_det1 = solver.ci_to_det (c_csf, 4, fcibox._get_nelec (solver, nelecas))
+                self.assertEqual (c_det1.shape, c_det.shape)
+                self.assertAlmostEqual (abs (np.dot (c_det.ravel (), c_det1.ravel ())), 1, 8)
+
+    def test_energy (self):
+        self.assertAlmostEqual (las_csf.e_tot, las_det.e_tot, 9)
+        for e_csf, e_det in zip (las_csf.e_states, las_det.e_states):
+            self.assertAlmostEqual (e_csf, e_det, 9)
+
+    def test_rdm (self):
+        dm1s_det = las_det.states_make_casdm1s ()
+        dm1s_csf = las_csf.states_make_casdm1s ()
+        self.assertAlmostEqual (lib.fp (dm1s_csf), lib.fp (dm1s_det), 7)
+        dm2_det = las_det.make_casdm2 ()
+        dm2_csf = las_csf.make_casdm2 ()
+        self.assertAlmostEqual (lib.fp (dm2_csf), lib.fp (dm2_det), 7)
+
+    def test_lassi (self):
+        e_det = las_det.lassi ()[0]
+        e_csf = las_csf.lassi ()[0]
+        self.assertAlmostEqual (lib.fp (e_csf), lib.fp (e_det), 8)
+
+    def test_excitation_estimates (self):
+        v2_det, de_det = get_single_excitation_estimates (las_det)
+        v2_csf, de_csf = get_single_excitation_estimates (las_csf)
+        self.assertAlmostEqual (lib.fp (v2_csf), lib.fp (v2_det), 7)
+        self.assertAlmostEqual (lib.fp (de_csf), lib.fp (de_det), 7)
+
+    def test_switch_basis (self):
+        ci = [[c.copy () for c in ci_f] for ci_f in las_csf.ci]
+        las_csf.ci_basis = 'det'
+        try:
+            self.assertEqual (las_csf.ci[0][0].shape, las_det.ci[0][0].shape)
+            las_csf.ci_basis = 'csf'
+            for ci0_f, ci1_f in zip (ci, las_csf.ci):
+                for c0, c1 in zip (ci0_f, ci1_f):
+                    self.assertAlmostEqual (lib.fp (c1), lib.fp (c0), 9)
+        finally:
+            las_csf.ci_basis = 'csf'
+            las_csf.ci = ci
+
+if __name__ == "__main__":
+    print("Full Tests for LASSCF with CI vectors in the CSF basis")
+    unittest.main()
+
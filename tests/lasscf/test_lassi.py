@@ -22,6 +22,8 @@ from pyscf.tools import molden
 from c2h4n4_struct import structure as struct
 from mrh.my_pyscf.mcscf.lasscf_o0 import LASSCF
 from mrh.my_pyscf.mcscf.lassi import roots_make_rdm12s, make_stdm12s, ham_2q
+from mrh.my_pyscf.mcscf.lassi import LASSIHamiltonian, lassi
+from mrh.my_pyscf.mcscf import lassi_op_o1
 
 dr_nn = 2.0
 mol = struct (dr_nn, dr_nn, '6-31g', symmetry=False)
@@ -101,6 +103,39 @@ class KnownValues(unittest.TestCase):
         for e1, e0 in zip (e_roots_test, e_roots):
             self.assertAlmostEqual (e1, e0, 8)
 
+    def test_hamobj (self):
+        # Add states, remove states, and add states again to the same symmetry block
+        hamobj = LASSIHamiltonian (las)
+        h0, h1, h2 = ham_2q (las, las.mo_coeff)
+        for states in ([0,1], [0,1,2,3], [1,3], [1,2,3]):
+            idx = np.zeros (las.nroots, dtype=bool)
+            idx[states] = True
+            ci_blk = [[cr[i] for i in states] for cr in las.ci]
+            ham_test, s2_test, ovlp_test = hamobj.ham (las, ci_blk, idx, (4,4,0))
+            ham_ref, s2_ref, ovlp_ref = lassi_op_o1.ham (las, h1, h2, ci_blk, idx)
+            with self.subTest (states=states):
+                self.assertAlmostEqual (lib.fp (ham_test), lib.fp (ham_ref), 9)
+                self.assertAlmostEqual (lib.fp (s2_test), lib.fp (s2_ref), 9)
+                self.assertAlmostEqual (lib.fp (ovlp_test), lib.fp (ovlp_ref), 9)
+        d1s_test, d2s_test = hamobj.roots_make_rdm12s (las, ci_blk, idx, si[:3,:3], (4,4,0))
+        d1s_ref, d2s_ref = lassi_op_o1.roots_make_rdm12s (las, ci_blk, idx, si[:3,:3])
+        self.assertAlmostEqual (lib.fp (d1s_test), lib.fp (d1s_ref), 9)
+        self.assertAlmostEqual (lib.fp (d2s_test), lib.fp (d2s_ref), 9)
+
+    def test_hamobj_kwargs (self):
+        hamobj = LASSIHamiltonian (las)
+        self.assertIsNone (si.hamobj)
+        e_test, si_test = lassi (las, mo_coeff=las.mo_coeff.copy (), hamobj=hamobj, keep_hamobj=True)
+        self.assertAlmostEqual (lib.fp (e_test), lib.fp (e_roots), 9)
+        self.assertIs (si_test.hamobj, hamobj)
+        mo_coeff = las.mo_coeff.copy ()
+        mo_coeff[:,[las.ncore,las.ncore+1]] = mo_coeff[:,[las.ncore+1,las.ncore]]
+        for kwargs in ({'mo_coeff': mo_coeff}, {'veff_c': 0}, {'h2eff_sub': 0}, {'opt': 0},
+                       {'soc': True}):
+            with self.subTest (kwargs=list (kwargs.keys ())):
+                with self.assertRaises (ValueError):
+                    lassi (las, hamobj=hamobj, **kwargs)
+
 if __name__ == "__main__":
     print("Full Tests for SA-LASSI")
     unittest.main()
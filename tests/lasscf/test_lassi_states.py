@@ -0,0 +1,126 @@
+import sys
+import itertools
+import unittest
+import numpy as np
+from pyscf import gto, scf
+from mrh.my_pyscf.mcscf.lasscf_o0 import LASSCF
+from mrh.my_pyscf.mcscf.lasci import get_state_info
+from mrh.my_pyscf.mcscf.lassi import lassi
+from mrh.my_pyscf.mcscf import lassi_states
+from mrh.my_pyscf.fci.csfstring import ImpossibleSpinError
+
+def setUpModule ():
+    global mol, mf, las
+    xyz = 'H 0 0 0; H 0.8 0 0; H 2.6 0 0; H 3.4 0 0; H 5.2 0 0; H 6.0 0 0'
+    mol = gto.M (atom=xyz, basis='6-31g', verbose=0, output='/dev/null')
+    mf = scf.RHF (mol).run ()
+    las = LASSCF (mf, (2,2,2), (2,2,2))
+    mo = las.localize_init_guess (([0,1],[2,3],[4,5]))
+    las.kernel (mo)
+
+def tearDownModule ():
+    global mol, mf, las
+    mol.stdout.close ()
+    del mol, mf, las
+
+def get_states (las):
+    return np.concatenate ([np.asarray (x) for x in get_state_info (las)[:3]], axis=1)
+
+def get_singles_slow (state):
+    # The loop-based enumeration which get_single_excitations replaced
+    singles = []
+    for s, (dna, dnb) in enumerate (((1,0),(0,1))):
+        has_e = np.where ((state.neleca, state.nelecb)[s] > 0)[0]
+        has_h = np.where ((state.nholea, state.nholeb)[s] > 0)[0]
+        for i, a in itertools.product (has_e, has_h):
+            if i==a: continue
+            si_range = state.get_valid_smult_change (i, -dna, -dnb)
+            sa_range = state.get_valid_smult_change (a, dna, dnb)
+            for si, sa in itertools.product (si_range, sa_range):
+                try:
+                    singles.append (state.get_single (i,a,s,si,sa))
+                except ImpossibleSpinError:
+                    pass
+    return singles
+
+def random_state (rng, nlas, nelelas):
+    nelec = np.array ([rng.integers (0, 2*n+1) for n in nlas])
+    spins = np.array ([rng.choice (np.arange (-min (n, 2*o-n), min (n, 2*o-n)+1, 2))
+                       for n, o in zip (nelec, nlas)])
+    min_smult, max_smult = lassi_states._smult_range (nlas, (nelec+spins)//2, (nelec-spins)//2)
+    smults = np.array ([rng.choice (np.arange (s0, s1+1, 2))
+                        for s0, s1 in zip (min_smult, max_smult)])
+    return nelelas - nelec, spins, smults
+
+class KnownValues (unittest.TestCase):
+
+    def test_single_excitations (self):
+        rng = np.random.default_rng (0)
+        for icase in range (300):
+            nfrag = rng.integers (2, 5)
+            nlas = rng.integers (1, 5, size=nfrag)
+            nelelas = np.array ([rng.integers (0, 2*n+1) for n in nlas])
+            charges, spins, smults = random_state (rng, nlas, nelelas)
+            state = lassi_states.SingleLASState (None, spins, smults, charges, 0, nlas=nlas,
+                                                 nelelas=nelelas, stdout=sys.stdout, verbose=0)
+            ref = [np.concatenate ([x.charges, x.spins, x.smults])
+                   for x in get_singles_slow (state)]
+            test = np.concatenate (lassi_states.get_single_excitations (
+                nlas, nelelas, charges, spins, smults)[:3], axis=1)
+            with self.subTest (icase=icase, nlas=nlas, nelelas=nelelas, charges=charges,
+                               spins=spins, smults=smults):
+                self.assertEqual (len (test), len (ref))
+                if len (ref): self.assertTrue (np.all (test == np.asarray (ref)))
+
+    def test_estimates_brute_force (self):
+        # LASSI energy lowering of the reference by each group of single excitations (s,i,a)
+        charges, spins, smults = [np.asarray (x) for x in get_state_info (las)[:3]]
+        c1, m1, s1, _, i, a, s = lassi_states.get_single_excitations (las.ncas_sub, [2,2,2],
+                                                                      charges, spins, smults)
+        las1 = las.state_average (weights=[1,]+[0,]*len (c1),
+                                  charges=np.append (charges, c1, axis=0),
+                                  spins=np.append (spins, m1, axis=0),
+                                  smults=np.append (smults, s1, axis=0))
+        las1.lasci ()
+        v2, de = lassi_states.get_single_excitation_estimates (las)
+        kept_ref = set ()
+        for key in set (zip (s, i, a)):
+            idx = [0,] + [k+1 for k, key1 in enumerate (zip (s, i, a)) if key1 == key]
+            states = get_states (las1)[idx]
+            las2 = las.state_average (weights=[1,]+[0,]*(len (idx)-1), charges=states[:,:3],
+                                      spins=states[:,3:6], smults=states[:,6:])
+            las2.e_states = las1.e_states[idx]
+            e = lassi (las2, ci=[[ci_r[k] for k in idx] for ci_r in las1.ci])[0][0]
+            de_bf = las.e_tot - e
+            e2 = v2[key] / de[key]
+            with self.subTest (key=key):
+                # The estimate is cheap and crude, but right to within an order of magnitude
+                self.assertLess (de_bf, e2)
+                self.assertLess (e2, 20*de_bf)
+            if de_bf > 1e-7: kept_ref.add (key)
+        # Selection at conv_tol=1e-6 keeps the same groups as brute force at 1e-7
+        las3 = lassi_states.screened_single_excitations (las, conv_tol=1e-6)
+        rows = [tuple (x) for x in np.concatenate ([c1, m1, s1], axis=1)]
+        kept = set (key for row, key in zip (rows, zip (s, i, a))
+                    if row in set (tuple (x) for x in get_states (las3)[1:]))
+        self.assertEqual (kept, kept_ref)
+        self.assertEqual (len (kept), 8)
+
+    def test_reference_order (self):
+        # Each parent is screened with the estimates of its own reference state, so the
+        # selection does not depend on the order of the reference states
+        refs = [np.array (x) for x in ([[0,0,0],[0,1,-1]], [[0,0,0],[0,1,-1]],
+                                       [[1,1,1],[1,2,2]])]
+        selected = []
+        for order in ([0,1], [1,0]):
+            las1 = las.state_average (weights=[.5,.5], charges=refs[0][order],
+                                      spins=refs[1][order], smults=refs[2][order])
+            las1.lasci ()
+            las2 = lassi_states.screened_single_excitations (las1, conv_tol=1e-6)
+            selected.append (set (tuple (x) for x in get_states (las2)[2:]))
+        self.assertEqual (selected[0], selected[1])
+        self.assertGreater (len (selected[0]), 0)
+
+if __name__ == "__main__":
+    print("Full Tests for LASSI model-space generation")
+    unittest.main()
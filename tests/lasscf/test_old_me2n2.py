@@ -13,15 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import copy
+import tempfile
 import unittest
+import h5py
 import numpy as np
 from pyscf import lib, gto, scf, dft, fci, mcscf, df
 from me2n2_struct import structure as struct
 from mrh.my_dmet import localintegrals, dmet, fragments
 from mrh.my_dmet.fragments import make_fragment_atom_list, make_fragment_orb_list
 
-def run (mf, CASlist=None, **kwargs):
+def build (mf, CASlist=None, **kwargs):
     # I/O
     # --------------------------------------------------------------------------------------------------------------------
     mol = mf.mol
@@ -51,6 +54,10 @@ def run (mf, CASlist=None, **kwargs):
     # --------------------------------------------------------------------------------------------------------------------
     me2n2_dmet = dmet (myInts, fraglist, **my_kwargs)
     me2n2_dmet.generate_frag_cas_guess (mf.mo_coeff, caslst=CASlist, force_imp=True, confine_guess=False)
+    return me2n2_dmet
+
+def run (mf, CASlist=None, **kwargs):
+    me2n2_dmet = build (mf, CASlist=CASlist, **kwargs)
     
     # Calculation
     # --------------------------------------------------------------------------------------------------------------------
@@ -87,9 +94,42 @@ class KnownValues(unittest.TestCase):
     def test_lasscf_df (self):
         self.assertAlmostEqual (run (mf_df), mc_df.e_tot, 6)
 
+    def test_lasscf_parallel (self):
+        self.assertAlmostEqual (run (mf, max_workers=2), mc.e_tot, 6)
+
     def test_lasscf_hs (self):
         self.assertAlmostEqual (run (mf_hs), mf_hs.e_tot, 8)
 
+    def test_checkpoint (self):
+        with tempfile.TemporaryDirectory () as tmpdir:
+            calcname = os.path.join (tmpdir, 'me2n2_chk')
+            fname = calcname + '.chk.h5'
+            dmet0 = build (mf, calcname=calcname, checkpoint_keep=2)
+            dmet0.doselfconsistent ()
+            dmet0.lasci_log.close ()
+            dmet0.save_checkpoint (fname)
+            with h5py.File (fname, 'r') as f: last = int (f.attrs['last'])
+            self.assertGreater (last, 1)
+            # A new calculation restarted from the file continues it
+            dmet1 = build (mf, calcname=calcname, checkpoint_keep=2)
+            dmet1.load_checkpoint (fname)
+            dmet1.save_checkpoint (fname)
+            with h5py.File (fname, 'r') as f:
+                self.assertEqual (int (f.attrs['last']), last+1)
+                self.assertEqual (sorted (int (key) for key in f['iter']), [last, last+1])
+            self.assertAlmostEqual (dmet1.chempot, dmet0.chempot, 12)
+            for f0, f1 in zip (dmet0.fragments, dmet1.fragments):
+                if not f0.norbs_as: continue
+                proj = f0.loc2amo @ f0.loc2amo.conjugate ().T
+                self.assertAlmostEqual (lib.fp (f1.oneRDMas_loc), lib.fp (proj @ f0.oneRDM_loc @ proj), 8)
+                self.assertAlmostEqual (lib.fp (f1.E2_cum), lib.fp (f0.E2_cum), 8)
+            # A new calculation that was not restarted from the file starts it over
+            dmet2 = build (mf, calcname=calcname)
+            dmet2.save_checkpoint (fname)
+            with h5py.File (fname, 'r') as f:
+                self.assertEqual (int (f.attrs['last']), 0)
+                self.assertEqual (list (f['iter'].keys ()), ['0'])
+
     def test_lasscf_hs_df (self):
         self.assertAlmostEqual (run (mf_hs_df), mf_hs_df.e_tot, 8)
 